@@ -1,10 +1,15 @@
 import os
 from starlite import Starlite, OpenAPIConfig
-from object_detection_ign.api.routes import ObjectDetectionController, health_check
+from object_detection_ign.api.routes import (
+    ObjectDetectionController,
+    health_check,
+    metrics,
+    readiness_check,
+)
 
 from object_detection_ign.api.api_configuration import (
     set_state_on_startup,
-    api_initialization,
+    start_api_initialization,
 )
 import picologging as logging
 
@@ -15,10 +20,10 @@ CONFIG_FILE_PATH = os.path.join("config", "api_config.toml")
 
 
 app = Starlite(
-    route_handlers=[ObjectDetectionController, health_check],
+    route_handlers=[ObjectDetectionController, health_check, readiness_check, metrics],
     on_startup=[
         set_state_on_startup,
-        api_initialization,
+        start_api_initialization,
     ],
     initial_state={"config_file_path": CONFIG_FILE_PATH},
     openapi_config=OpenAPIConfig(title="Object Detection API", version="1.0.0"),
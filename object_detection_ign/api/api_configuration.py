@@ -1,11 +1,29 @@
 import os
 import toml
+import threading
+import time
+import picologging as logging
+from typing import Optional
 from starlite import State
 from requests.exceptions import HTTPError, Timeout, ConnectionError
 from starlite.exceptions import ServiceUnavailableException
 
-from object_detection_ign.detector.inference_helpers import load_inference_model
+from object_detection_ign.api.image_encoding import ImageEncoder
+from object_detection_ign.api.instrumentation import StageMetrics
+from object_detection_ign.detector.annotation import AnnotationRenderer, BoxStyle
+from object_detection_ign.detector.inference_helpers import load_interpreter_pool
+from object_detection_ign.detector.inference_engine import BatchedInferenceEngine
+from object_detection_ign.detector.detection_cache import (
+    DetectionCache,
+    hash_model_file,
+)
 from object_detection_ign.wmts.satellite_view import WMTSClient
+from object_detection_ign.wmts.tile_cache import TileCache
+from object_detection_ign.wmts.tile_sources import open_tile_source
+from object_detection_ign.wmts.geocoding import GeocodingCache
+
+logging.basicConfig()
+logger = logging.getLogger()
 
 
 def set_state_on_startup(state: State) -> None:
@@ -23,14 +41,145 @@ def set_state_on_startup(state: State) -> None:
     state.CORRESPONDANCE_TABLE_FILE: str = os.path.join(
         state.DATA_PATH, config["wmts"]["CORRESPONDANCE_TABLE_FILE"]
     )
+    state.CAPABILITIES_FILE: str = os.path.join(
+        state.DATA_PATH, config["wmts"]["CAPABILITIES_FILE"]
+    )
+    state.CAPABILITIES_REFRESH_SECONDS: float = config["wmts"][
+        "CAPABILITIES_REFRESH_SECONDS"
+    ]
+    state.MAX_CONCURRENT_REQUESTS: int = config["wmts"]["MAX_CONCURRENT_REQUESTS"]
+    state.REQUEST_TIMEOUT: float = config["wmts"]["REQUEST_TIMEOUT"]
+    state.GEOCODING_URL: str = config["wmts"]["GEOCODING_URL"]
+    state.GEOCODING_RATE_LIMIT: float = config["wmts"]["GEOCODING_RATE_LIMIT"]
+    state.PNG_COMPRESS_LEVEL: int = config["image_encoding"]["PNG_COMPRESS_LEVEL"]
+    state.JPEG_QUALITY: int = config["image_encoding"]["JPEG_QUALITY"]
+    state.WEBP_QUALITY: int = config["image_encoding"]["WEBP_QUALITY"]
+    state.WEBP_METHOD: int = config["image_encoding"]["WEBP_METHOD"]
+    state.TILE_SOURCE_PATH: str = config["tile_source"]["PATH"]
+    state.TILE_SOURCE_LAYER: str = config["tile_source"]["LAYER"]
+    state.TILE_SOURCE_MMAP_BYTES: int = config["tile_source"]["MMAP_MB"] * 1024**2
+    state.TILE_CACHE_ENABLED: bool = config["tile_cache"]["ENABLED"]
+    state.TILE_CACHE_DIRECTORY: str = os.path.join(
+        state.DATA_PATH, config["tile_cache"]["DIRECTORY"]
+    )
+    state.TILE_CACHE_MEMORY_CAPACITY: int = config["tile_cache"]["MEMORY_CAPACITY"]
+    state.TILE_CACHE_DISK_BUDGET_BYTES: int = (
+        config["tile_cache"]["DISK_BUDGET_MB"] * 1024**2
+    )
+    state.TILE_CACHE_TTL: float = config["tile_cache"]["TTL_SECONDS"]
+    state.DETECTION_CACHE_ENABLED: bool = config["detection_cache"]["ENABLED"]
+    state.DETECTION_CACHE_MEMORY_BUDGET_BYTES: int = (
+        config["detection_cache"]["MEMORY_BUDGET_MB"] * 1024**2
+    )
+    state.DETECTION_CACHE_FILE: Optional[str] = (
+        os.path.join(state.DATA_PATH, config["detection_cache"]["FILE"])
+        if config["detection_cache"]["PERSISTENT"]
+        else None
+    )
+    state.DETECTION_CACHE_TTL: float = config["detection_cache"]["TTL_SECONDS"]
+    state.DETECTION_CACHE_IMAGES: bool = config["detection_cache"]["CACHE_IMAGES"]
+    state.GEOCODING_CACHE_ENABLED: bool = config["geocoding_cache"]["ENABLED"]
+    state.GEOCODING_CACHE_FILE: Optional[str] = (
+        os.path.join(state.DATA_PATH, config["geocoding_cache"]["FILE"])
+        if config["geocoding_cache"]["PERSISTENT"]
+        else None
+    )
+    state.GEOCODING_CACHE_TTL: float = config["geocoding_cache"]["TTL_SECONDS"]
+    state.GEOCODING_CACHE_NOT_FOUND_TTL: float = config["geocoding_cache"][
+        "NOT_FOUND_TTL_SECONDS"
+    ]
     state.MODEL_PATH: str = config["model"]["MODEL_PATH"]
+    state.INTERPRETER_POOL_SIZE: int = config["model"]["INTERPRETER_POOL_SIZE"]
+    state.NUM_THREADS: int = config["model"]["NUM_THREADS"]
+    state.CPU_FALLBACK_INTERPRETERS: int = config["model"]["CPU_FALLBACK_INTERPRETERS"]
+    state.MAX_BATCH_SIZE: int = config["model"]["MAX_BATCH_SIZE"]
+    state.MAX_BATCH_WAIT_MS: float = config["model"]["MAX_BATCH_WAIT_MS"]
+    state.READINESS_TIMEOUT: float = config["startup"]["READINESS_TIMEOUT_SECONDS"]
+    state.INITIALIZATION_ATTEMPTS: int = config["startup"]["INITIALIZATION_ATTEMPTS"]
+    state.INITIALIZATION_RETRY_SECONDS: float = config["startup"][
+        "INITIALIZATION_RETRY_SECONDS"
+    ]
+    state.INITIALIZATION_MAX_RETRY_SECONDS: float = config["startup"][
+        "INITIALIZATION_MAX_RETRY_SECONDS"
+    ]
+    state.MAX_BATCH_ITEMS: int = config["batch"]["MAX_ITEMS"]
+    state.BATCH_CONCURRENCY: int = config["batch"]["CONCURRENCY"]
     state.CLASSES_DICT: dict = {
         int(key): value for key, value in config["model"]["classes_dict"].items()
     }
+    state.image_encoder = ImageEncoder(
+        png_compress_level=state.PNG_COMPRESS_LEVEL,
+        jpeg_quality=state.JPEG_QUALITY,
+        webp_quality=state.WEBP_QUALITY,
+        webp_method=state.WEBP_METHOD,
+    )
+    default_style = BoxStyle.from_config(config["annotation"])
+    state.annotation_renderer = AnnotationRenderer(
+        styles={
+            label: BoxStyle.from_config(class_config, default=default_style)
+            for label, class_config in config["annotation"].get("classes", {}).items()
+        },
+        default_style=default_style,
+        font_path=config["annotation"]["FONT_PATH"],
+        font_size=config["annotation"]["FONT_SIZE"],
+        vectorize_above=config["annotation"]["VECTORIZE_ABOVE"],
+    )
+    state.stage_metrics = StageMetrics()
+
+
+def create_wmts_client(state: State) -> WMTSClient:
+    """Creates the WMTS client from the parameters of the config file, with its tile and geocoding caches when they are
+    enabled, and its local tile source when there is one.
+
+    Args:
+        state (State): a Starlite State object, set up by `set_state_on_startup`
+
+    Returns:
+        WMTSClient: the WMTS client
+    """
+    tile_cache = (
+        TileCache(
+            state.TILE_CACHE_DIRECTORY,
+            memory_capacity=state.TILE_CACHE_MEMORY_CAPACITY,
+            disk_budget_bytes=state.TILE_CACHE_DISK_BUDGET_BYTES,
+            ttl=state.TILE_CACHE_TTL,
+        )
+        if state.TILE_CACHE_ENABLED
+        else None
+    )
+    geocoding_cache = (
+        GeocodingCache(
+            state.GEOCODING_CACHE_FILE,
+            ttl=state.GEOCODING_CACHE_TTL,
+            not_found_ttl=state.GEOCODING_CACHE_NOT_FOUND_TTL,
+        )
+        if state.GEOCODING_CACHE_ENABLED
+        else None
+    )
+    return WMTSClient(
+        state.WMTS_SERVICE_URL,
+        state.CORRESPONDANCE_TABLE_FILE,
+        state.CORRESPONDANCE_TABLE_URL,
+        max_concurrent_requests=state.MAX_CONCURRENT_REQUESTS,
+        request_timeout=state.REQUEST_TIMEOUT,
+        tile_cache=tile_cache,
+        geocoding_url=state.GEOCODING_URL,
+        geocoding_cache=geocoding_cache,
+        geocoding_rate_limit=state.GEOCODING_RATE_LIMIT,
+        capabilities_path=state.CAPABILITIES_FILE,
+        tile_source=open_tile_source(
+            state.TILE_SOURCE_PATH,
+            layer=state.TILE_SOURCE_LAYER or None,
+            mmap_size=state.TILE_SOURCE_MMAP_BYTES,
+        )
+        if state.TILE_SOURCE_PATH
+        else None,
+    )
 
 
 def api_initialization(state: State):
-    """Initializes the API on startup by loading the inference model and the WMTS client.
+    """Initializes the API on startup by loading the inference model and the WMTS client, then rasterizes the labels
+    drawn on the images.
 
     Args:
         state (State): a Starlite State object
@@ -38,19 +187,46 @@ def api_initialization(state: State):
     Raises:
         ServiceUnavailableException: errors are raised when the WMTS Server is unreachable
     """
-    if not getattr(state, "inference_model", None):
+    if not getattr(state, "interpreter_pool", None):
         (
-            state.inference_model,
+            state.interpreter_pool,
             state.input_img_width,
             state.input_img_height,
-        ) = load_inference_model(state.MODEL_PATH)
-    if not getattr(state, "wmts_server", None):
-        try:
-            state.wmts_client = WMTSClient(
-                state.WMTS_SERVICE_URL,
-                state.CORRESPONDANCE_TABLE_FILE,
-                state.CORRESPONDANCE_TABLE_URL,
+        ) = load_interpreter_pool(
+            state.MODEL_PATH,
+            state.INTERPRETER_POOL_SIZE,
+            state.NUM_THREADS,
+            cpu_fallbacks=state.CPU_FALLBACK_INTERPRETERS,
+        )
+        # Without batching, the route handlers check interpreters out of the pool directly.
+        state.inference_engine = (
+            BatchedInferenceEngine(
+                state.interpreter_pool,
+                max_batch_size=state.MAX_BATCH_SIZE,
+                max_wait_time=state.MAX_BATCH_WAIT_MS / 1000,
+            )
+            if state.MAX_BATCH_SIZE > 1
+            else state.interpreter_pool
+        )
+        # Cached detections are keyed by the hash of the model file, so changing MODEL_PATH invalidates them.
+        state.detection_cache = (
+            DetectionCache(
+                hash_model_file(state.MODEL_PATH),
+                memory_budget_bytes=state.DETECTION_CACHE_MEMORY_BUDGET_BYTES,
+                database_path=state.DETECTION_CACHE_FILE,
+                ttl=state.DETECTION_CACHE_TTL,
+                cache_images=state.DETECTION_CACHE_IMAGES,
             )
+            if state.DETECTION_CACHE_ENABLED
+            else None
+        )
+    if not getattr(state, "wmts_client", None):
+        try:
+            state.wmts_client = create_wmts_client(state)
+            if state.wmts_client.tile_source is None:
+                state.wmts_client.start_capabilities_refresh(
+                    state.CAPABILITIES_REFRESH_SECONDS
+                )
         except HTTPError:
             raise ServiceUnavailableException(
                 detail=f"Error {HTTPError.errno} occured."
@@ -63,3 +239,66 @@ def api_initialization(state: State):
 
         except ConnectionError:
             raise ServiceUnavailableException
+    # The labels are rasterized once the API is ready, the first drawings rasterize the labels they need themselves.
+    state.annotation_renderer.prerender(
+        [label for value, label in state.CLASSES_DICT.items() if value != 0]
+    )
+
+
+def start_api_initialization(state: State) -> threading.Thread:
+    """Runs `api_initialization` in a background thread, so that the API answers health checks while the model and the
+    WMTS client are loading. Until they are loaded, `is_ready` is False, and the error of the last attempt, if any, is
+    kept in `state.initialization_error`. Failed attempts are retried with an exponential backoff, since the WMTS
+    server may only be unreachable for a while. Once INITIALIZATION_ATTEMPTS attempts failed,
+    `state.initialization_failed` is set and the liveness probe fails, so that the process gets restarted.
+
+    Args:
+        state (State): a Starlite State object
+
+    Returns:
+        threading.Thread: the daemon thread initializing the API
+    """
+    state.initialization_error = None
+    state.initialization_failed = False
+
+    def initialize():
+        delay = state.INITIALIZATION_RETRY_SECONDS
+        for attempt in range(1, state.INITIALIZATION_ATTEMPTS + 1):
+            try:
+                api_initialization(state)
+            except Exception as e:
+                state.initialization_error = e
+                if attempt == state.INITIALIZATION_ATTEMPTS:
+                    logger.critical(f"The API could not be initialized: {e!r}")
+                    state.initialization_failed = True
+                    return
+                logger.error(
+                    f"Initialization attempt {attempt} failed: {e!r}, retrying in {delay:g} s."
+                )
+                time.sleep(delay)
+                delay = min(2 * delay, state.INITIALIZATION_MAX_RETRY_SECONDS)
+            else:
+                state.initialization_error = None
+                logger.info("The API is ready.")
+                return
+
+    initialization_thread = threading.Thread(
+        target=initialize, name="api-initialization", daemon=True
+    )
+    initialization_thread.start()
+    return initialization_thread
+
+
+def is_ready(state: State) -> bool:
+    """Checks whether the components used by the inference endpoints are loaded.
+
+    Args:
+        state (State): a Starlite State object
+
+    Returns:
+        bool: True once the inference engine and the WMTS client are loaded
+    """
+    return (
+        getattr(state, "inference_engine", None) is not None
+        and getattr(state, "wmts_client", None) is not None
+    )
@@ -1,7 +1,40 @@
-from pydantic import BaseModel
+from enum import Enum
+from typing import Optional, Union
+from pydantic import BaseModel, confloat, conint, conlist
 
 
-class SatelliteAddress(BaseModel):
+class OutputFormat(str, Enum):
+    """Formats in which the inference endpoints can return their results. The png, jpeg and webp formats return the
+    image with the detections drawn on it, while the json and geojson formats only return the detections, located in GPS
+    coordinates.
+    """
+
+    PNG = "png"
+    JPEG = "jpeg"
+    WEBP = "webp"
+    JSON = "json"
+    GEOJSON = "geojson"
+
+    @property
+    def is_image(self) -> bool:
+        return self in (OutputFormat.PNG, OutputFormat.JPEG, OutputFormat.WEBP)
+
+
+class OutputOptions(BaseModel):
+    """Output options shared by the inference endpoints. The quality, compression level and downscale factor only apply
+    to image formats.
+
+    Args:
+        BaseModel (_type_): a Starlite BaseModel
+    """
+
+    output_format: OutputFormat = OutputFormat.PNG
+    quality: Optional[conint(ge=1, le=100)] = None
+    compression_level: Optional[conint(ge=0, le=9)] = None
+    downscale: confloat(ge=1) = 1.0
+
+
+class SatelliteAddress(OutputOptions):
     """Data model for SatelliteView objects generated through an address input.
 
     Args:
@@ -13,7 +46,7 @@ class SatelliteAddress(BaseModel):
     layer: str = "HR.ORTHOIMAGERY.ORTHOPHOTOS"
 
 
-class SatellitePosition(BaseModel):
+class SatellitePosition(OutputOptions):
     """Data model for SatelliteView objects generated through coordinates input.
 
     Args:
@@ -24,3 +57,14 @@ class SatellitePosition(BaseModel):
     latitude: float
     zoom_level: int = 19
     layer: str = "HR.ORTHOIMAGERY.ORTHOPHOTOS"
+
+
+class BatchRequest(BaseModel):
+    """Data model of batch requests, which hold many SatelliteAddress and SatellitePosition items. Each item keeps its
+    own output options.
+
+    Args:
+        BaseModel (_type_): a Starlite BaseModel
+    """
+
+    items: conlist(Union[SatellitePosition, SatelliteAddress], min_items=1)
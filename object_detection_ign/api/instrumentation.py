@@ -0,0 +1,332 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Union
+
+# Upper bounds in seconds of the latency histogram buckets, from cache hits to slow WMTS downloads.
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Histogram:
+    """A latency histogram with fixed buckets, in the format of Prometheus histograms. An observation only costs a
+    binary search and a locked increment, so histograms can stay enabled in production.
+
+    Args:
+        buckets (tuple, optional): sorted upper bounds of the buckets, in seconds. Defaults to LATENCY_BUCKETS.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets: tuple = tuple(buckets)
+        self._counts: list[int] = [0] * (len(self.buckets) + 1)
+        self._sum: float = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> tuple[list, int, float]:
+        """Cumulative counts of the histogram.
+
+        Returns:
+            tuple: the (upper bound, cumulative count) of each bucket including +Inf, the total count and the sum
+        """
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, bucket_counts = 0, []
+        for upper_bound, count in zip([*self.buckets, float("inf")], counts):
+            cumulative += count
+            bucket_counts.append((upper_bound, cumulative))
+        return bucket_counts, cumulative, total
+
+
+class StageMetrics:
+    """Latency histograms of the stages of the inference pipeline (geocoding, tile fetch, inference, drawing,
+    encoding...), keyed by stage name. Histograms are created on the first observation of their stage.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets: tuple = buckets
+        self.histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, duration: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, Histogram(self.buckets))
+        histogram.observe(duration)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        """Measures the wall-clock duration of a block of code, awaits included, as a stage of the pipeline.
+
+        Args:
+            stage (str): name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    formatted_labels = ",".join(
+        f'{name}="{_escape_label_value(str(value))}"' for name, value in labels.items()
+    )
+    return f"{{{formatted_labels}}}"
+
+
+def _format_value(value: Union[int, float]) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class PrometheusExposition:
+    """Writes metrics in the Prometheus text exposition format (version 0.0.4)."""
+
+    def __init__(self):
+        self._lines: list[str] = []
+
+    def add(
+        self,
+        name: str,
+        metric_type: str,
+        help_text: str,
+        samples: list,
+    ):
+        """Adds a metric family, skipped when it has no sample.
+
+        Args:
+            name (str): name of the metric
+            metric_type (str): "counter" or "gauge"
+            help_text (str): description of the metric
+            samples (list): (labels dict, value) pairs
+        """
+        if not samples:
+            return
+        self._lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        self._lines += [
+            f"{name}{_format_labels(labels)} {_format_value(value)}"
+            for labels, value in samples
+        ]
+
+    def add_histograms(
+        self, name: str, help_text: str, histograms: dict, label_name: str
+    ):
+        """Adds a histogram family.
+
+        Args:
+            name (str): name of the metric
+            help_text (str): description of the metric
+            histograms (dict): Histograms keyed by the value of their label
+            label_name (str): name of the label telling the histograms apart
+        """
+        if not histograms:
+            return
+        self._lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for label_value, histogram in sorted(histograms.items()):
+            bucket_counts, count, total = histogram.snapshot()
+            self._lines += [
+                f"{name}_bucket{_format_labels({label_name: label_value, 'le': _format_value(upper_bound)})} {cumulative}"
+                for upper_bound, cumulative in bucket_counts
+            ]
+            labels = _format_labels({label_name: label_value})
+            self._lines += [
+                f"{name}_sum{labels} {_format_value(float(total))}",
+                f"{name}_count{labels} {count}",
+            ]
+
+    def render(self) -> str:
+        return "\n".join(self._lines) + "\n"
+
+
+def render_metrics(
+    stage_metrics: StageMetrics,
+    interpreter_pool=None,
+    inference_engine=None,
+    image_encoder=None,
+    wmts_client=None,
+    detection_cache=None,
+) -> str:
+    """Collects the metrics of the API components which are loaded, in the Prometheus text exposition format.
+
+    Args:
+        stage_metrics (StageMetrics): latency histograms of the pipeline stages
+        interpreter_pool (InterpreterPool, optional): the interpreter pool, or DeviceScheduler. Defaults to None.
+        inference_engine (BatchedInferenceEngine, optional): the batching engine, if batching is on. Defaults to None.
+        image_encoder (ImageEncoder, optional): the encoder of image responses. Defaults to None.
+        wmts_client (WMTSClient, optional): the WMTS client, with its error counters and caches. Defaults to None.
+        detection_cache (DetectionCache, optional): the detection cache, if it is enabled. Defaults to None.
+
+    Returns:
+        str: the metrics, one sample per line
+    """
+    exposition = PrometheusExposition()
+    exposition.add_histograms(
+        "object_detection_stage_duration_seconds",
+        "Duration of each stage of the inference pipeline.",
+        stage_metrics.histograms,
+        "stage",
+    )
+    if wmts_client is not None:
+        exposition.add(
+            "object_detection_upstream_errors_total",
+            "counter",
+            "Failed requests to the WMTS and Nominatim servers.",
+            [
+                ({"service": service}, count)
+                for service, count in wmts_client.errors.items()
+            ],
+        )
+    if interpreter_pool is not None:
+        pool_metrics = interpreter_pool.metrics
+        for name, metric_type, help_text, value in (
+            ("size", "gauge", "Number of interpreters.", pool_metrics["size"]),
+            ("in_use", "gauge", "Interpreters checked out.", pool_metrics["in_use"]),
+            (
+                "queue_depth",
+                "gauge",
+                "Callers waiting for an interpreter.",
+                pool_metrics["queue_depth"],
+            ),
+            (
+                "checkouts_total",
+                "counter",
+                "Interpreter checkouts.",
+                pool_metrics["checkouts"],
+            ),
+            (
+                "p99_wait_seconds",
+                "gauge",
+                "p99 waiting time of the most recent checkouts.",
+                pool_metrics["p99_wait_time"],
+            ),
+        ):
+            exposition.add(
+                f"object_detection_interpreter_pool_{name}",
+                metric_type,
+                help_text,
+                [({}, value)],
+            )
+        devices = pool_metrics.get("devices", {})
+        for name, metric_type, help_text, key in (
+            ("assigned", "gauge", "Requests assigned to each device.", "assigned"),
+            ("checkouts_total", "counter", "Checkouts of each device.", "checkouts"),
+            (
+                "mean_latency_seconds",
+                "gauge",
+                "Mean latency of the most recent checkouts of each device.",
+                "mean_latency",
+            ),
+        ):
+            exposition.add(
+                f"object_detection_device_{name}",
+                metric_type,
+                help_text,
+                [
+                    ({"device": device}, values[key])
+                    for device, values in devices.items()
+                ],
+            )
+    if inference_engine is not None and hasattr(inference_engine, "queue_depth"):
+        exposition.add(
+            "object_detection_inference_queue_depth",
+            "gauge",
+            "Images queued for batched inference.",
+            [({}, inference_engine.queue_depth)],
+        )
+    if image_encoder is not None:
+        encoding_metrics = image_encoder.metrics
+        for name, help_text, key in (
+            ("images_total", "Images encoded per format.", "images"),
+            ("bytes_total", "Bytes encoded per format.", "bytes"),
+            ("seconds_total", "Time spent encoding per format.", "encode_time"),
+        ):
+            exposition.add(
+                f"object_detection_encoded_{name}",
+                "counter",
+                help_text,
+                [
+                    ({"format": image_format}, values[key])
+                    for image_format, values in encoding_metrics.items()
+                ],
+            )
+    cache_lookups, cache_entries, cache_bytes = [], [], []
+    tile_cache = getattr(wmts_client, "tile_cache", None)
+    if tile_cache is not None:
+        tile_stats = tile_cache.stats
+        cache_lookups += [
+            ({"cache": "tile", "result": result}, tile_stats[key])
+            for result, key in (
+                ("memory_hit", "memory_hits"),
+                ("disk_hit", "disk_hits"),
+                ("miss", "misses"),
+            )
+        ]
+        cache_entries.append(({"cache": "tile"}, tile_stats["memory_tiles"]))
+    geocoding_cache = getattr(wmts_client, "geocoding_cache", None)
+    if geocoding_cache is not None:
+        geocoding_stats = geocoding_cache.stats
+        cache_lookups += [
+            ({"cache": "geocoding", "result": "hit"}, geocoding_stats["hits"]),
+            ({"cache": "geocoding", "result": "miss"}, geocoding_stats["misses"]),
+        ]
+        cache_entries.append(
+            ({"cache": "geocoding"}, geocoding_stats["memory_entries"])
+        )
+    if detection_cache is not None:
+        detection_stats = detection_cache.stats
+        cache_lookups += [
+            ({"cache": "detection", "result": "hit"}, detection_stats["hits"]),
+            ({"cache": "detection", "result": "miss"}, detection_stats["misses"]),
+        ]
+        cache_entries.append(
+            ({"cache": "detection"}, detection_stats["memory_entries"])
+        )
+        cache_bytes.append(({"cache": "detection"}, detection_stats["memory_bytes"]))
+    exposition.add(
+        "object_detection_cache_lookups_total",
+        "counter",
+        "Cache lookups, by cache and result.",
+        cache_lookups,
+    )
+    exposition.add(
+        "object_detection_cache_memory_entries",
+        "gauge",
+        "Entries held in the memory tier of each cache.",
+        cache_entries,
+    )
+    exposition.add(
+        "object_detection_cache_memory_bytes",
+        "gauge",
+        "Bytes held in the memory tier of each cache.",
+        cache_bytes,
+    )
+    return exposition.render()
@@ -1,16 +1,394 @@
-import io
+import json
+import time
+import anyio
+import base64
+import asyncio
+import httpx
+import requests
+import numpy as np
+from PIL import Image
 import picologging as logging
-from starlite import post, get, MediaType, State
+from typing import AsyncIterator, Optional, Union
+from starlite import post, get, MediaType, Response, State, Stream
 
+from starlite.connection import ASGIConnection
 from starlite.controller import Controller
-from starlite.exceptions import ValidationException
+from starlite.exceptions import ServiceUnavailableException, ValidationException
+from starlite.handlers import BaseRouteHandler
 from object_detection_ign.wmts.satellite_view import SatelliteView
-from object_detection_ign.api.data_objects import SatelliteAddress, SatellitePosition
-from object_detection_ign.detector.inference_helpers import perform_inference
+from object_detection_ign.wmts.tile_sources import TileNotFoundError
+from starlite.status_codes import (
+    HTTP_200_OK,
+    HTTP_201_CREATED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_502_BAD_GATEWAY,
+)
+from object_detection_ign.api.data_objects import (
+    BatchRequest,
+    OutputFormat,
+    OutputOptions,
+    SatelliteAddress,
+    SatellitePosition,
+)
+from object_detection_ign.api.api_configuration import is_ready
+from object_detection_ign.api.image_encoding import MEDIA_TYPES
+from object_detection_ign.api.instrumentation import render_metrics
+from object_detection_ign.api.serialization import (
+    detections_to_geojson,
+    detections_to_json,
+)
+from object_detection_ign.detector.detection_cache import (
+    DetectionCache,
+    DetectionKey,
+    Detections,
+)
+from object_detection_ign.detector.inference_helpers import (
+    filter_predictions,
+    run_detector,
+)
+from object_detection_ign.wmts.tile_loader import SharedTileLoader
 
 logging.basicConfig()
 logger = logging.getLogger()
 
+DETECTION_THRESHOLD = 0.1
+ADDRESS_NOT_FOUND = "The requested address was not found in OpenStreetMap, try to change it slightly or use the coordinates endpoint."
+LOCATION_NOT_FOUND = "The requested location was not found, check that the latitude and longitude are correct, or that the position is located in France."
+TILE_NOT_FOUND = "The requested area or layer is not covered by the local tile source."
+
+
+def _detection_key(satellite_view: SatelliteView, layer: str) -> DetectionKey:
+    return (
+        layer,
+        satellite_view.zoom_level,
+        satellite_view.pixel_window,
+        DETECTION_THRESHOLD,
+    )
+
+
+def _image_encoding(options: OutputOptions) -> str:
+    """Describes the encoding options of an image, to tell the cached images of the same detections apart."""
+    return f"{options.output_format.value}/{options.quality}/{options.compression_level}/{options.downscale}"
+
+
+def _cached_result(
+    detection_cache: DetectionCache, key: DetectionKey, options: OutputOptions
+) -> tuple[Optional[Detections], Optional[bytes]]:
+    """Looks the detections up, with the encoded image when the response is an image. As the lookup may read the
+    SQLite database, it runs in a worker thread rather than in the event loop.
+    """
+    detections = detection_cache.get_detections(key)
+    if detections is None or not options.output_format.is_image:
+        return detections, None
+    return detections, detection_cache.get_image(key, _image_encoding(options))
+
+
+def _image_response(
+    content: bytes, options: OutputOptions, headers: Optional[dict] = None
+) -> Response:
+    return Response(
+        content=content,
+        media_type=MEDIA_TYPES[options.output_format.value],
+        status_code=HTTP_201_CREATED,
+        headers=headers,
+    )
+
+
+def _detections_response(
+    satellite_view: SatelliteView,
+    state: State,
+    layer: str,
+    options: OutputOptions,
+    detections: Detections,
+) -> Response:
+    """Serializes the detections as json or geojson, located in GPS coordinates."""
+    scores, labels, bounding_boxes = detections
+    with state.stage_metrics.time("serialization"):
+        coordinates = satellite_view.boxes_to_coordinates(
+            bounding_boxes, state.wmts_client.matrix_index
+        )
+        if options.output_format == OutputFormat.GEOJSON:
+            return Response(
+                content=detections_to_geojson(scores, labels, coordinates),
+                media_type="application/geo+json",
+                status_code=HTTP_201_CREATED,
+            )
+        return Response(
+            content=detections_to_json(
+                satellite_view, layer, scores, labels, coordinates
+            ),
+            media_type=MediaType.JSON,
+            status_code=HTTP_201_CREATED,
+        )
+
+
+def _detect_and_encode(
+    satellite_view: SatelliteView,
+    state: State,
+    layer: str,
+    options: OutputOptions,
+    detections: Optional[Detections] = None,
+) -> Response:
+    """Runs the CPU-bound part of the pipeline: inference, then either drawing and image encoding, or serialization of
+    the detections. It is meant to be executed in a worker thread, so that the event loop keeps serving other requests
+    meanwhile. The results are stored in the detection cache, if there is one. The inference stage covers the wait
+    for an interpreter, and includes the assembly stage, in which the tiles are written into the model input tensor.
+
+    Args:
+        satellite_view (SatelliteView): a SatelliteView whose image has been fetched, with the model input size
+        state (State): a Starlite State object, used to load various parameters (e.g. model filepath location)
+        layer (str): name of the layer containing the images in the WMTS server
+        options (OutputOptions): the format of the response, and the encoding options of images
+        detections (Detections, optional): cached detections of the image, which skip inference. Defaults to None.
+
+    Returns:
+        Response: the inference image with bounding boxes encoded as a png, jpeg or webp, or the detections as json or
+        geojson. Image responses report their encode time in a Server-Timing header.
+    """
+    detection_cache: Optional[DetectionCache] = getattr(state, "detection_cache", None)
+    stage_metrics = state.stage_metrics
+    if detections is None:
+
+        def write_image(destination):
+            with stage_metrics.time("assembly"):
+                satellite_view.write_image(destination)
+
+        with stage_metrics.time("inference"):
+            detections = filter_predictions(
+                run_detector(state.inference_engine, write_image),
+                state.CLASSES_DICT,
+                detection_threshold=DETECTION_THRESHOLD,
+            )
+        logger.info("Inference performed.")
+        if detection_cache:
+            detection_cache.put_detections(
+                _detection_key(satellite_view, layer), detections
+            )
+
+    if not options.output_format.is_image:
+        return _detections_response(satellite_view, state, layer, options, detections)
+
+    scores, labels, bounding_boxes = detections
+    with stage_metrics.time("drawing"):
+        # The tiles are written into the array the boxes are drawn on, the view never assembles its own image.
+        width, height = satellite_view.size
+        image_array = np.empty((height, width, 3), dtype="uint8")
+        satellite_view.write_image(image_array)
+        state.annotation_renderer.draw(image_array, bounding_boxes, scores, labels)
+        image = Image.fromarray(image_array)
+    start = time.perf_counter()
+    content = state.image_encoder.encode(
+        image,
+        options.output_format.value,
+        quality=options.quality,
+        compression_level=options.compression_level,
+        downscale=options.downscale,
+    )
+    encode_time = time.perf_counter() - start
+    stage_metrics.observe("encoding", encode_time)
+    if detection_cache:
+        detection_cache.put_image(
+            _detection_key(satellite_view, layer), _image_encoding(options), content
+        )
+    return _image_response(
+        content,
+        options,
+        headers={"Server-Timing": f"encode;dur={encode_time * 1000:.1f}"},
+    )
+
+
+async def _locate(
+    data: Union[SatelliteAddress, SatellitePosition], state: State
+) -> SatelliteView:
+    """Locates the model input window of a request on the tile grid, without fetching its tiles."""
+    if isinstance(data, SatelliteAddress):
+        # Without fetching the tiles, creating the view is mostly the call to the geocoding service.
+        with state.stage_metrics.time("geocoding"):
+            satellite_view = (
+                await state.wmts_client.async_create_satellite_view_from_address(
+                    data.address,
+                    data.layer,
+                    data.zoom_level,
+                    window_width=state.input_img_width,
+                    window_height=state.input_img_height,
+                    fetch_tiles=False,
+                )
+            )
+        logger.info(f"Found coordinates ?: {satellite_view.found_coordinates}")
+        return satellite_view
+    return await state.wmts_client.async_create_satellite_view_from_location(
+        data.latitude,
+        data.longitude,
+        data.layer,
+        data.zoom_level,
+        window_width=state.input_img_width,
+        window_height=state.input_img_height,
+        fetch_tiles=False,
+    )
+
+
+async def _respond(
+    satellite_view: SatelliteView,
+    state: State,
+    layer: str,
+    options: OutputOptions,
+    tile_loader: Optional[SharedTileLoader] = None,
+) -> Response:
+    """Answers a request from the detection cache when possible. Otherwise, the tiles of the located SatelliteView are
+    fetched, and the pipeline runs in a worker thread, reusing the cached detections when only the image is missing.
+
+    Args:
+        satellite_view (SatelliteView): a SatelliteView located on the tile grid, whose tiles have not been fetched
+        state (State): a Starlite State object
+        layer (str): name of the layer containing the images in the WMTS server
+        options (OutputOptions): the format of the response, and the encoding options of images
+        tile_loader (SharedTileLoader, optional): a loader sharing the tiles between the items of a batch. Defaults to
+            None (the tiles are loaded by the WMTS client).
+
+    Raises:
+        ValidationException: an error is raised when the local tile source does not hold the tiles of the view
+
+    Returns:
+        Response: the response of the inference endpoints
+    """
+    detection_cache: Optional[DetectionCache] = getattr(state, "detection_cache", None)
+    detections, content = None, None
+    if detection_cache:
+        with state.stage_metrics.time("cache_lookup"):
+            detections, content = await anyio.to_thread.run_sync(
+                _cached_result,
+                detection_cache,
+                _detection_key(satellite_view, layer),
+                options,
+            )
+        if detections is not None and not options.output_format.is_image:
+            return _detections_response(
+                satellite_view, state, layer, options, detections
+            )
+        if content is not None:
+            return _image_response(content, options)
+    with state.stage_metrics.time("tile_fetch"):
+        try:
+            if tile_loader is not None:
+                await tile_loader.load_tiles(satellite_view, layer)
+            else:
+                await state.wmts_client.async_load_tiles(satellite_view, layer)
+        except TileNotFoundError:
+            raise ValidationException(detail=TILE_NOT_FOUND)
+    return await anyio.to_thread.run_sync(
+        _detect_and_encode, satellite_view, state, layer, options, detections
+    )
+
+
+async def _batch_item_result(
+    index: int,
+    data: Union[SatelliteAddress, SatellitePosition],
+    state: State,
+    tile_loader: SharedTileLoader,
+) -> dict:
+    """Runs the pipeline on an item of a batch. Errors are reported in the result of the item, so that they do not
+    interrupt the other items.
+
+    Args:
+        index (int): position of the item in the batch
+        data (SatelliteAddress|SatellitePosition): the item
+        state (State): a Starlite State object
+        tile_loader (SharedTileLoader): the loader sharing the tiles between the items of the batch
+
+    Returns:
+        dict: the index and status code of the item, then either its media type and content (the detections for json and
+        geojson, the base64 encoded image for image formats), or the detail of its error
+    """
+    try:
+        satellite_view = await _locate(data, state)
+        if not satellite_view.found_coordinates:
+            detail = (
+                ADDRESS_NOT_FOUND
+                if isinstance(data, SatelliteAddress)
+                else LOCATION_NOT_FOUND
+            )
+            return {
+                "index": index,
+                "status_code": HTTP_400_BAD_REQUEST,
+                "detail": detail,
+            }
+        response = await _respond(
+            satellite_view, state, data.layer, data, tile_loader=tile_loader
+        )
+    except ValidationException as e:
+        return {
+            "index": index,
+            "status_code": HTTP_400_BAD_REQUEST,
+            "detail": e.detail,
+        }
+    except (httpx.HTTPError, requests.RequestException) as e:
+        logger.error(f"Batch item {index} failed: {e!r}")
+        return {
+            "index": index,
+            "status_code": HTTP_502_BAD_GATEWAY,
+            "detail": "The WMTS or geocoding server did not answer.",
+        }
+    except Exception as e:
+        logger.exception(f"Batch item {index} failed.")
+        return {
+            "index": index,
+            "status_code": HTTP_500_INTERNAL_SERVER_ERROR,
+            "detail": repr(e),
+        }
+    content = (
+        base64.b64encode(response.body).decode("ascii")
+        if data.output_format.is_image
+        else json.loads(response.body)
+    )
+    return {
+        "index": index,
+        "status_code": response.status_code,
+        "media_type": response.media_type,
+        "content": content,
+    }
+
+
+async def _stream_batch_results(items: list, state: State) -> AsyncIterator[bytes]:
+    """Processes the items of a batch, at most BATCH_CONCURRENCY at a time, and yields their results as NDJSON lines
+    in the order they finish. The items left are cancelled if the client disconnects."""
+    tile_loader = SharedTileLoader(state.wmts_client)
+    semaphore = asyncio.Semaphore(state.BATCH_CONCURRENCY)
+
+    async def process(index: int, data: Union[SatelliteAddress, SatellitePosition]):
+        async with semaphore:
+            return await _batch_item_result(index, data, state, tile_loader)
+
+    tasks = [
+        asyncio.ensure_future(process(index, data)) for index, data in enumerate(items)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield (json.dumps(await task) + "\n").encode()
+    finally:
+        for task in tasks:
+            task.cancel()
+        tile_loader.close()
+        logger.info(
+            f"Batch of {len(items)} items: {tile_loader.downloads} tiles loaded, {tile_loader.shared} shared."
+        )
+
+
+async def _require_ready(connection: ASGIConnection, _: BaseRouteHandler) -> None:
+    """Guard holding the requests received while the API components are loading, for at most READINESS_TIMEOUT
+    seconds, then answering 503 if they are still not loaded. Failed initialization attempts are retried meanwhile,
+    so the requests only fail early once the initialization was given up."""
+    state = connection.app.state
+    deadline = time.perf_counter() + state.READINESS_TIMEOUT
+    while not is_ready(state):
+        if time.perf_counter() >= deadline or getattr(
+            state, "initialization_failed", False
+        ):
+            raise ServiceUnavailableException(
+                detail="The API is starting, retry in a few seconds."
+            )
+        await anyio.sleep(0.05)
+
 
 class ObjectDetectionController(Controller):
     """Inherits from the Controller class. This object is used to define the routes belonging to the "inference" branch.
@@ -21,9 +399,12 @@ class ObjectDetectionController(Controller):
     """
 
     path = "/inference"
+    guards = [_require_ready]
 
-    @post("/address", media_type="image/png")
-    def detect_objects_address(self, data: SatelliteAddress, state: State) -> bytearray:
+    @post("/address")
+    async def detect_objects_address(
+        self, data: SatelliteAddress, state: State
+    ) -> Response:
         """Performs object detection on a location specified by an address. A SatelliteView object is created through a call to
         the OpenStreetMaps reverse geocoding API in order to obtain its coordinates. If the address is incorrect, an error is raised.
 
@@ -35,44 +416,20 @@ class ObjectDetectionController(Controller):
             ValidationException: an error is raised when the address is not found on the OpenStreetMaps reverse geocoding API
 
         Returns:
-            bytearray: raw array containing the inference image with bounding boxes encoded as a png
+            Response: the inference image with bounding boxes encoded as a png, or the detections as json or geojson
+            depending on the requested output format
         """
-
-        satellite_view: SatelliteView = (
-            state.wmts_client.create_satellite_view_from_address(
-                data.address, data.layer, data.zoom_level
-            )
-        )
-        logger.info("Found coordinates ?: ", satellite_view.found_coordinates)
+        satellite_view = await _locate(data, state)
         if satellite_view.found_coordinates:
-            satellite_view.crop_image_center(
-                state.input_img_width, state.input_img_height
-            )
-            scores, labels, bounding_boxes = perform_inference(
-                state.inference_model,
-                satellite_view,
-                state.CLASSES_DICT,
-                detection_threshold=0.1,
-            )
-
-            logger.info("Inference performed.")
-
-            img_byte_arr = io.BytesIO()
-            satellite_view.image.save(img_byte_arr, format="PNG")
-            img_byte_arr = img_byte_arr.getvalue()
-            return img_byte_arr
+            return await _respond(satellite_view, state, data.layer, data)
         else:
-            logger.critical(
-                "The requested address was not found, try to change it slightly or use the coordinates endpoint."
-            )
-            raise ValidationException(
-                detail="The requested address was not found in OpenStreetMap, try to change it slightly or use the coordinates endpoint."
-            )
+            logger.critical(ADDRESS_NOT_FOUND)
+            raise ValidationException(detail=ADDRESS_NOT_FOUND)
 
-    @post("/location", media_type="image/png")
-    def detect_objects_location(
+    @post("/location")
+    async def detect_objects_location(
         self, data: SatellitePosition, state: State
-    ) -> bytearray:
+    ) -> Response:
         """Performs object detection on GPS coordinates (latitude and longitude).
 
         Args:
@@ -84,40 +441,101 @@ class ObjectDetectionController(Controller):
             is not in France)
 
         Returns:
-            bytearray: raw array containing the inference image with bounding boxes encoded as a png
+            Response: the inference image with bounding boxes encoded as a png, or the detections as json or geojson
+            depending on the requested output format
         """
-        satellite_view: SatelliteView = (
-            state.wmts_client.create_satellite_view_from_location(
-                data.latitude, data.longitude, data.layer, data.zoom_level
-            )
-        )
-
+        satellite_view = await _locate(data, state)
         if satellite_view.found_coordinates:
-            satellite_view.crop_image_center(
-                state.input_img_width, state.input_img_height
-            )
-            scores, labels, bounding_boxes = perform_inference(
-                state.inference_model,
-                satellite_view,
-                state.CLASSES_DICT,
-                detection_threshold=0.1,
-            )
+            return await _respond(satellite_view, state, data.layer, data)
+        else:
+            logger.critical(LOCATION_NOT_FOUND)
+            raise ValidationException(detail=LOCATION_NOT_FOUND)
 
-            logger.info("Inference performed.")
+    @post("/batch", media_type="application/x-ndjson", status_code=HTTP_200_OK)
+    async def detect_objects_batch(self, data: BatchRequest, state: State) -> Stream:
+        """Performs object detection on many addresses and GPS coordinates in a single request. The items are processed
+        concurrently: tiles shared by several items are downloaded once, and the images of concurrent items are batched
+        by the inference engine. Results are streamed back as NDJSON, one line per item in the order they finish, each
+        line holding the index of its item.
 
-            img_byte_arr = io.BytesIO()
-            satellite_view.image.save(img_byte_arr, format="PNG")
-            img_byte_arr = img_byte_arr.getvalue()
-            return img_byte_arr
-        else:
-            logger.critical(
-                "The requested location was not found, check that the latitude and longitude are correct, or that the position is located in France."
-            )
+        Args:
+            data (BatchRequest): a BatchRequest pydantic data object
+            state (State): a Starlite State object
+
+        Raises:
+            ValidationException: an error is raised when the batch holds more than MAX_BATCH_ITEMS items
+
+        Returns:
+            Stream: an NDJSON stream of the results of the items, see `_batch_item_result`
+        """
+        if len(data.items) > state.MAX_BATCH_ITEMS:
             raise ValidationException(
-                detail="The requested location was not found, check that the latitude and longitude are correct, or that the position is located in France."
+                detail=f"A batch holds at most {state.MAX_BATCH_ITEMS} items."
             )
+        return Stream(iterator=_stream_batch_results(data.items, state))
 
 
 @get(path="/health", media_type=MediaType.TEXT)
-def health_check() -> str:
+def health_check(state: State) -> str:
+    """Liveness probe, which answers as soon as the process serves requests, even while the model is loading, and fails
+    once the initialization of the API was given up.
+
+    Args:
+        state (State): a Starlite State object
+
+    Raises:
+        ServiceUnavailableException: an error is raised when every initialization attempt failed
+
+    Returns:
+        str: "healthy"
+    """
+    if getattr(state, "initialization_failed", False):
+        raise ServiceUnavailableException(
+            detail=f"The API could not be initialized: {state.initialization_error!r}"
+        )
     return "healthy"
+
+
+@get(path="/ready", media_type=MediaType.TEXT)
+def readiness_check(state: State) -> str:
+    """Readiness probe, which answers once the model and the WMTS client are loaded.
+
+    Args:
+        state (State): a Starlite State object
+
+    Raises:
+        ServiceUnavailableException: an error is raised while the API is starting, or when its initialization failed
+
+    Returns:
+        str: "ready"
+    """
+    if is_ready(state):
+        return "ready"
+    initialization_error = getattr(state, "initialization_error", None)
+    if initialization_error is not None:
+        raise ServiceUnavailableException(
+            detail=f"The API could not be initialized: {initialization_error!r}"
+        )
+    raise ServiceUnavailableException(detail="The API is starting.")
+
+
+@get(path="/metrics", media_type="text/plain; version=0.0.4; charset=utf-8")
+def metrics(state: State) -> str:
+    """Exposes runtime metrics of the API in the Prometheus text format: latency histograms of each stage of the
+    pipeline, gauges of the interpreter pool and inference queue, cache hits and misses, encoding statistics and
+    errors of the WMTS and Nominatim servers.
+
+    Args:
+        state (State): a Starlite State object
+
+    Returns:
+        str: the metrics of the components which are loaded
+    """
+    return render_metrics(
+        state.stage_metrics,
+        interpreter_pool=getattr(state, "interpreter_pool", None),
+        inference_engine=getattr(state, "inference_engine", None),
+        image_encoder=state.image_encoder,
+        wmts_client=getattr(state, "wmts_client", None),
+        detection_cache=getattr(state, "detection_cache", None),
+    )
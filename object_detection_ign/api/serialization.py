@@ -0,0 +1,71 @@
+import numpy as np
+from object_detection_ign.wmts.satellite_view import SatelliteView
+
+
+def detections_to_json(
+    satellite_view: SatelliteView,
+    layer: str,
+    scores: np.array,
+    labels: list,
+    coordinates: np.array,
+) -> dict:
+    """Serializes detections located in GPS coordinates as a plain JSON document.
+
+    Args:
+        satellite_view (SatelliteView): the SatelliteView the detections were made on
+        layer (str): name of the layer containing the images in the WMTS server
+        scores (np.array): scores of the detections
+        labels (list): labels of the detections
+        coordinates (np.array): a [N, 4] array of (min_longitude, min_latitude, max_longitude, max_latitude) boxes
+
+    Returns:
+        dict: the detections and the location they were made on
+    """
+    return {
+        "latitude": float(satellite_view.latitude),
+        "longitude": float(satellite_view.longitude),
+        "zoom_level": satellite_view.zoom_level,
+        "layer": layer,
+        "detections": [
+            {
+                "label": label,
+                "score": float(score),
+                "bounding_box": [float(value) for value in box],
+            }
+            for score, label, box in zip(scores, labels, coordinates)
+        ],
+    }
+
+
+def detections_to_geojson(
+    scores: np.array, labels: list, coordinates: np.array
+) -> dict:
+    """Serializes detections located in GPS coordinates as a GeoJSON FeatureCollection of box polygons.
+
+    Args:
+        scores (np.array): scores of the detections
+        labels (list): labels of the detections
+        coordinates (np.array): a [N, 4] array of (min_longitude, min_latitude, max_longitude, max_latitude) boxes
+
+    Returns:
+        dict: a GeoJSON FeatureCollection
+    """
+    features = []
+    for score, label, (min_longitude, min_latitude, max_longitude, max_latitude) in zip(
+        scores, labels, np.asarray(coordinates, dtype=float).tolist()
+    ):
+        ring = [
+            [min_longitude, min_latitude],
+            [max_longitude, min_latitude],
+            [max_longitude, max_latitude],
+            [min_longitude, max_latitude],
+            [min_longitude, min_latitude],
+        ]
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [ring]},
+                "properties": {"label": label, "score": float(score)},
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
@@ -0,0 +1,256 @@
+import os
+import threading
+import numpy as np
+import picologging as logging
+from typing import Optional, Union
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+DEFAULT_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+Color = Union[str, tuple[int, int, int]]
+
+
+def _to_rgb(color: Color) -> tuple[int, int, int]:
+    return ImageColor.getrgb(color)[:3] if isinstance(color, str) else tuple(color)[:3]
+
+
+class BoxStyle:
+    """Style of the boxes drawn for a class. Colors are PIL color names or (red, green, blue) sequences.
+
+    Args:
+        outline_color (Color, optional): color of the box outline. Defaults to "orange".
+        outline_width (int, optional): width of the box outline in pixels. Defaults to 2.
+        label_color (Color, optional): background color of the label. Defaults to "red".
+        text_color (Color, optional): color of the label text. Defaults to "black".
+    """
+
+    def __init__(
+        self,
+        outline_color: Color = "orange",
+        outline_width: int = 2,
+        label_color: Color = "red",
+        text_color: Color = "black",
+    ):
+        self.outline_color: tuple[int, int, int] = _to_rgb(outline_color)
+        self.outline_width: int = outline_width
+        self.label_color: tuple[int, int, int] = _to_rgb(label_color)
+        self.text_color: tuple[int, int, int] = _to_rgb(text_color)
+
+    @classmethod
+    def from_config(cls, config: dict, default: Optional["BoxStyle"] = None):
+        """Builds a style from a section of the config file, whose missing keys are taken from a default style.
+
+        Args:
+            config (dict): OUTLINE_COLOR, OUTLINE_WIDTH, LABEL_COLOR and TEXT_COLOR, all optional
+            default (BoxStyle, optional): the style completing the missing keys. Defaults to None (BoxStyle()).
+
+        Returns:
+            BoxStyle: the style
+        """
+        default = default or cls()
+        return cls(
+            outline_color=config.get("OUTLINE_COLOR", default.outline_color),
+            outline_width=config.get("OUTLINE_WIDTH", default.outline_width),
+            label_color=config.get("LABEL_COLOR", default.label_color),
+            text_color=config.get("TEXT_COLOR", default.text_color),
+        )
+
+
+class AnnotationRenderer:
+    """Draws detections on images: the box outlines, and a label with the class and score above each box (below it when
+    there is no room above). The font is loaded once, and each label is rasterized once per class and score, then
+    copied into the image. Everything is drawn into a single uint8 array in one pass, without ImageDraw.
+
+    Outlines are drawn box by box with array slices. Above `vectorize_above` boxes, the outlines of each style are
+    instead drawn at once with NumPy, which avoids a Python iteration per box.
+
+    Args:
+        styles (dict, optional): BoxStyles keyed by label. Defaults to None (every class uses the default style).
+        default_style (BoxStyle, optional): style of the classes without a style. Defaults to None (BoxStyle()).
+        font_path (str, optional): path of a TrueType font. Defaults to DEFAULT_FONT_PATH, or the PIL default font
+            when it does not exist.
+        font_size (int, optional): size of the label text. Defaults to 15.
+        vectorize_above (int, optional): number of boxes from which outlines are drawn at once. Defaults to 32, None
+            never draws them at once.
+    """
+
+    def __init__(
+        self,
+        styles: Optional[dict] = None,
+        default_style: Optional[BoxStyle] = None,
+        font_path: str = DEFAULT_FONT_PATH,
+        font_size: int = 15,
+        vectorize_above: Optional[int] = 32,
+    ):
+        self.styles: dict[str, BoxStyle] = styles or {}
+        self.default_style: BoxStyle = default_style or BoxStyle()
+        self.vectorize_above: Optional[int] = vectorize_above
+        if os.path.exists(font_path):
+            self.font = ImageFont.truetype(font_path, font_size)
+        else:
+            logger.warning(f"Font {font_path} not found, using the default font.")
+            self.font = ImageFont.load_default()
+        self._labels: dict[tuple[str, str], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def style(self, label: str) -> BoxStyle:
+        return self.styles.get(label, self.default_style)
+
+    def _label_sprite(self, label: str, score_text: str) -> np.ndarray:
+        """Returns the [height, width, 3] rasterized label of a class and score, rendering it on the first call."""
+        sprite = self._labels.get((label, score_text))
+        if sprite is None:
+            style = self.style(label)
+            text = f"{label}/{score_text}"
+            left, top, right, bottom = self.font.getbbox(text)
+            margin = int(np.ceil(0.05 * (bottom - top)))
+            label_image = Image.new(
+                "RGB",
+                (right - left + 2 * margin, bottom - top + 2 * margin),
+                style.label_color,
+            )
+            ImageDraw.Draw(label_image).text(
+                (margin - left, margin - top),
+                text,
+                fill=style.text_color,
+                font=self.font,
+            )
+            sprite = np.asarray(label_image)
+            with self._lock:
+                self._labels[(label, score_text)] = sprite
+        return sprite
+
+    def prerender(self, labels: list):
+        """Rasterizes the labels of every score of some classes ahead of time, e.g. on startup, so that the first
+        drawings do not pay for it.
+
+        Args:
+            labels (list): labels of the classes
+        """
+        for label in labels:
+            for score in range(101):
+                self._label_sprite(label, f"{score / 100:.2f}")
+
+    @staticmethod
+    def _draw_outlines_at_once(
+        image_array: np.ndarray, boxes: np.ndarray, width: int, color: tuple
+    ):
+        """Fills the outlines of many boxes of the same style at once. Each outline is made of `width` horizontal runs of
+        pixels at the top and at the bottom of the box, and `width` vertical runs on its sides: the flat indices of every
+        run are generated together, then filled with a single assignment."""
+        image_width = image_array.shape[1]
+        top, left, bottom, right = boxes.T
+        line_offsets = np.arange(width)[:, None]
+        box_indices = np.tile(np.arange(len(boxes)), 2 * width)
+        runs = []
+        for (first_line, last_line, first_pixel, last_pixel), line_step, pixel_step in (
+            ((top, bottom, left, right), image_width, 1),
+            ((left, right, top, bottom), 1, image_width),
+        ):
+            lines = np.concatenate(
+                [first_line + line_offsets, last_line - 1 - line_offsets]
+            ).ravel()
+            # Lines beyond the opposite side of a box thinner than twice the outline width are skipped.
+            valid_lines = (lines >= first_line[box_indices]) & (
+                lines < last_line[box_indices]
+            )
+            lengths = np.where(valid_lines, (last_pixel - first_pixel)[box_indices], 0)
+            starts = lines * line_step + first_pixel[box_indices] * pixel_step
+            run_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+            runs.append(
+                np.repeat(starts, lengths)
+                + (np.arange(lengths.sum()) - run_offsets) * pixel_step
+            )
+        image_array.reshape(-1, image_array.shape[2])[np.concatenate(runs)] = color
+
+    @staticmethod
+    def _draw_outline(image_array: np.ndarray, box: tuple, width: int, color: tuple):
+        top, left, bottom, right = box
+        image_array[top : min(top + width, bottom), left:right] = color
+        image_array[max(bottom - width, top) : bottom, left:right] = color
+        image_array[top:bottom, left : min(left + width, right)] = color
+        image_array[top:bottom, max(right - width, left) : right] = color
+
+    def draw(
+        self,
+        image_array: np.ndarray,
+        boxes: np.ndarray,
+        scores: np.ndarray,
+        labels: list,
+    ):
+        """Draws detections in place on an image array.
+
+        Args:
+            image_array (np.ndarray): a [height, width, 3] uint8 image
+            boxes (np.ndarray): a [N, 4] array of (ymin, xmin, ymax, xmax) boxes, normalized between 0 and 1
+            scores (np.ndarray): scores of the detections
+            labels (list): labels of the detections
+
+        Raises:
+            ValueError: an error is raised when boxes is not a [N, 4] array
+        """
+        boxes = np.asarray(boxes)
+        if boxes.ndim != 2 or boxes.shape[1] != 4:
+            raise ValueError("Input must be of size [N, 4]")
+        if len(boxes) == 0:
+            return
+        height, width = image_array.shape[:2]
+        # (top, left, bottom, right) in pixels, bottom and right excluded, clipped to the image.
+        pixel_boxes = np.clip(
+            np.rint(boxes * [height, width, height, width]).astype("int64"),
+            0,
+            [height, width, height, width],
+        )
+        styles = [self.style(label) for label in labels]
+        if (
+            self.vectorize_above is not None
+            and len(boxes) > self.vectorize_above
+            and image_array.flags.c_contiguous
+        ):
+            style_indices: dict[tuple, list] = {}
+            for i, style in enumerate(styles):
+                style_indices.setdefault(
+                    (style.outline_width, style.outline_color), []
+                ).append(i)
+            for (outline_width, outline_color), indices in style_indices.items():
+                self._draw_outlines_at_once(
+                    image_array, pixel_boxes[indices], outline_width, outline_color
+                )
+        else:
+            for box, style in zip(pixel_boxes.tolist(), styles):
+                self._draw_outline(
+                    image_array, box, style.outline_width, style.outline_color
+                )
+
+        for (top, left, bottom, _), label, score in zip(
+            pixel_boxes.tolist(), labels, np.asarray(scores, dtype=float).tolist()
+        ):
+            sprite = self._label_sprite(label, f"{score:.2f}")
+            sprite_height, sprite_width = sprite.shape[:2]
+            sprite_top = top - sprite_height if top >= sprite_height else bottom
+            sprite_bottom = min(sprite_top + sprite_height, height)
+            sprite_right = min(left + sprite_width, width)
+            image_array[sprite_top:sprite_bottom, left:sprite_right] = sprite[
+                : sprite_bottom - sprite_top, : sprite_right - left
+            ]
+
+    def draw_on_image(
+        self,
+        image: Image.Image,
+        boxes: np.ndarray,
+        scores: np.ndarray,
+        labels: list,
+    ):
+        """Draws detections in place on a PIL image. Drawing on the image array with `draw` saves two copies.
+
+        Args:
+            image (Image.Image): an RGB image
+            boxes (np.ndarray): a [N, 4] array of (ymin, xmin, ymax, xmax) boxes, normalized between 0 and 1
+            scores (np.ndarray): scores of the detections
+            labels (list): labels of the detections
+        """
+        image_array = np.array(image.convert("RGB"))
+        self.draw(image_array, boxes, scores, labels)
+        image.paste(Image.fromarray(image_array))
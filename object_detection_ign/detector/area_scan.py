@@ -0,0 +1,328 @@
+"""Detection over a whole area, such as a town, with overlapping windows of the model input size slid over the tiles
+covering it. The detections are written to a GeoJSON file.
+
+Usage, from the root of the repository:
+    python -m object_detection_ign.detector.area_scan detections.geojson --bbox -1.552 48.838 -1.5465 48.8416
+    python -m object_detection_ign.detector.area_scan detections.geojson --geojson town.geojson --zoom-level 18
+"""
+import sys
+import json
+import argparse
+import numpy as np
+import picologging as logging
+import tflite_runtime.interpreter as tflite
+from collections import OrderedDict
+from typing import Optional, Union
+from starlite import State
+
+from object_detection_ign.api.api_configuration import (
+    create_wmts_client,
+    set_state_on_startup,
+)
+from object_detection_ign.api.serialization import detections_to_geojson
+from object_detection_ign.wmts.satellite_view import WMTSClient
+from object_detection_ign.wmts.tile_seeding import read_geojson_polygons
+from object_detection_ign.wmts.tile_sources import TileNotFoundError
+from object_detection_ign.wmts.utils import (
+    TILE_SIZE,
+    compute_covering_tiles,
+    paste_tiles,
+    tile_positions_to_coordinates,
+    window_tile_positions,
+)
+from object_detection_ign.detector.inference_engine import BatchedInferenceEngine
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+from object_detection_ign.detector.inference_helpers import (
+    filter_predictions,
+    load_inference_model,
+    non_max_suppression,
+    run_detector,
+)
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+CONFIG_FILE_PATH = "config/api_config.toml"
+
+
+class SlidingWindowReader:
+    """Assembles square windows of the tile grid directly from the tiles they overlap, either into a single
+    preallocated buffer or straight into a model input tensor. The most recently used tiles are kept decoded, since
+    consecutive overlapping windows share most of their tiles. Memory usage is bounded by the buffer and
+    `max_cached_tiles`, whatever the size of the scanned area.
+
+    With `fill_missing_tiles`, the tiles which a local tile source does not hold, e.g. around the area it covers, are
+    filled with black pixels and counted in `missing_tiles` instead of raising an error.
+    """
+
+    def __init__(
+        self,
+        wmts_client: WMTSClient,
+        layer: str,
+        zoom_level: int,
+        window_size: int,
+        max_cached_tiles: int = 32,
+        fill_missing_tiles: bool = False,
+    ):
+        self.wmts_client: WMTSClient = wmts_client
+        self.layer: str = layer
+        self.zoom_level: int = zoom_level
+        self.window_size: int = window_size
+        self.max_cached_tiles: int = max_cached_tiles
+        self.fill_missing_tiles: bool = fill_missing_tiles
+        self.missing_tiles: int = 0
+        self.buffer: np.ndarray = None
+        self._tiles: OrderedDict = OrderedDict()
+
+    def _get_tile_array(self, tile_row: int, tile_column: int) -> np.ndarray:
+        key = (tile_row, tile_column)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        try:
+            tile_array = self.wmts_client.get_tile_array(
+                self.layer, self.zoom_level, *key
+            )
+        except TileNotFoundError:
+            if not self.fill_missing_tiles:
+                raise
+            self.missing_tiles += 1
+            tile_array = np.zeros((TILE_SIZE, TILE_SIZE, 3), dtype="uint8")
+        self._tiles[key] = tile_array
+        if len(self._tiles) > self.max_cached_tiles:
+            self._tiles.popitem(last=False)
+        return tile_array
+
+    def window_tiles(self, pixel_row: int, pixel_column: int) -> list:
+        """Lists the (row, column) of the tiles overlapped by the window whose top left pixel is given."""
+        return window_tile_positions(
+            pixel_row, pixel_column, self.window_size, self.window_size
+        )
+
+    def prefetch(self, pixel_row: int, pixel_column: int):
+        """Fetches and decodes the tiles of the window whose top left pixel is given into the cache, so that writing the
+        window only copies pixels, e.g. while an interpreter is checked out. The cache must hold the tiles of a window.
+
+        Args:
+            pixel_row (int): row of the top left pixel of the window
+            pixel_column (int): column of the top left pixel of the window
+        """
+        for tile_row, tile_column in self.window_tiles(pixel_row, pixel_column):
+            self._get_tile_array(tile_row, tile_column)
+
+    def write(self, destination: np.ndarray, pixel_row: int, pixel_column: int):
+        """Writes the window whose top left pixel is given into a [window_size, window_size, 3] array.
+
+        Args:
+            destination (np.ndarray): the array to fill, e.g. a view on a model input tensor
+            pixel_row (int): row of the top left pixel of the window
+            pixel_column (int): column of the top left pixel of the window
+        """
+        paste_tiles(destination, self._get_tile_array, pixel_row, pixel_column)
+
+    def read(self, pixel_row: int, pixel_column: int) -> np.ndarray:
+        """Fills the buffer with the window whose top left pixel is given, in pixels of the whole tile grid.
+        Note: the buffer is overwritten by the next read.
+
+        Args:
+            pixel_row (int): row of the top left pixel of the window
+            pixel_column (int): column of the top left pixel of the window
+
+        Returns:
+            np.ndarray: a [1, window_size, window_size, 3] float32 array
+        """
+        if self.buffer is None:
+            self.buffer = np.zeros(
+                (1, self.window_size, self.window_size, 3), dtype="float32"
+            )
+        self.write(self.buffer[0], pixel_row, pixel_column)
+        return self.buffer
+
+
+def _window_offsets(start: int, length: int, window_size: int, stride: int) -> list:
+    """Lists the offsets of the windows sliding along one axis. The last window is aligned on the end of the axis."""
+    last_offset = max(length - window_size, 0)
+    offsets = list(range(0, last_offset + 1, stride))
+    if offsets[-1] != last_offset:
+        offsets.append(last_offset)
+    return [start + offset for offset in offsets]
+
+
+def scan_area(
+    wmts_client: WMTSClient,
+    satellite_detector: Union[
+        tflite.Interpreter, InterpreterPool, BatchedInferenceEngine
+    ],
+    classes_dict: dict,
+    area,
+    layer: str,
+    zoom_level: int,
+    window_size: int = 640,
+    overlap: int = 128,
+    detection_threshold=0.1,
+    iou_threshold=0.5,
+    max_cached_tiles: Optional[int] = None,
+) -> tuple[np.array, list, np.array]:
+    """Detects objects over a whole area, such as a town, by sliding overlapping windows of the model input size over
+    the tiles covering it. Windows are assembled from the tiles one at a time, so memory stays bounded. Objects cut by a
+    window border are seen whole by an overlapping window, and the duplicate detections are merged by non maximum
+    suppression.
+
+    The tiles of each window are fetched before it is handed to the model, so that no download happens while an
+    interpreter is checked out or on the worker of a BatchedInferenceEngine, where a failed download would fail the
+    other images of the batch.
+
+    Args:
+        wmts_client (WMTSClient): the WMTS client used to fetch the tiles
+        satellite_detector (tf.lite.Interpreter|InterpreterPool|BatchedInferenceEngine): the model to run
+        classes_dict (dict): a dictionary containing the label corresponding to each class value
+        area (tuple|list): a (min_longitude, min_latitude, max_longitude, max_latitude) bounding box, or a list of
+            (longitude, latitude) polygon vertices
+        layer (str): name of the layer containing the images in the WMTS server
+        zoom_level (int): zoom level to use on the WMTS server
+        window_size (int, optional): width and height of the model input images. Defaults to 640.
+        overlap (int, optional): number of pixels shared by two neighbouring windows. Defaults to 128.
+        detection_threshold (float, optional): minimal score of the kept detections. Defaults to 0.1.
+        iou_threshold (float, optional): IoU above which two detections of the same label are merged. Defaults to 0.5.
+        max_cached_tiles (int, optional): number of decoded tiles kept in memory. Defaults to None (the tiles of a row
+            of windows across the area, so that the tiles shared by two rows of windows are decoded once).
+
+    Raises:
+        ValueError: an error is raised when the area is out of the limits of the tile matrix
+
+    Returns:
+        scores (np.array): scores of the detections
+        labels (list): labels of the detections
+        bounding_boxes (np.array): a [N, 4] array of (min_longitude, min_latitude, max_longitude, max_latitude) boxes
+    """
+    tiles = compute_covering_tiles(wmts_client.matrix_index, zoom_level, area)
+    if not len(tiles):
+        raise ValueError(f"The area is out of the tile matrix {zoom_level}.")
+    covered_tiles = set(map(tuple, tiles.tolist()))
+    (first_row, first_column), (last_row, last_column) = tiles.min(0), tiles.max(0)
+    stride = window_size - overlap
+    # A window overlaps at most window_size // TILE_SIZE + 2 rows and columns of tiles.
+    window_span = window_size // TILE_SIZE + 2
+    if max_cached_tiles is None:
+        max_cached_tiles = window_span * int(last_column - first_column + 1)
+    reader = SlidingWindowReader(
+        wmts_client,
+        layer,
+        zoom_level,
+        window_size,
+        max(max_cached_tiles, window_span**2),
+    )
+    logger.info(f"Scanning {len(tiles)} tiles at zoom level {zoom_level}.")
+
+    window_scores, window_labels, window_boxes = [], [], []
+    for pixel_row in _window_offsets(
+        int(first_row) * TILE_SIZE,
+        int(last_row - first_row + 1) * TILE_SIZE,
+        window_size,
+        stride,
+    ):
+        for pixel_column in _window_offsets(
+            int(first_column) * TILE_SIZE,
+            int(last_column - first_column + 1) * TILE_SIZE,
+            window_size,
+            stride,
+        ):
+            if covered_tiles.isdisjoint(reader.window_tiles(pixel_row, pixel_column)):
+                continue
+            reader.prefetch(pixel_row, pixel_column)
+            output = run_detector(
+                satellite_detector,
+                lambda destination: reader.write(destination, pixel_row, pixel_column),
+            )
+            scores, labels, bounding_boxes = filter_predictions(
+                output, classes_dict, detection_threshold=detection_threshold
+            )
+            window_scores.append(scores)
+            window_labels.extend(labels)
+            window_boxes.append(
+                np.reshape(bounding_boxes, (-1, 4)) * window_size
+                + [pixel_row, pixel_column, pixel_row, pixel_column]
+            )
+
+    scores = np.concatenate(window_scores) if window_scores else np.array([])
+    pixel_boxes = np.concatenate(window_boxes) if window_boxes else np.zeros((0, 4))
+    kept_idx = non_max_suppression(
+        pixel_boxes, scores, window_labels, iou_threshold=iou_threshold
+    )
+    pixel_boxes = pixel_boxes[kept_idx] / TILE_SIZE
+    min_longitudes, max_latitudes = tile_positions_to_coordinates(
+        wmts_client.matrix_index, zoom_level, pixel_boxes[:, 0], pixel_boxes[:, 1]
+    )
+    max_longitudes, min_latitudes = tile_positions_to_coordinates(
+        wmts_client.matrix_index, zoom_level, pixel_boxes[:, 2], pixel_boxes[:, 3]
+    )
+    bounding_boxes = np.stack(
+        [min_longitudes, min_latitudes, max_longitudes, max_latitudes], axis=1
+    )
+    return scores[kept_idx], [window_labels[i] for i in kept_idx], bounding_boxes
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("output", help="path of the GeoJSON file of the detections")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("MIN_LONGITUDE", "MIN_LATITUDE", "MAX_LONGITUDE", "MAX_LATITUDE"),
+    )
+    region.add_argument("--geojson", help="path of a GeoJSON file of polygons")
+    parser.add_argument("--layer", default="HR.ORTHOIMAGERY.ORTHOPHOTOS")
+    parser.add_argument("--zoom-level", type=int, default=19)
+    parser.add_argument("--overlap", type=int, default=128)
+    parser.add_argument("--detection-threshold", type=float, default=0.1)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--config", default=CONFIG_FILE_PATH)
+    arguments = parser.parse_args(arguments)
+    logger.setLevel(logging.INFO)
+
+    state = State({"config_file_path": arguments.config})
+    set_state_on_startup(state)
+    wmts_client = create_wmts_client(state)
+    if arguments.zoom_level not in wmts_client.matrix_index.zoom_levels:
+        parser.error(f"Unavailable zoom level: {arguments.zoom_level}.")
+    if arguments.layer not in wmts_client.list_available_layers():
+        parser.error(f"Unavailable layer: {arguments.layer}.")
+    areas = (
+        [tuple(arguments.bbox)]
+        if arguments.bbox
+        else read_geojson_polygons(arguments.geojson)
+    )
+    satellite_detector, window_width, _ = load_inference_model(state.MODEL_PATH)
+
+    area_scores, area_labels, area_boxes = [], [], []
+    for area in areas:
+        scores, labels, bounding_boxes = scan_area(
+            wmts_client,
+            satellite_detector,
+            state.CLASSES_DICT,
+            area,
+            arguments.layer,
+            arguments.zoom_level,
+            window_size=int(window_width),
+            overlap=arguments.overlap,
+            detection_threshold=arguments.detection_threshold,
+            iou_threshold=arguments.iou_threshold,
+        )
+        area_scores.append(scores)
+        area_labels.extend(labels)
+        area_boxes.append(bounding_boxes)
+    with open(arguments.output, "w") as output_file:
+        json.dump(
+            detections_to_geojson(
+                np.concatenate(area_scores), area_labels, np.concatenate(area_boxes)
+            ),
+            output_file,
+        )
+    logger.info(f"Wrote {len(area_labels)} detections to {arguments.output}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
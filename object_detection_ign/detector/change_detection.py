@@ -0,0 +1,438 @@
+"""Incremental detection over a new snapshot of an orthophoto layer, e.g. when the IGN publishes a new layer over areas
+already processed by the offline pipeline.
+
+The tiles of the previous and of the new snapshot are compared by the hash of their encoded content, without decoding
+them. Only the chunks with a window reading a changed tile go through the model again: the detections of the other
+chunks are copied from the output of the previous run, since they were computed from the same pixels. The new
+detections of the chunks run again are matched with their previous detections, by label and overlap, and the
+unmatched ones are written to the "added" and "removed" layers of the changes output. The run uses the parameters of
+the previous run, so that both runs have the same chunks.
+
+Usage, from the root of the repository:
+    python -m object_detection_ign.detector.change_detection ortho_2021.mbtiles detections_2021.gpkg \\
+        ortho_2024.mbtiles detections_2024.gpkg --changes changes_2024.gpkg
+    python -m object_detection_ign.detector.change_detection ortho.gpkg detections_2021/ ortho.gpkg \\
+        detections_2024/ --layer ortho_2024 --changes changes_2024/
+"""
+import os
+import sys
+import time
+import argparse
+import functools
+import numpy as np
+import picologging as logging
+from typing import Callable, Optional
+from starlite import State
+
+from object_detection_ign.api.api_configuration import set_state_on_startup
+from object_detection_ign.detector.detection_writers import (
+    DetectionWriter,
+    open_detection_writer,
+)
+from object_detection_ign.detector.offline_pipeline import (
+    CONFIG_FILE_PATH,
+    detect_chunks,
+    _tile_keys,
+    filter_area_tiles,
+    load_cpu_interpreter,
+    plan_chunks,
+)
+from object_detection_ign.wmts.tile_sources import TileSource, open_tile_source
+from object_detection_ign.wmts.utils import TILE_SIZE
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+def _area_tile_hashes(
+    tile_source: TileSource, layer: str, zoom_level: int, areas: Optional[list]
+) -> tuple[np.ndarray, np.ndarray]:
+    tiles, hashes = tile_source.tile_hashes(layer, zoom_level)
+    if not areas:
+        return tiles, hashes
+    # The area tiles keep the row-major order of the tiles, whose hashes are found by binary search.
+    area_tiles = filter_area_tiles(tiles, tile_source.matrix_index, zoom_level, areas)
+    return (
+        area_tiles,
+        hashes[
+            np.searchsorted(
+                _tile_keys(tiles, zoom_level), _tile_keys(area_tiles, zoom_level)
+            )
+        ],
+    )
+
+
+def find_changed_tiles(
+    previous_tiles: np.ndarray,
+    previous_hashes: np.ndarray,
+    new_tiles: np.ndarray,
+    new_hashes: np.ndarray,
+) -> np.ndarray:
+    """Lists the tiles whose content changed between two snapshots, including the tiles held by a single snapshot.
+
+    Args:
+        previous_tiles (np.ndarray): a [N, 2] array of the (tile row, tile column) of the previous snapshot
+        previous_hashes (np.ndarray): the [N] hashes of the tiles of the previous snapshot
+        new_tiles (np.ndarray): a [M, 2] array of the (tile row, tile column) of the new snapshot
+        new_hashes (np.ndarray): the [M] hashes of the tiles of the new snapshot
+
+    Returns:
+        np.ndarray: a [K, 2] array of the (tile row, tile column) of the changed tiles, in row-major order
+    """
+    tiles = np.concatenate(
+        [
+            np.asarray(previous_tiles, dtype="int64").reshape(-1, 2),
+            np.asarray(new_tiles, dtype="int64").reshape(-1, 2),
+        ]
+    )
+    hashes = np.concatenate([previous_hashes, new_hashes])
+    order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+    tiles, hashes = tiles[order], hashes[order]
+    # A tile held by both snapshots is listed twice in a row: it is unchanged when both have the same hash.
+    same_tile = np.all(tiles[1:] == tiles[:-1], axis=1)
+    unchanged_pairs = same_tile & (hashes[1:] == hashes[:-1])
+    unchanged = np.zeros(len(tiles), dtype=bool)
+    unchanged[1:] |= unchanged_pairs
+    unchanged[:-1] |= unchanged_pairs
+    first_listing = np.ones(len(tiles), dtype=bool)
+    first_listing[1:] = ~same_tile
+    return tiles[~unchanged & first_listing]
+
+
+def _windows_reading(
+    first_pixels: np.ndarray, last_pixels: np.ndarray, window_size: int, stride: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Finds the first and the last windows of an axis reading at least one pixel between two pixels included, for
+    arrays of pixels. Window i reads the pixels from i * stride to i * stride + window_size excluded.
+    """
+    return (
+        np.maximum(-((window_size - 1 - first_pixels) // stride), 0),
+        last_pixels // stride,
+    )
+
+
+def find_dirty_chunks(
+    changed_tiles: np.ndarray, window_size: int, overlap: int, chunk_windows: int
+) -> set:
+    """Lists the chunks with a window reading a changed tile, as planned by `plan_chunks`. The detections of the other
+    chunks are computed from unchanged pixels.
+
+    Args:
+        changed_tiles (np.ndarray): a [N, 2] array of the (tile row, tile column) of the changed tiles
+        window_size (int): width and height of the windows in pixels
+        overlap (int): number of pixels shared by two neighbouring windows
+        chunk_windows (int): number of windows along each side of a chunk
+
+    Returns:
+        set: the (chunk row, chunk column) of the chunks to process again
+    """
+    changed_tiles = np.asarray(changed_tiles, dtype="int64").reshape(-1, 2)
+    if len(changed_tiles) == 0:
+        return set()
+    first_windows, last_windows = _windows_reading(
+        changed_tiles * TILE_SIZE,
+        (changed_tiles + 1) * TILE_SIZE - 1,
+        window_size,
+        window_size - overlap,
+    )
+    first_chunks, last_chunks = (
+        first_windows // chunk_windows,
+        last_windows // chunk_windows,
+    )
+    spans = last_chunks - first_chunks + 1
+    # A tile is read by the windows of a few chunks along each axis: they are listed one offset at a time.
+    dirty_chunks = [
+        first_chunks[(row_offset < spans[:, 0]) & (column_offset < spans[:, 1])]
+        + [row_offset, column_offset]
+        for row_offset in range(spans[:, 0].max())
+        for column_offset in range(spans[:, 1].max())
+    ]
+    return set(map(tuple, np.unique(np.concatenate(dirty_chunks), axis=0).tolist()))
+
+
+def match_detections(
+    previous_boxes: np.ndarray,
+    previous_labels: list,
+    new_boxes: np.ndarray,
+    new_labels: list,
+    iou_threshold: float = 0.5,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Matches the detections of two snapshots, greedily by decreasing intersection over union: a detection is matched
+    with a detection of the same label of the other snapshot when their IoU exceeds the threshold.
+
+    Args:
+        previous_boxes (np.ndarray): a [N, 4] array of (min_x, min_y, max_x, max_y) boxes of the previous snapshot
+        previous_labels (list): the [N] labels of the previous detections
+        new_boxes (np.ndarray): a [M, 4] array of (min_x, min_y, max_x, max_y) boxes of the new snapshot
+        new_labels (list): the [M] labels of the new detections
+        iou_threshold (float, optional): minimal IoU between two matched detections. Defaults to 0.5.
+
+    Returns:
+        previous_matched (np.ndarray): a [N] boolean mask of the matched previous detections
+        new_matched (np.ndarray): a [M] boolean mask of the matched new detections
+    """
+    previous_boxes = np.asarray(previous_boxes, dtype="float64").reshape(-1, 4)
+    new_boxes = np.asarray(new_boxes, dtype="float64").reshape(-1, 4)
+    previous_matched = np.zeros(len(previous_boxes), dtype=bool)
+    new_matched = np.zeros(len(new_boxes), dtype=bool)
+    if len(previous_boxes) == 0 or len(new_boxes) == 0:
+        return previous_matched, new_matched
+    minimums = np.maximum(previous_boxes[:, None, :2], new_boxes[None, :, :2])
+    maximums = np.minimum(previous_boxes[:, None, 2:], new_boxes[None, :, 2:])
+    intersection = np.prod(np.clip(maximums - minimums, 0, None), axis=2)
+    previous_areas = np.prod(previous_boxes[:, 2:] - previous_boxes[:, :2], axis=1)
+    new_areas = np.prod(new_boxes[:, 2:] - new_boxes[:, :2], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        iou = intersection / (previous_areas[:, None] + new_areas[None] - intersection)
+    iou[np.asarray(previous_labels)[:, None] != np.asarray(new_labels)[None]] = 0
+    candidates = np.argwhere(iou > iou_threshold)
+    order = np.argsort(-iou[candidates[:, 0], candidates[:, 1]], kind="stable")
+    for previous_index, new_index in candidates[order].tolist():
+        if not previous_matched[previous_index] and not new_matched[new_index]:
+            previous_matched[previous_index] = new_matched[new_index] = True
+    return previous_matched, new_matched
+
+
+def run_change_detection(
+    previous_tile_source_path: str,
+    previous_output: DetectionWriter,
+    tile_source_path: str,
+    writer: DetectionWriter,
+    added_writer: DetectionWriter,
+    removed_writer: DetectionWriter,
+    interpreter_factory: Callable,
+    classes_dict: dict,
+    layer: Optional[str] = None,
+    workers: Optional[int] = None,
+    iou_threshold: float = 0.5,
+    queue_size: int = 4,
+    progress_interval: float = 10.0,
+) -> dict:
+    """Detects objects over a new snapshot of a tile archive, running the model only on the chunks which changed since
+    a previous run of the offline pipeline, and writes the added and removed detections. Like the offline pipeline, the
+    outputs are the checkpoint of the run: chunks already written are skipped.
+
+    Args:
+        previous_tile_source_path (str): path of the tile archive of the previous run
+        previous_output (DetectionWriter): the output of the previous run, read only
+        tile_source_path (str): path of the tile archive of the new snapshot, which may be the previous archive
+        writer (DetectionWriter): the writer of every detection of the new snapshot
+        added_writer (DetectionWriter): the writer of the detections which appeared in the new snapshot
+        removed_writer (DetectionWriter): the writer of the previous detections which disappeared
+        interpreter_factory (callable): loads the model in each worker process. It must be picklable.
+        classes_dict (dict): a dictionary containing the label corresponding to each class value
+        layer (str, optional): name of the layer of the new snapshot. Defaults to None (the layer of the previous run).
+        workers (int, optional): number of worker processes. Defaults to None (the number of CPUs).
+        iou_threshold (float, optional): minimal IoU between a previous and a new detection of the same object.
+            Defaults to 0.5.
+        queue_size (int, optional): number of windows assembled ahead of the inference in each worker. Defaults to 4.
+        progress_interval (float, optional): time between two progress reports, in seconds. Defaults to 10.
+
+    Raises:
+        ValueError: an error is raised when the previous output holds no run, or when an output holds a run with other
+            parameters
+
+    Returns:
+        dict: the number of changed tiles, of chunks reused and run again, of added and removed detections and of
+            detections of the new snapshot, and the duration in seconds
+    """
+    previous_parameters = previous_output.stored_parameters()
+    if previous_parameters is None:
+        raise ValueError("The previous output holds no run.")
+    parameters = {**previous_parameters, "layer": layer or previous_parameters["layer"]}
+    writer.check_parameters(parameters)
+    changes_parameters = {
+        **parameters,
+        "previous_layer": previous_parameters["layer"],
+        "iou_threshold": iou_threshold,
+    }
+    added_writer.check_parameters(changes_parameters)
+    removed_writer.check_parameters(changes_parameters)
+    zoom_level, areas = parameters["zoom_level"], parameters["areas"]
+    window_size, overlap, chunk_windows = (
+        parameters["window_size"],
+        parameters["overlap"],
+        parameters["chunk_windows"],
+    )
+
+    start = time.perf_counter()
+    tile_hashes = []
+    for path, source_layer in (
+        (previous_tile_source_path, previous_parameters["layer"]),
+        (tile_source_path, parameters["layer"]),
+    ):
+        tile_source = open_tile_source(path, layer=source_layer)
+        tile_hashes.append(
+            _area_tile_hashes(tile_source, source_layer, zoom_level, areas)
+        )
+        tile_source.close()
+    (previous_tiles, previous_hashes), (new_tiles, new_hashes) = tile_hashes
+    changed_tiles = find_changed_tiles(
+        previous_tiles, previous_hashes, new_tiles, new_hashes
+    )
+    dirty_chunks = find_dirty_chunks(changed_tiles, window_size, overlap, chunk_windows)
+    chunks = plan_chunks(new_tiles, window_size, overlap, chunk_windows)
+
+    previous_chunks = previous_output.completed_chunks()
+    completed_chunks = writer.completed_chunks()
+    added_chunks, removed_chunks = (
+        added_writer.completed_chunks(),
+        removed_writer.completed_chunks(),
+    )
+    pending_chunks = [
+        chunk for chunk in sorted(chunks) if chunk not in completed_chunks
+    ]
+    reused_chunks = [
+        chunk
+        for chunk in pending_chunks
+        if chunk in previous_chunks and chunk not in dirty_chunks
+    ]
+    detected_chunks = sorted(set(pending_chunks) - set(reused_chunks))
+    logger.info(
+        f"{len(changed_tiles)} of {len(new_tiles)} tiles changed, {len(detected_chunks)} chunks to run again, "
+        f"{len(reused_chunks)} chunks to reuse, {len(chunks) - len(pending_chunks)} chunks already done."
+    )
+    progress = {
+        "changed_tiles": len(changed_tiles),
+        "reused_chunks": 0,
+        "detected_chunks": 0,
+        "added": 0,
+        "removed": 0,
+        "detections": 0,
+    }
+
+    for chunk in reused_chunks:
+        scores, labels, bounding_boxes = previous_output.read_chunk(chunk)
+        writer.write(chunk, scores, labels, bounding_boxes)
+        progress["reused_chunks"] += 1
+        progress["detections"] += len(labels)
+    # Chunks which are not covered by the new snapshot anymore only lost their detections.
+    for chunk in sorted(previous_chunks - chunks.keys() - removed_chunks):
+        scores, labels, bounding_boxes = previous_output.read_chunk(chunk)
+        removed_writer.write(chunk, scores, labels, bounding_boxes)
+        progress["removed"] += len(labels)
+
+    last_report = time.perf_counter()
+    for chunk, scores, labels, bounding_boxes, _ in detect_chunks(
+        tile_source_path,
+        parameters["layer"],
+        zoom_level,
+        {chunk: chunks[chunk] for chunk in detected_chunks},
+        interpreter_factory,
+        classes_dict,
+        workers=workers,
+        window_size=window_size,
+        overlap=overlap,
+        chunk_windows=chunk_windows,
+        detection_threshold=parameters["detection_threshold"],
+        queue_size=queue_size,
+    ):
+        previous_scores, previous_labels, previous_boxes = (
+            previous_output.read_chunk(chunk)
+            if chunk in previous_chunks
+            else (np.array([]), [], np.zeros((0, 4)))
+        )
+        previous_matched, new_matched = match_detections(
+            previous_boxes, previous_labels, bounding_boxes, labels, iou_threshold
+        )
+        # The changes are written first: the chunk is only completed once every output holds it.
+        if chunk not in added_chunks:
+            added_writer.write(
+                chunk,
+                np.asarray(scores)[~new_matched],
+                [label for label, matched in zip(labels, new_matched) if not matched],
+                np.asarray(bounding_boxes)[~new_matched],
+            )
+        if chunk not in removed_chunks:
+            removed_writer.write(
+                chunk,
+                np.asarray(previous_scores)[~previous_matched],
+                [
+                    label
+                    for label, matched in zip(previous_labels, previous_matched)
+                    if not matched
+                ],
+                np.asarray(previous_boxes)[~previous_matched],
+            )
+        writer.write(chunk, scores, labels, bounding_boxes)
+        progress["detected_chunks"] += 1
+        progress["added"] += int((~new_matched).sum())
+        progress["removed"] += int((~previous_matched).sum())
+        progress["detections"] += len(labels)
+        now = time.perf_counter()
+        if now - last_report >= progress_interval:
+            last_report = now
+            logger.info(
+                f"Processed {progress['detected_chunks']}/{len(detected_chunks)} chunks, "
+                f"{progress['added']} added and {progress['removed']} removed detections."
+            )
+    progress["duration"] = time.perf_counter() - start
+    return progress
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("previous_tile_source", help="tile archive of the previous run")
+    parser.add_argument("previous_output", help="output of the previous run")
+    parser.add_argument("tile_source", help="tile archive of the new snapshot")
+    parser.add_argument(
+        "output", help="a .gpkg GeoPackage, or a directory of Parquet files"
+    )
+    parser.add_argument(
+        "--changes",
+        required=True,
+        help="a .gpkg GeoPackage, or a directory of Parquet files, receiving the added and removed layers",
+    )
+    parser.add_argument(
+        "--layer",
+        default=None,
+        help="layer of the new snapshot, the layer of the previous run by default",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    parser.add_argument("--config", default=CONFIG_FILE_PATH)
+    arguments = parser.parse_args(arguments)
+    logger.setLevel(logging.INFO)
+
+    if not os.path.exists(arguments.previous_output):
+        parser.error(f"The previous output {arguments.previous_output} does not exist.")
+    state = State({"config_file_path": arguments.config})
+    set_state_on_startup(state)
+    writers = [
+        open_detection_writer(arguments.previous_output),
+        open_detection_writer(arguments.output),
+        open_detection_writer(arguments.changes, layer="added"),
+        open_detection_writer(arguments.changes, layer="removed"),
+    ]
+    try:
+        progress = run_change_detection(
+            arguments.previous_tile_source,
+            writers[0],
+            arguments.tile_source,
+            *writers[1:],
+            functools.partial(
+                load_cpu_interpreter, state.MODEL_PATH, arguments.threads_per_worker
+            ),
+            state.CLASSES_DICT,
+            layer=arguments.layer,
+            workers=arguments.workers,
+            iou_threshold=arguments.iou_threshold,
+            progress_interval=arguments.progress_interval,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        for writer in writers:
+            writer.close()
+    logger.info(
+        f"{progress['changed_tiles']} tiles changed: ran {progress['detected_chunks']} chunks and reused "
+        f"{progress['reused_chunks']} chunks in {progress['duration']:.1f} s, {progress['added']} added and "
+        f"{progress['removed']} removed detections, {progress['detections']} detections in the new snapshot."
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
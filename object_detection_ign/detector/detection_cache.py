@@ -0,0 +1,287 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Optional
+import picologging as logging
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+# (layer, zoom level, pixel window of the image on the tile grid, detection threshold)
+DetectionKey = tuple[str, int, tuple[int, int, int, int], float]
+Detections = tuple[np.array, list, np.array]
+
+
+def hash_model_file(model_path: str) -> str:
+    """Hashes the content of a model file, so that results computed by another model are never reused.
+
+    Args:
+        model_path (str): Filepath of a tensorflow lite object detection model.
+
+    Returns:
+        str: the SHA-256 digest of the file
+    """
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as model_file:
+        for chunk in iter(lambda: model_file.read(1024**2), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DetectionCache:
+    """A cache of detection results, keyed by layer, zoom level, pixel window on the tile grid and detection threshold.
+    Each entry holds the raw detections and, optionally, the images encoded from them, keyed by encoding options.
+
+    The first tier is an in-memory LRU bounded by `memory_budget_bytes`. When a database path is given, entries are
+    also stored in a SQLite database, shared by every worker. Every entry records the hash of the model which computed
+    it: entries of other models are ignored, and deleted from the database on startup, so changing MODEL_PATH
+    invalidates the cache.
+    """
+
+    def __init__(
+        self,
+        model_hash: str,
+        memory_budget_bytes: int = 64 * 1024**2,
+        database_path: Optional[str] = None,
+        ttl: float = 7 * 24 * 3600,
+        cache_images: bool = True,
+    ):
+        self.model_hash: str = model_hash
+        self.memory_budget_bytes: int = memory_budget_bytes
+        self.database_path: Optional[str] = database_path
+        self.ttl: float = ttl
+        self.cache_images: bool = cache_images
+        self.hits, self.misses, self.memory_bytes = 0, 0, 0
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if database_path:
+            with self._connection() as connection:
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS detections (
+                        key TEXT PRIMARY KEY, model_hash TEXT, scores BLOB, labels TEXT, boxes BLOB, stored_at REAL
+                    )"""
+                )
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS images (
+                        key TEXT, encoding TEXT, model_hash TEXT, content BLOB, stored_at REAL,
+                        PRIMARY KEY (key, encoding)
+                    )"""
+                )
+                deleted = sum(
+                    connection.execute(
+                        f"DELETE FROM {table} WHERE model_hash != ?", (model_hash,)
+                    ).rowcount
+                    for table in ("detections", "images")
+                )
+            if deleted:
+                logger.info(f"Deleted {deleted} cached results of another model.")
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the SQLite connection of the current thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _key(self, key: DetectionKey) -> str:
+        layer, zoom_level, pixel_window, detection_threshold = key
+        return json.dumps(
+            [
+                self.model_hash,
+                layer,
+                int(zoom_level),
+                [int(value) for value in pixel_window],
+                float(detection_threshold),
+            ]
+        )
+
+    @staticmethod
+    def _entry_size(entry: dict) -> int:
+        scores, labels, boxes = entry["detections"]
+        return (
+            scores.nbytes
+            + boxes.nbytes
+            + sum(map(len, labels))
+            + sum(map(len, entry["images"].values()))
+        )
+
+    def _store_in_memory(self, key: str, entry: dict):
+        if key in self._entries:
+            self.memory_bytes -= self._entry_size(self._entries[key])
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.memory_bytes += self._entry_size(entry)
+        self._evict_memory()
+
+    def _store_image_in_memory(self, key: str, encoding: str, content: bytes):
+        entry = self._entries[key]
+        if encoding not in entry["images"]:
+            entry["images"][encoding] = content
+            self.memory_bytes += len(content)
+        self._entries.move_to_end(key)
+        self._evict_memory()
+
+    def _evict_memory(self):
+        """Evicts the least recently used entries until the memory tier fits in its budget."""
+        while self.memory_bytes > self.memory_budget_bytes and len(self._entries) > 1:
+            _, evicted_entry = self._entries.popitem(last=False)
+            self.memory_bytes -= self._entry_size(evicted_entry)
+
+    @property
+    def stats(self) -> dict:
+        """Hit and miss counters of the cache, for the current process.
+
+        Returns:
+            dict: the number of hits, misses, and entries and bytes held in memory
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._entries),
+            "memory_bytes": self.memory_bytes,
+        }
+
+    def get_detections(self, key: DetectionKey) -> Optional[Detections]:
+        """Looks the detections of an image up in memory, then on disk.
+
+        Args:
+            key (DetectionKey): (layer, zoom level, pixel window, detection threshold) of the detections
+
+        Returns:
+            Detections|None: the (scores, labels, bounding_boxes) if they are cached and not expired, None otherwise
+        """
+        entry = self._get_entry(self._key(key))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return entry["detections"]
+
+    def get_image(self, key: DetectionKey, encoding: str) -> Optional[bytes]:
+        """Looks an encoded image up in memory, then on disk.
+
+        Args:
+            key (DetectionKey): (layer, zoom level, pixel window, detection threshold) of the detections
+            encoding (str): a description of the encoding options of the image
+
+        Returns:
+            bytes|None: the encoded image if it is cached, None otherwise
+        """
+        key = self._key(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and encoding in entry["images"]:
+                return entry["images"][encoding]
+        if not self.database_path:
+            return None
+        row = (
+            self._connection()
+            .execute(
+                "SELECT content, stored_at FROM images WHERE key = ? AND encoding = ?",
+                (key, encoding),
+            )
+            .fetchone()
+        )
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._store_image_in_memory(key, encoding, row[0])
+        return row[0]
+
+    def _get_entry(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry["stored_at"] < self.ttl:
+                self._entries.move_to_end(key)
+                return entry
+            elif entry is not None:
+                self.memory_bytes -= self._entry_size(self._entries.pop(key))
+        if not self.database_path:
+            return None
+        row = (
+            self._connection()
+            .execute(
+                "SELECT scores, labels, boxes, stored_at FROM detections WHERE key = ?",
+                (key,),
+            )
+            .fetchone()
+        )
+        if row is None or now - row[3] >= self.ttl:
+            return None
+        scores, labels, boxes, stored_at = row
+        entry = {
+            "detections": (
+                np.frombuffer(scores, dtype="float32"),
+                json.loads(labels),
+                np.frombuffer(boxes, dtype="float32").reshape(-1, 4),
+            ),
+            "images": {},
+            "stored_at": stored_at,
+        }
+        with self._lock:
+            self._store_in_memory(key, entry)
+        return entry
+
+    def put_detections(self, key: DetectionKey, detections: Detections):
+        """Stores the detections of an image.
+
+        Args:
+            key (DetectionKey): (layer, zoom level, pixel window, detection threshold) of the detections
+            detections (Detections): the (scores, labels, bounding_boxes) of the image
+        """
+        key, now = self._key(key), time.time()
+        scores, labels, boxes = detections
+        detections = (
+            np.asarray(scores, dtype="float32"),
+            list(labels),
+            np.asarray(boxes, dtype="float32").reshape(-1, 4),
+        )
+        with self._lock:
+            self._store_in_memory(
+                key, {"detections": detections, "images": {}, "stored_at": now}
+            )
+        if self.database_path:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO detections VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        self.model_hash,
+                        detections[0].tobytes(),
+                        json.dumps(detections[1]),
+                        detections[2].tobytes(),
+                        now,
+                    ),
+                )
+
+    def put_image(self, key: DetectionKey, encoding: str, content: bytes):
+        """Stores an image encoded from cached detections. Images are only stored alongside their detections.
+
+        Args:
+            key (DetectionKey): (layer, zoom level, pixel window, detection threshold) of the detections
+            encoding (str): a description of the encoding options of the image
+            content (bytes): the encoded image
+        """
+        if not self.cache_images:
+            return
+        key = self._key(key)
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._store_image_in_memory(key, encoding, content)
+        if self.database_path:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+                    (key, encoding, self.model_hash, content, time.time()),
+                )
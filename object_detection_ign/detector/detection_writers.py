@@ -0,0 +1,380 @@
+import os
+import json
+import struct
+import sqlite3
+import tempfile
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import Optional
+
+WGS84_SRS_ID = 4326
+WGS84_DEFINITION = (
+    'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+    'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+    'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+)
+# "GPKG" as a big-endian integer, and GeoPackage version 1.2.
+GEOPACKAGE_APPLICATION_ID = 0x47504B47
+GEOPACKAGE_USER_VERSION = 10200
+
+Chunk = tuple[int, int]
+
+
+class DetectionWriter(ABC):
+    """Writes the detections of an offline pipeline run incrementally, chunk by chunk. Writing a chunk also marks it as
+    completed, atomically, so the output itself is the checkpoint of the run: a run started again on the same output
+    skips the completed chunks. The run parameters are stored with the first chunk, and resuming a run with other
+    parameters is refused, since its chunks would not match. The detections of a completed chunk are read back with
+    `read_chunk`, e.g. to reuse them in a later run.
+
+    Subclasses implement `stored_parameters`, `_store_parameters`, `completed_chunks`, `read_chunk` and `write`.
+    """
+
+    def check_parameters(self, parameters: dict):
+        """Stores the parameters of the run, or checks that they are the ones of the run being resumed.
+
+        Args:
+            parameters (dict): JSON serializable parameters of the run
+
+        Raises:
+            ValueError: an error is raised when the output holds a run with other parameters
+        """
+        parameters = json.loads(json.dumps(parameters))
+        stored_parameters = self.stored_parameters()
+        if stored_parameters is None:
+            self._store_parameters(parameters)
+        elif stored_parameters != parameters:
+            raise ValueError(
+                f"The output holds a run with other parameters: {stored_parameters}."
+            )
+
+    @abstractmethod
+    def stored_parameters(self) -> Optional[dict]:
+        """Reads the parameters of the run stored in the output.
+
+        Returns:
+            dict: the parameters of the run, None when the output holds no run yet
+        """
+
+    @abstractmethod
+    def _store_parameters(self, parameters: dict):
+        """Stores the parameters of a new run in the output."""
+
+    @abstractmethod
+    def completed_chunks(self) -> set:
+        """Lists the chunks already written.
+
+        Returns:
+            set: the (chunk row, chunk column) of the completed chunks
+        """
+
+    @abstractmethod
+    def read_chunk(self, chunk: Chunk) -> tuple[np.ndarray, list, np.ndarray]:
+        """Reads the detections of a completed chunk.
+
+        Args:
+            chunk (Chunk): (chunk row, chunk column) of the chunk
+
+        Returns:
+            scores (np.ndarray): scores of the detections
+            labels (list): labels of the detections
+            bounding_boxes (np.ndarray): a [N, 4] array of (min_longitude, min_latitude, max_longitude, max_latitude)
+        """
+
+    @abstractmethod
+    def write(
+        self,
+        chunk: Chunk,
+        scores: np.ndarray,
+        labels: list,
+        bounding_boxes: np.ndarray,
+    ):
+        """Writes the detections of a chunk, and marks it as completed.
+
+        Args:
+            chunk (Chunk): (chunk row, chunk column) of the chunk
+            scores (np.ndarray): scores of the detections
+            labels (list): labels of the detections
+            bounding_boxes (np.ndarray): a [N, 4] array of (min_longitude, min_latitude, max_longitude, max_latitude)
+        """
+
+    def close(self):
+        """Releases the output file."""
+
+
+def _geopackage_polygon(bounding_box) -> bytes:
+    """Encodes a bounding box as a GeoPackage geometry: a header holding the envelope of the geometry, followed by the
+    little-endian WKB polygon."""
+    min_x, min_y, max_x, max_y = bounding_box
+    return struct.pack(
+        "<2sBBi4dBIII10d",
+        b"GP",
+        0,
+        # Little-endian header with a [min_x, max_x, min_y, max_y] envelope.
+        0b011,
+        WGS84_SRS_ID,
+        min_x,
+        max_x,
+        min_y,
+        max_y,
+        1,
+        3,
+        1,
+        5,
+        min_x,
+        min_y,
+        max_x,
+        min_y,
+        max_x,
+        max_y,
+        min_x,
+        max_y,
+        min_x,
+        min_y,
+    )
+
+
+class GeoPackageDetectionWriter(DetectionWriter):
+    """Writes detections as polygons of a layer of a GeoPackage, which GIS tools open directly. A GeoPackage may hold
+    several layers, each one written by its own writer. The completed chunks and the run parameters of each layer are
+    kept in two more tables of the GeoPackage, and each chunk is written in a single transaction along with its
+    checkpoint.
+
+    Args:
+        path (str): path of the GeoPackage, created if it does not exist
+        layer (str, optional): name of the layer, a Python identifier. Defaults to "detections".
+
+    Raises:
+        ValueError: an error is raised when the layer name is not an identifier
+    """
+
+    def __init__(self, path: str, layer: str = "detections"):
+        # Layer names are table names, which cannot be query parameters.
+        if not layer.isidentifier():
+            raise ValueError(f"Invalid layer name {layer!r}.")
+        self.path: str = path
+        self.layer: str = layer
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                f"PRAGMA application_id = {GEOPACKAGE_APPLICATION_ID}"
+            )
+            self.connection.execute(f"PRAGMA user_version = {GEOPACKAGE_USER_VERSION}")
+            self.connection.executescript(
+                """CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+                    srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+                    organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT
+                );
+                CREATE TABLE IF NOT EXISTS gpkg_contents (
+                    table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+                    description TEXT DEFAULT '',
+                    last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ', 'now')),
+                    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+                    table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+                    srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+                    PRIMARY KEY (table_name, column_name)
+                );
+                CREATE TABLE IF NOT EXISTS pipeline_chunks (
+                    layer TEXT, chunk_row INTEGER, chunk_column INTEGER, detections INTEGER,
+                    PRIMARY KEY (layer, chunk_row, chunk_column)
+                );
+                CREATE TABLE IF NOT EXISTS pipeline_parameters (layer TEXT PRIMARY KEY, parameters TEXT);"""
+            )
+            self.connection.executescript(
+                f"""CREATE TABLE IF NOT EXISTS "{layer}" (
+                    fid INTEGER PRIMARY KEY AUTOINCREMENT, geom POLYGON, label TEXT, score REAL,
+                    chunk_row INTEGER, chunk_column INTEGER
+                );
+                CREATE INDEX IF NOT EXISTS "{layer}_chunk" ON "{layer}" (chunk_row, chunk_column);"""
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, NULL)",
+                [
+                    ("Undefined cartesian SRS", -1, "NONE", -1, "undefined"),
+                    ("Undefined geographic SRS", 0, "NONE", 0, "undefined"),
+                    ("WGS 84", WGS84_SRS_ID, "EPSG", WGS84_SRS_ID, WGS84_DEFINITION),
+                ],
+            )
+            self.connection.execute(
+                """INSERT OR IGNORE INTO gpkg_contents (table_name, data_type, identifier, srs_id)
+                VALUES (?, 'features', ?, ?)""",
+                (layer, layer, WGS84_SRS_ID),
+            )
+            self.connection.execute(
+                "INSERT OR IGNORE INTO gpkg_geometry_columns VALUES (?, 'geom', 'POLYGON', ?, 0, 0)",
+                (layer, WGS84_SRS_ID),
+            )
+
+    def stored_parameters(self) -> Optional[dict]:
+        row = self.connection.execute(
+            "SELECT parameters FROM pipeline_parameters WHERE layer = ?", (self.layer,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _store_parameters(self, parameters: dict):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO pipeline_parameters VALUES (?, ?)",
+                (self.layer, json.dumps(parameters)),
+            )
+
+    def completed_chunks(self) -> set:
+        return set(
+            self.connection.execute(
+                "SELECT chunk_row, chunk_column FROM pipeline_chunks WHERE layer = ?",
+                (self.layer,),
+            )
+        )
+
+    def read_chunk(self, chunk: Chunk) -> tuple[np.ndarray, list, np.ndarray]:
+        rows = self.connection.execute(
+            f"""SELECT geom, label, score FROM "{self.layer}"
+            WHERE chunk_row = ? AND chunk_column = ? ORDER BY fid""",
+            chunk,
+        ).fetchall()
+        # The envelope of the header holds (min_x, max_x, min_y, max_y).
+        envelopes = np.array(
+            [struct.unpack_from("<4d", geometry, 8) for geometry, _, _ in rows]
+        ).reshape(-1, 4)
+        return (
+            np.array([score for _, _, score in rows], dtype="float32"),
+            [label for _, label, _ in rows],
+            envelopes[:, [0, 2, 1, 3]],
+        )
+
+    def write(
+        self,
+        chunk: Chunk,
+        scores: np.ndarray,
+        labels: list,
+        bounding_boxes: np.ndarray,
+    ):
+        chunk_row, chunk_column = chunk
+        with self.connection:
+            self.connection.executemany(
+                f"""INSERT INTO "{self.layer}" (geom, label, score, chunk_row, chunk_column)
+                VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (_geopackage_polygon(box), label, score, chunk_row, chunk_column)
+                    for box, label, score in zip(
+                        np.asarray(bounding_boxes, dtype=float).tolist(),
+                        labels,
+                        np.asarray(scores, dtype=float).tolist(),
+                    )
+                ],
+            )
+            self.connection.execute(
+                "INSERT INTO pipeline_chunks VALUES (?, ?, ?, ?)",
+                (self.layer, chunk_row, chunk_column, len(labels)),
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class ParquetDetectionWriter(DetectionWriter):
+    """Writes detections into a directory of Parquet files, one per chunk, which Parquet readers load as a single
+    dataset. Each file is written to a temporary file then renamed, so its presence marks the chunk as completed.
+    pyarrow is only imported here, as it is only needed for this output.
+
+    Args:
+        directory (str): path of the output directory, created if it does not exist
+    """
+
+    def __init__(self, directory: str):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow, self.parquet = pyarrow, pyarrow.parquet
+        self.directory: str = directory
+        self.parameters_path: str = os.path.join(directory, "_parameters.json")
+        os.makedirs(directory, exist_ok=True)
+
+    def stored_parameters(self) -> Optional[dict]:
+        if not os.path.exists(self.parameters_path):
+            return None
+        with open(self.parameters_path) as parameters_file:
+            return json.load(parameters_file)
+
+    def _store_parameters(self, parameters: dict):
+        with open(self.parameters_path, "w") as parameters_file:
+            json.dump(parameters, parameters_file)
+
+    def completed_chunks(self) -> set:
+        chunks = set()
+        for file_name in os.listdir(self.directory):
+            name, extension = os.path.splitext(file_name)
+            if extension == ".parquet" and name.startswith("chunk_"):
+                chunk_row, chunk_column = name[len("chunk_") :].split("_")
+                chunks.add((int(chunk_row), int(chunk_column)))
+        return chunks
+
+    def _chunk_path(self, chunk: Chunk) -> str:
+        return os.path.join(self.directory, f"chunk_{chunk[0]}_{chunk[1]}.parquet")
+
+    def read_chunk(self, chunk: Chunk) -> tuple[np.ndarray, list, np.ndarray]:
+        table = self.parquet.read_table(self._chunk_path(chunk))
+        return (
+            table.column("score").to_numpy(),
+            table.column("label").to_pylist(),
+            np.stack(
+                [
+                    table.column(name).to_numpy()
+                    for name in (
+                        "min_longitude",
+                        "min_latitude",
+                        "max_longitude",
+                        "max_latitude",
+                    )
+                ],
+                axis=1,
+            ).reshape(-1, 4),
+        )
+
+    def write(
+        self,
+        chunk: Chunk,
+        scores: np.ndarray,
+        labels: list,
+        bounding_boxes: np.ndarray,
+    ):
+        bounding_boxes = np.asarray(bounding_boxes, dtype="float64").reshape(-1, 4)
+        table = self.pyarrow.table(
+            {
+                "label": self.pyarrow.array(labels, type=self.pyarrow.string()),
+                "score": np.asarray(scores, dtype="float32"),
+                "min_longitude": bounding_boxes[:, 0],
+                "min_latitude": bounding_boxes[:, 1],
+                "max_longitude": bounding_boxes[:, 2],
+                "max_latitude": bounding_boxes[:, 3],
+                "chunk_row": np.full(len(labels), chunk[0], dtype="int32"),
+                "chunk_column": np.full(len(labels), chunk[1], dtype="int32"),
+            }
+        )
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory)
+        os.close(file_descriptor)
+        self.parquet.write_table(table, temporary_path)
+        os.replace(temporary_path, self._chunk_path(chunk))
+
+
+def open_detection_writer(path: str, layer: Optional[str] = None) -> DetectionWriter:
+    """Opens the writer of an output path: a GeoPackage for a .gpkg path, a directory of Parquet files otherwise.
+
+    Args:
+        path (str): path of the output
+        layer (str, optional): layer of the output, e.g. to write several sets of detections to the same output: a
+            layer of the GeoPackage, or a subdirectory of the Parquet directory. Defaults to None (the "detections"
+            layer of a GeoPackage, the Parquet directory itself).
+
+    Raises:
+        ImportError: an error is raised when Parquet files are requested without pyarrow installed
+        ValueError: an error is raised when the layer name of a GeoPackage is not an identifier
+
+    Returns:
+        DetectionWriter: the writer of the output
+    """
+    if os.path.splitext(path)[1].lower() == ".gpkg":
+        return GeoPackageDetectionWriter(path, layer=layer or "detections")
+    return ParquetDetectionWriter(os.path.join(path, layer) if layer else path)
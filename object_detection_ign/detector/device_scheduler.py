@@ -0,0 +1,125 @@
+import time
+import queue
+import numpy as np
+import tflite_runtime.interpreter as tflite
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+
+
+class _Device:
+    """An interpreter bound to a device, with the number of requests assigned to it and its recent latencies."""
+
+    def __init__(self, name: str, interpreter, latency_window: int):
+        self.name: str = name
+        self.interpreter = interpreter
+        self.idle_interpreter: queue.Queue = queue.Queue(maxsize=1)
+        self.idle_interpreter.put(interpreter)
+        self.assigned: int = 0
+        self.checkouts: int = 0
+        self.latencies: deque = deque(maxlen=latency_window)
+
+    @property
+    def mean_latency(self) -> float:
+        return float(np.mean(self.latencies)) if len(self.latencies) else 0.0
+
+
+class DeviceScheduler(InterpreterPool):
+    """A pool of interpreters bound to different devices, such as one interpreter per Edge TPU plus CPU fallbacks.
+    Devices are not interchangeable: a busy Edge TPU may still answer sooner than an idle CPU. Each checkout is
+    therefore assigned to the least-loaded device, i.e. the one with the lowest expected completion time, estimated from
+    the requests already assigned to it and its mean latency over the most recent checkouts. Devices without any
+    measured latency are tried first.
+
+    It can be used wherever an InterpreterPool is expected, and its metrics add the load and latency of each device.
+
+    Args:
+        devices (list): (name, interpreter) pairs, e.g. ("edgetpu:0", interpreter)
+        latency_window (int, optional): number of checkouts used to estimate each device latency. Defaults to 100.
+        wait_time_window (int, optional): number of checkouts used for the waiting time statistics. Defaults to 1000.
+    """
+
+    def __init__(
+        self,
+        devices: list,
+        latency_window: int = 100,
+        wait_time_window: int = 1000,
+    ):
+        super().__init__([interpreter for _, interpreter in devices], wait_time_window)
+        self.devices: list[_Device] = [
+            _Device(name, interpreter, latency_window) for name, interpreter in devices
+        ]
+
+    def _assign_device(self) -> _Device:
+        with self._lock:
+            device = min(
+                self.devices,
+                key=lambda device: (
+                    (device.assigned + 1) * device.mean_latency,
+                    device.assigned,
+                ),
+            )
+            device.assigned += 1
+            self.waiting += 1
+            return device
+
+    @contextmanager
+    def checkout(self, timeout: Optional[float] = None) -> Iterator[tflite.Interpreter]:
+        """Lends the interpreter of the least-loaded device, waiting for it if it is in use.
+
+        Args:
+            timeout (float, optional): maximal waiting time in seconds. Defaults to None (waits indefinitely).
+
+        Raises:
+            queue.Empty: an error is raised when the device did not become available before the timeout
+
+        Yields:
+            tflite.Interpreter: an interpreter reserved for the caller until the end of the context
+        """
+        start = time.perf_counter()
+        device = self._assign_device()
+        try:
+            interpreter = device.idle_interpreter.get(timeout=timeout)
+        except queue.Empty:
+            with self._lock:
+                device.assigned -= 1
+                self.waiting -= 1
+            raise
+        with self._lock:
+            self.waiting -= 1
+            self.in_use += 1
+            self.checkouts += 1
+            device.checkouts += 1
+            self._wait_times.append(time.perf_counter() - start)
+        usage_start = time.perf_counter()
+        try:
+            yield interpreter
+        finally:
+            with self._lock:
+                device.latencies.append(time.perf_counter() - usage_start)
+                device.assigned -= 1
+                self.in_use -= 1
+            device.idle_interpreter.put(interpreter)
+
+    @property
+    def metrics(self) -> dict:
+        """Metrics of the pool, plus the assigned requests, checkouts and mean/p99 latencies in seconds of each device.
+
+        Returns:
+            dict: the InterpreterPool metrics, and a "devices" dict keyed by device name
+        """
+        metrics = super().metrics
+        with self._lock:
+            metrics["devices"] = {
+                device.name: {
+                    "assigned": device.assigned,
+                    "checkouts": device.checkouts,
+                    "mean_latency": device.mean_latency,
+                    "p99_latency": float(np.percentile(device.latencies, 99))
+                    if len(device.latencies)
+                    else 0.0,
+                }
+                for device in self.devices
+            }
+        return metrics
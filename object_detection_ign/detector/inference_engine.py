@@ -0,0 +1,159 @@
+import time
+import queue
+import threading
+import numpy as np
+import picologging as logging
+from concurrent.futures import Future
+from typing import Union
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+from object_detection_ign.detector.input_tensor import (
+    ImageWriter,
+    as_image_writer,
+    invoke_with_writers,
+)
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+
+class BatchedInferenceEngine:
+    """Runs a TFLite object detection model on batches of images gathered from concurrent requests.
+
+    Requests are queued and collected by one worker thread per interpreter of the pool. Each worker checks an
+    interpreter out of the pool for every batch (TFLite interpreters are not thread-safe). A batch is closed as soon as
+    it holds `max_batch_size` images or `max_wait_time` seconds after its first image arrived. The images of a batch are
+    written straight into the input tensor of the interpreter, which runs them in a single invoke when the model accepts
+    a dynamic batch dimension, and image by image otherwise. The outputs are then split back per request.
+    """
+
+    def __init__(
+        self,
+        interpreter_pool: InterpreterPool,
+        max_batch_size: int = 8,
+        max_wait_time: float = 0.005,
+    ):
+        self.interpreter_pool: InterpreterPool = interpreter_pool
+        self.max_batch_size: int = max_batch_size
+        self.max_wait_time: float = max_wait_time
+        with interpreter_pool.checkout() as interpreter:
+            self.supports_batching: bool = (
+                interpreter.get_input_details()[0]["shape_signature"][0] == -1
+            )
+        if not self.supports_batching:
+            logger.warning(
+                "The model has a fixed batch size, batched images will be run one by one."
+            )
+        self._queue: queue.Queue = queue.Queue()
+        self._workers = [
+            threading.Thread(
+                target=self._run, name=f"inference-engine-{i}", daemon=True
+            )
+            for i in range(interpreter_pool.size)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of images waiting to be collected into a batch."""
+        return self._queue.qsize()
+
+    def submit(self, image: Union[np.ndarray, ImageWriter]) -> Future:
+        """Queues an image for inference. An ImageWriter is only called once the batch is assembled, from a worker
+        thread, so the image it writes must stay available until the future resolves.
+
+        Args:
+            image (np.ndarray|ImageWriter): a [1, height, width, 3] image array, or a function writing the image
+
+        Returns:
+            Future: a future resolving to the output dict of the model for this image
+        """
+        future = Future()
+        self._queue.put((as_image_writer(image), future))
+        return future
+
+    def infer(self, image: Union[np.ndarray, ImageWriter]) -> dict:
+        """Runs inference on an image and waits for its results.
+
+        Args:
+            image (np.ndarray|ImageWriter): a [1, height, width, 3] image array, or a function writing the image
+
+        Returns:
+            dict: output dict of the model, with a batch dimension of 1
+        """
+        return self.submit(image).result()
+
+    def close(self):
+        """Stops the worker threads once the queued requests have been processed."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _collect_batch(self) -> list:
+        first_request = self._queue.get()
+        if first_request is None:
+            return []
+        batch = [first_request]
+        deadline = time.perf_counter() + self.max_wait_time
+        while len(batch) < self.max_batch_size:
+            remaining_time = deadline - time.perf_counter()
+            try:
+                request = (
+                    self._queue.get(timeout=remaining_time)
+                    if remaining_time > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _invoke(self, writers: list) -> dict:
+        with self.interpreter_pool.checkout() as interpreter:
+            if self.supports_batching:
+                return invoke_with_writers(interpreter, writers)
+            outputs = [invoke_with_writers(interpreter, [writer]) for writer in writers]
+        return {
+            name: np.concatenate([output[name] for output in outputs])
+            for name in outputs[0]
+        }
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if len(batch) == 0:
+                return
+            writers, futures = zip(*batch)
+            # An image which could not be written only fails its own request: its slot of the batch is left blank.
+            write_errors: list = [None] * len(batch)
+
+            def guard(i: int, writer: ImageWriter) -> ImageWriter:
+                def write(destination: np.ndarray):
+                    try:
+                        writer(destination)
+                    except Exception as e:
+                        destination[...] = 0
+                        # The traceback would keep the destination, a view on the input tensor, alive.
+                        write_errors[i] = e.with_traceback(None)
+
+                return write
+
+            try:
+                outputs = self._invoke(
+                    [guard(i, writer) for i, writer in enumerate(writers)]
+                )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for i, future in enumerate(futures):
+                if write_errors[i] is not None:
+                    future.set_exception(write_errors[i])
+                else:
+                    future.set_result(
+                        {name: value[i : i + 1] for name, value in outputs.items()}
+                    )
@@ -1,11 +1,22 @@
 import tflite_runtime.interpreter as tflite
 import numpy as np
 import picologging as logging
-from PIL import ImageDraw, ImageFont, Image
+from PIL import Image
 
 
 from platform import system
+from functools import lru_cache
+from typing import Optional, Union
 from object_detection_ign.wmts.satellite_view import SatelliteView
+from object_detection_ign.detector.inference_engine import BatchedInferenceEngine
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+from object_detection_ign.detector.device_scheduler import DeviceScheduler
+from object_detection_ign.detector.annotation import AnnotationRenderer
+from object_detection_ign.detector.input_tensor import (
+    ImageWriter,
+    as_image_writer,
+    invoke_with_writers,
+)
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -43,8 +54,96 @@ except ImportError:
 #     return img
 
 
+@lru_cache(maxsize=1)
+def _default_renderer() -> AnnotationRenderer:
+    return AnnotationRenderer()
+
+
+@lru_cache(maxsize=32)
+def _build_class_tables(
+    classes_items: tuple, detection_threshold: float, class_thresholds_items: tuple
+) -> tuple[np.array, np.array]:
+    """Builds the arrays indexed by class value which hold the label and the detection threshold of each class. The
+    background class (0), and the last slot, used for unknown class values, get an infinite threshold so that they are
+    never kept.
+    """
+    classes_dict, class_thresholds = dict(classes_items), dict(class_thresholds_items)
+    labels_lookup = np.empty(max(classes_dict) + 2, dtype=object)
+    thresholds_lookup = np.full(max(classes_dict) + 2, np.inf)
+    for class_value, label in classes_dict.items():
+        labels_lookup[class_value] = label
+        if class_value != 0:
+            thresholds_lookup[class_value] = class_thresholds.get(
+                label, class_thresholds.get(class_value, detection_threshold)
+            )
+    return labels_lookup, thresholds_lookup
+
+
+def filter_batch_predictions(
+    output: dict,
+    classes_dict: dict,
+    detection_threshold=0.1,
+    class_thresholds: Optional[dict] = None,
+    top_k: Optional[int] = None,
+) -> list[tuple[np.array, list, np.array]]:
+    """Filters batched predictions of a tensorflow lite object detection model, of shape [B, N], with boolean masks. Each
+    detection is compared to the threshold of its class, and at most `top_k` detections are kept per image.
+
+    Args:
+        output (dict): output dict of a tensorflow lite model inference.
+        classes_dict (dict): a dictionary containing the label corresponding to each class value.
+        detection_threshold (float, optional): a minimal certainty score required in order to keep a detection in the results. Defaults to 0.1.
+        class_thresholds (dict, optional): thresholds overriding `detection_threshold` for some classes, keyed by label or class value. Defaults to None.
+        top_k (int, optional): maximal number of detections kept per image, by decreasing score. Defaults to None (no limit).
+
+    Returns:
+        list: the (scores, labels, bounding_boxes) of each image of the batch
+    """
+    labels_lookup, thresholds_lookup = _build_class_tables(
+        tuple(sorted(classes_dict.items())),
+        float(detection_threshold),
+        tuple(sorted((class_thresholds or {}).items(), key=str)),
+    )
+    scores = output["output_1"]
+    class_values = output["output_2"].astype(int).reshape(scores.shape)
+    bounding_boxes = output["output_3"].reshape(*scores.shape, 4)
+
+    unknown_class_value = len(labels_lookup) - 1
+    class_values = np.where(
+        (class_values >= 0) & (class_values < unknown_class_value),
+        class_values,
+        unknown_class_value,
+    )
+    kept = scores >= thresholds_lookup[class_values]
+    if top_k is not None and top_k < scores.shape[1]:
+        ranks = np.argsort(
+            np.argsort(-np.where(kept, scores, -np.inf), axis=1, kind="stable"),
+            axis=1,
+            kind="stable",
+        )
+        kept &= ranks < top_k
+
+    batch_idx, detection_idx = np.nonzero(kept)
+    split_points = np.cumsum(kept.sum(axis=1))[:-1]
+    kept_scores = np.split(scores[batch_idx, detection_idx], split_points)
+    kept_labels = np.split(
+        labels_lookup[class_values[batch_idx, detection_idx]], split_points
+    )
+    kept_boxes = np.split(bounding_boxes[batch_idx, detection_idx], split_points)
+    return [
+        (image_scores, image_labels.tolist(), image_boxes)
+        for image_scores, image_labels, image_boxes in zip(
+            kept_scores, kept_labels, kept_boxes
+        )
+    ]
+
+
 def filter_predictions(
-    output: dict, classes_dict: dict, detection_threshold=0.1
+    output: dict,
+    classes_dict: dict,
+    detection_threshold=0.1,
+    class_thresholds: Optional[dict] = None,
+    top_k: Optional[int] = None,
 ) -> tuple[np.array, list, np.array]:
     """Filters the predictions of a tensorflow lite object detection model according to a certain threshold.
 
@@ -52,74 +151,68 @@ def filter_predictions(
         output (dict): output dict of a tensorflow lite model inference.
         classes_dict (dict): a dictionary containing the label corresponding to each class value.
         detection_threshold (float, optional): a minimal certainty score required in order to keep a detection in the results. Defaults to 0.1.
+        class_thresholds (dict, optional): thresholds overriding `detection_threshold` for some classes, keyed by label or class value. Defaults to None.
+        top_k (int, optional): maximal number of detections kept, by decreasing score. Defaults to None (no limit).
 
     Returns:
         scores (np.array): filtered scores
         labels (list): filtered labels
         bounding_boxes (np.array): filtered bounding boxes
     """
-    labels, bounding_boxes, scores = (
-        output["output_2"].astype(int).squeeze(),
-        output["output_3"].squeeze(),
-        output["output_1"].squeeze(),
-    )
-    chosen_idx = [
-        idx
-        for idx, score, label in zip(range(len(scores)), scores, labels)
-        if score >= detection_threshold and label != 0
-    ]
-    scores = scores[chosen_idx]
-    labels = labels[chosen_idx]
-    labels = [classes_dict[label] for label in labels]
-    bounding_boxes = bounding_boxes[chosen_idx]
-    return scores, labels, bounding_boxes
-
+    single_output = {**output, "output_1": np.reshape(output["output_1"], (1, -1))}
+    return filter_batch_predictions(
+        single_output,
+        classes_dict,
+        detection_threshold=detection_threshold,
+        class_thresholds=class_thresholds,
+        top_k=top_k,
+    )[0]
+
+
+def non_max_suppression(
+    bounding_boxes: np.array, scores: np.array, labels, iou_threshold=0.5
+) -> np.array:
+    """Greedy non maximum suppression, performed class by class: a detection is dropped when it overlaps a detection
+    of the same label with a higher score by more than the IoU threshold.
 
-def _draw_bbox(
-    image: Image.Image,
-    bbox: np.array,
-    label: str,
-    score: float,
-    color="orange",
-    use_normalized_coordinates=True,
-):
+    Args:
+        bounding_boxes (np.array): a [N, 4] array of (ymin, xmin, ymax, xmax) boxes
+        scores (np.array): the [N] scores of the detections
+        labels (list|np.array): the [N] labels of the detections
+        iou_threshold (float, optional): maximal intersection over union between two kept detections. Defaults to 0.5.
 
-    font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 15)
-    ymin, xmin, ymax, xmax = (bbox[i] for i in range(0, 4))
-    im_width, im_height = image.size
-    if use_normalized_coordinates:
-        (left, right, top, bottom) = (
-            xmin * im_width,
-            xmax * im_width,
-            ymin * im_height,
-            ymax * im_height,
-        )
-    else:
-        (left, right, top, bottom) = (xmin, xmax, ymin, ymax)
-    text_width, text_height = font.getsize(label)
-    # Each display_str has a top and bottom margin of 0.05x.
-    total_display_str_height = (1 + 2 * 0.05) * text_height
-    if top > total_display_str_height:
-        text_bottom = top
-    else:
-        text_bottom = bottom + total_display_str_height
-    margin = np.ceil(0.01 * text_height)
-
-    draw = ImageDraw.Draw(image)
-    draw.rectangle((left, top, right, bottom), outline="orange", width=2)
-    draw.rectangle(
-        [
-            (left, text_bottom - text_height - 2 * margin),
-            (left + text_width + 2 * margin, text_bottom),
-        ],
-        fill=color,
-    )
-    draw.text(
-        (left + margin, text_bottom - text_height - margin),
-        label + "/" + str(score),
-        fill="black",
-        font=font,
+    Returns:
+        np.array: indices of the kept detections, by decreasing score
+    """
+    if len(scores) == 0:
+        return np.array([], dtype=int)
+    bounding_boxes = np.asarray(bounding_boxes, dtype="float64")
+    # Shifting each class to its own region of the plane prevents boxes of different classes from overlapping.
+    _, class_ids = np.unique(np.asarray(labels), return_inverse=True)
+    bounding_boxes = bounding_boxes + class_ids[:, np.newaxis] * (
+        bounding_boxes.max() - bounding_boxes.min() + 1
     )
+    ymin, xmin, ymax, xmax = bounding_boxes.T
+    areas = (ymax - ymin) * (xmax - xmin)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    kept_idx = []
+    while order.size > 0:
+        best, others = order[0], order[1:]
+        kept_idx.append(best)
+        intersection_height = np.clip(
+            np.minimum(ymax[best], ymax[others]) - np.maximum(ymin[best], ymin[others]),
+            0,
+            None,
+        )
+        intersection_width = np.clip(
+            np.minimum(xmax[best], xmax[others]) - np.maximum(xmin[best], xmin[others]),
+            0,
+            None,
+        )
+        intersection = intersection_height * intersection_width
+        iou = intersection / (areas[best] + areas[others] - intersection)
+        order = others[iou <= iou_threshold]
+    return np.array(kept_idx, dtype=int)
 
 
 def draw_bounding_boxes_on_image(
@@ -127,41 +220,38 @@ def draw_bounding_boxes_on_image(
     boxes: np.array,
     scores=np.array([]),
     labels=np.array([]),
-    color="red",
-    thickness=4,
+    renderer: Optional[AnnotationRenderer] = None,
 ):
     """Draws bounding boxes on image.
     Args:
       image: a PIL.Image object.
       boxes: a 2 dimensional numpy array of [N, 4]: (ymin, xmin, ymax, xmax). The
         coordinates are in normalized format between [0, 1].
-      color: color to draw bounding box. Default is red.
-      thickness: line thickness. Default value is 4.
-      display_str_list_list: list of list of strings. a list of strings for each
-        bounding box. The reason to pass a list of strings for a bounding box is
-        that it might contain multiple labels.
+      scores: scores of the detections.
+      labels: labels of the detections.
+      renderer: the AnnotationRenderer drawing the boxes. Default is a renderer with the
+        default style.
     Raises:
       ValueError: if boxes is not a [N, 4] array
     """
-    boxes_shape = boxes.shape
-    if len(boxes_shape) != 2 or boxes_shape[1] != 4:
-        raise ValueError("Input must be of size [N, 4]")
-    for i in range(boxes_shape[0]):
-        _draw_bbox(
-            image,
-            boxes[i],
-            labels[i],
-            scores[i],
-            color
-            # thickness,
-        )
+    (renderer or _default_renderer()).draw_on_image(image, boxes, scores, labels)
 
 
-def load_coral_tpus(available_driver=AVAILABLE_DRIVER) -> list:
+def load_coral_tpus(
+    available_driver=AVAILABLE_DRIVER, list_devices=None, load_delegate=None
+) -> list:
     """Loads Coral TPUs if they are available on the current platform. If they are not, the inference defaults to CPU inference.
+    Each delegate is bound to its own TPU, so that each one can be given to a different interpreter.
+
+    Args:
+        available_driver (bool, optional): whether the Edge TPU driver is installed. Defaults to AVAILABLE_DRIVER.
+        list_devices (callable, optional): lists the available TPUs, replaced by stand-ins on CI. Defaults to None
+            (pycoral's list_edge_tpus).
+        load_delegate (callable, optional): loads a delegate from a library name and options, replaced by stand-ins on
+            CI. Defaults to None (tflite.load_delegate).
 
     Returns:
-        list: a list of hardware delegates to speed up inference.
+        list: a list of hardware delegates to speed up inference, one per TPU.
     """
 
     platform_dict = {
@@ -171,15 +261,19 @@ def load_coral_tpus(available_driver=AVAILABLE_DRIVER) -> list:
     }
 
     current_system = system()
-    if available_driver:
-        available_tpus = list_edge_tpus()
+    if available_driver or list_devices is not None:
+        list_devices = list_devices or list_edge_tpus
+        load_delegate = load_delegate or tflite.load_delegate
+        available_tpus = list_devices()
         if len(available_tpus) > 0:
             logger.info(f"Found {len(available_tpus)} existing Coral TPU.")
             available_delegates = []
             try:
-                for tpu in available_tpus:
+                for i, tpu in enumerate(available_tpus):
                     available_delegates.append(
-                        tflite.experimental.load_delegate(platform_dict[current_system])
+                        load_delegate(
+                            platform_dict[current_system], {"device": f":{i}"}
+                        )
                     )
             except ValueError as e:
                 logger.critical(f"Error {e} occured. Switching to CPU predictions.")
@@ -195,11 +289,16 @@ def load_coral_tpus(available_driver=AVAILABLE_DRIVER) -> list:
     return available_delegates
 
 
-def load_inference_model(model_path: str) -> tuple[tflite.Interpreter, int, int]:
+def load_inference_model(
+    model_path: str, num_threads: Optional[int] = None, delegates: Optional[list] = None
+) -> tuple[tflite.Interpreter, int, int]:
     """Loads the inference model as a TFLite Interpreter.
 
     Args:
         model_path (str): Filepath of a tensorflow lite object detection model.
+        num_threads (int, optional): number of CPU threads used by the interpreter. Defaults to None (TFLite default).
+        delegates (list, optional): hardware delegates of the interpreter, [] for CPU inference. Defaults to None (every
+            available Coral TPU).
 
     Returns:
         object_detector (tf.lite.Interpreter): a TF Lite Object Detection model.
@@ -208,7 +307,9 @@ def load_inference_model(model_path: str) -> tuple[tflite.Interpreter, int, int]
     """
 
     object_detector = tflite.Interpreter(
-        model_path, experimental_delegates=load_coral_tpus()
+        model_path,
+        experimental_delegates=load_coral_tpus() if delegates is None else delegates,
+        num_threads=num_threads,
     )
     object_detector.allocate_tensors()
 
@@ -220,17 +321,93 @@ def load_inference_model(model_path: str) -> tuple[tflite.Interpreter, int, int]
     return object_detector, input_img_width, input_img_height
 
 
+def load_interpreter_pool(
+    model_path: str,
+    pool_size: int,
+    num_threads: Optional[int] = None,
+    cpu_fallbacks: int = 1,
+    list_devices=None,
+    load_delegate=None,
+) -> tuple[InterpreterPool, int, int]:
+    """Loads the inference model as a pool of TFLite Interpreters, so that several inferences can run in parallel.
+    When Coral TPUs are available, one interpreter is loaded per TPU, plus `cpu_fallbacks` CPU interpreters, and
+    requests are scheduled on the least-loaded device by a DeviceScheduler. Otherwise, `pool_size` CPU interpreters are
+    loaded.
+
+    Args:
+        model_path (str): Filepath of a tensorflow lite object detection model.
+        pool_size (int): number of interpreters in the pool, without Coral TPU.
+        num_threads (int, optional): number of CPU threads used by each interpreter. Defaults to None (TFLite default).
+        cpu_fallbacks (int, optional): number of CPU interpreters added to the Coral TPUs. Defaults to 1.
+        list_devices (callable, optional): lists the available TPUs, see `load_coral_tpus`. Defaults to None.
+        load_delegate (callable, optional): loads a TPU delegate, see `load_coral_tpus`. Defaults to None.
+
+    Returns:
+        interpreter_pool (InterpreterPool): a pool of TF Lite Object Detection models.
+        input_img_width (int): the width of the input inference image.
+        input_img_height (int): the height of the input inference image.
+    """
+    delegates = load_coral_tpus(list_devices=list_devices, load_delegate=load_delegate)
+    device_delegates = [
+        (f"edgetpu:{i}", [delegate]) for i, delegate in enumerate(delegates)
+    ]
+    device_delegates += [
+        (f"cpu:{i}", []) for i in range(cpu_fallbacks if delegates else pool_size)
+    ]
+    devices = []
+    for device_name, interpreter_delegates in device_delegates:
+        object_detector, input_img_width, input_img_height = load_inference_model(
+            model_path, num_threads=num_threads, delegates=interpreter_delegates
+        )
+        devices.append((device_name, object_detector))
+    if delegates:
+        return DeviceScheduler(devices), input_img_width, input_img_height
+    return (
+        InterpreterPool([object_detector for _, object_detector in devices]),
+        input_img_width,
+        input_img_height,
+    )
+
+
+def run_detector(
+    satellite_detector: Union[
+        tflite.Interpreter, InterpreterPool, BatchedInferenceEngine
+    ],
+    image: Union[np.array, ImageWriter],
+) -> dict:
+    """Runs the model on an image, either directly on an interpreter, on an interpreter checked out of a pool, or
+    through a batched inference engine. The image is written straight into the input tensor of the interpreter.
+
+    Args:
+        satellite_detector (tf.lite.Interpreter|InterpreterPool|BatchedInferenceEngine): the model to run
+        image (np.array|ImageWriter): a [1, height, width, 3] image array, or a function writing the image into the
+            [height, width, 3] array it is given
+
+    Returns:
+        dict: output dict of the model
+    """
+    if isinstance(satellite_detector, BatchedInferenceEngine):
+        return satellite_detector.infer(image)
+    if isinstance(satellite_detector, InterpreterPool):
+        with satellite_detector.checkout() as interpreter:
+            return run_detector(interpreter, image)
+    return invoke_with_writers(satellite_detector, [as_image_writer(image)])
+
+
 def perform_inference(
-    satellite_detector: tflite.Interpreter,
+    satellite_detector: Union[
+        tflite.Interpreter, InterpreterPool, BatchedInferenceEngine
+    ],
     satellite_view: SatelliteView,
     classes_dict: dict,
     detection_threshold=0.1,
 ) -> tuple[np.array, list, np.array]:
     """Detect objects on a given picture, filters them according to a thresholds, draws them on the picture and returns scores,
-    labels and bounding boxes. Note : the image is modified in-place and is not returned by the function.
+    labels and bounding boxes. Note : the image is modified in-place and is not returned by the function. Use
+    `detect_objects` to get the detections without drawing them.
 
     Args:
-        satellite_detector (tf.lite.Interpreter): _description_
+        satellite_detector (tf.lite.Interpreter|InterpreterPool|BatchedInferenceEngine): _description_
         satellite_view (SatelliteView): _description_
         classes_dict (dict): _description_
         detection_threshold (float, optional): _description_. Defaults to 0.1.
@@ -240,16 +417,44 @@ def perform_inference(
         labels (list):
         bounding_boxes (np.array):
     """
-    tf_img = satellite_view.image_array.astype("float32")
-    signature = satellite_detector.get_signature_runner()
-    output = signature(images=tf_img)
-    scores, labels, bounding_boxes = filter_predictions(
-        output, classes_dict, detection_threshold=detection_threshold
+    scores, labels, bounding_boxes = detect_objects(
+        satellite_detector,
+        satellite_view,
+        classes_dict,
+        detection_threshold=detection_threshold,
     )
     draw_bounding_boxes_on_image(satellite_view.image, bounding_boxes, scores, labels)
     return scores, labels, bounding_boxes
 
 
+def detect_objects(
+    satellite_detector: Union[
+        tflite.Interpreter, InterpreterPool, BatchedInferenceEngine
+    ],
+    satellite_view: SatelliteView,
+    classes_dict: dict,
+    detection_threshold=0.1,
+) -> tuple[np.array, list, np.array]:
+    """Detect objects on a given picture and filters them according to a threshold, without modifying the picture.
+    The picture is written from its tiles straight into the model input tensor, without building an intermediate image.
+
+    Args:
+        satellite_detector (tf.lite.Interpreter|InterpreterPool|BatchedInferenceEngine): the model to run
+        satellite_view (SatelliteView): a SatelliteView whose image has the model input size
+        classes_dict (dict): a dictionary containing the label corresponding to each class value
+        detection_threshold (float, optional): minimal score of the kept detections. Defaults to 0.1.
+
+    Returns:
+        scores (np.array): filtered scores
+        labels (list): filtered labels
+        bounding_boxes (np.array): filtered (ymin, xmin, ymax, xmax) bounding boxes, normalized between 0 and 1
+    """
+    output = run_detector(satellite_detector, satellite_view.write_image)
+    return filter_predictions(
+        output, classes_dict, detection_threshold=detection_threshold
+    )
+
+
 # def _draw_bounding_box_on_image(
 #     image,
 #     bounding_box,
@@ -0,0 +1,61 @@
+import numpy as np
+import tflite_runtime.interpreter as tflite
+from typing import Callable, Union
+
+# A function writing a [height, width, 3] image into the array it is given, which is a view on a model input tensor.
+ImageWriter = Callable[[np.ndarray], None]
+
+
+def as_image_writer(image: Union[np.ndarray, ImageWriter]) -> ImageWriter:
+    """Wraps an image array into an ImageWriter, so that arrays and writers can be given interchangeably to the model.
+
+    Args:
+        image (np.ndarray|ImageWriter): a [1, height, width, 3] or [height, width, 3] image array, or an ImageWriter
+
+    Returns:
+        ImageWriter: a function copying the image into its destination
+    """
+    if callable(image):
+        return image
+
+    def write_array(destination: np.ndarray):
+        destination[...] = np.reshape(image, destination.shape)
+
+    return write_array
+
+
+def invoke_with_writers(interpreter: tflite.Interpreter, writers: list) -> dict:
+    """Runs the model on a batch of images written straight into its input tensor. The input tensor is only resized when
+    the batch size changes, so consecutive calls reuse the same buffer, and the images are never copied into an
+    intermediate array: each writer fills its slice of the tensor, converting the pixels to the dtype of the model input
+    (float32, or uint8 for quantized models) on the fly.
+
+    Args:
+        interpreter (tf.lite.Interpreter): the interpreter to run, which must not be used by another thread meanwhile
+        writers (list): one ImageWriter per image of the batch
+
+    Returns:
+        dict: output dict of the model, with a batch dimension of len(writers)
+    """
+    signature = interpreter.get_signature_runner()
+    (input_details,) = signature.get_input_details().values()
+    input_shape = [len(writers), *input_details["shape"][1:]]
+    if list(input_details["shape"]) != input_shape:
+        interpreter.resize_tensor_input(input_details["index"], input_shape)
+        interpreter.allocate_tensors()
+    input_tensor = interpreter.tensor(input_details["index"])()
+    # TFLite refuses to invoke while numpy views on its tensors are alive. The traceback of an error raised by a writer
+    # references its frame, and thus its view, so it is stripped: otherwise the interpreter could not run again for as
+    # long as the error is kept, e.g. in a future.
+    try:
+        for i, writer in enumerate(writers):
+            writer(input_tensor[i])
+    except Exception as e:
+        raise e.with_traceback(None)
+    finally:
+        del input_tensor
+    interpreter.invoke()
+    return {
+        name: interpreter.get_tensor(output_details["index"])
+        for name, output_details in signature.get_output_details().items()
+    }
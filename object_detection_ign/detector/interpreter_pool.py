@@ -0,0 +1,84 @@
+import time
+import queue
+import threading
+import numpy as np
+import tflite_runtime.interpreter as tflite
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+class InterpreterPool:
+    """A fixed-size pool of TFLite interpreters loaded from the same model. TFLite interpreters are not thread-safe, so
+    each one is lent to a single caller at a time through `checkout`, and returned to the pool afterwards.
+
+    The pool records how many callers are waiting for an interpreter and how long they waited, in order to tune its
+    size against tail latency.
+    """
+
+    def __init__(self, interpreters: list, wait_time_window: int = 1000):
+        self.interpreters: list = list(interpreters)
+        self._idle_interpreters: queue.Queue = queue.Queue()
+        for interpreter in self.interpreters:
+            self._idle_interpreters.put(interpreter)
+        self._lock = threading.Lock()
+        self._wait_times: deque = deque(maxlen=wait_time_window)
+        self.waiting: int = 0
+        self.in_use: int = 0
+        self.checkouts: int = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.interpreters)
+
+    @contextmanager
+    def checkout(self, timeout: Optional[float] = None) -> Iterator[tflite.Interpreter]:
+        """Lends an idle interpreter, waiting for one to be returned if they are all in use.
+
+        Args:
+            timeout (float, optional): maximal waiting time in seconds. Defaults to None (waits indefinitely).
+
+        Raises:
+            queue.Empty: an error is raised when no interpreter became available before the timeout
+
+        Yields:
+            tflite.Interpreter: an interpreter reserved for the caller until the end of the context
+        """
+        start = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+        try:
+            interpreter = self._idle_interpreters.get(timeout=timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self._wait_times.append(time.perf_counter() - start)
+        try:
+            yield interpreter
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._idle_interpreters.put(interpreter)
+
+    @property
+    def metrics(self) -> dict:
+        """Current state of the pool and statistics on the waiting times of the most recent checkouts.
+
+        Returns:
+            dict: pool size, interpreters in use, queue depth, checkouts count and mean/p99 waiting times in seconds
+        """
+        with self._lock:
+            wait_times = np.array(self._wait_times)
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "queue_depth": self.waiting,
+                "checkouts": self.checkouts,
+                "mean_wait_time": float(wait_times.mean()) if len(wait_times) else 0.0,
+                "p99_wait_time": float(np.percentile(wait_times, 99))
+                if len(wait_times)
+                else 0.0,
+            }
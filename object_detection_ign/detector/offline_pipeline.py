@@ -0,0 +1,592 @@
+"""Offline detection over a local tile archive (MBTiles or GeoPackage), for large areas such as nightly national
+counts, without the HTTP API.
+
+The covered tiles are split into windows of the model input size, on a grid of overlapping windows anchored on the
+tile matrix, and the windows are grouped into square chunks. Chunks are processed by a pool of processes, each one with
+its own interpreter and its own connection to the archive, so throughput grows with the number of cores. In each
+process, a decoding thread reads the tiles and assembles the windows while the inference runs, through a bounded queue.
+The detections of each chunk are written to the output as soon as the chunk is done, with a checkpoint: an interrupted
+run resumes from the chunks it did not complete.
+
+Windows overlap, so that objects cut by a window border are seen whole by a neighbouring window. Instead of merging the
+duplicate detections across chunks, each detection is kept only by the window owning its center: window i of an axis
+owns the pixels from i * stride + overlap / 2 to (i + 1) * stride + overlap / 2, so every pixel has exactly one owner.
+
+Usage, from the root of the repository:
+    python -m object_detection_ign.detector.offline_pipeline france.mbtiles detections.gpkg --workers 8
+    python -m object_detection_ign.detector.offline_pipeline paris.gpkg detections/ --bbox 2.22 48.81 2.47 48.91
+"""
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import functools
+import numpy as np
+import multiprocessing
+import picologging as logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Iterator, Optional
+from starlite import State
+
+from object_detection_ign.api.api_configuration import set_state_on_startup
+from object_detection_ign.detector.area_scan import SlidingWindowReader
+from object_detection_ign.detector.detection_writers import (
+    Chunk,
+    DetectionWriter,
+    open_detection_writer,
+)
+from object_detection_ign.detector.inference_helpers import (
+    filter_predictions,
+    load_inference_model,
+    run_detector,
+)
+from object_detection_ign.wmts.satellite_view import WMTSClient
+from object_detection_ign.wmts.tile_seeding import read_geojson_polygons
+from object_detection_ign.wmts.tile_sources import open_tile_source
+from object_detection_ign.wmts.utils import (
+    TILE_SIZE,
+    compute_covering_tiles,
+    tile_positions_to_coordinates,
+)
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+CONFIG_FILE_PATH = "config/api_config.toml"
+
+
+def load_cpu_interpreter(model_path: str, num_threads: int = 1):
+    """Loads the model on the CPU, the interpreter factory of the pipeline workers. Edge TPUs cannot be shared between
+    processes, so the workers do not claim them."""
+    return load_inference_model(model_path, num_threads=num_threads, delegates=[])[0]
+
+
+def _tile_keys(tiles: np.ndarray, zoom_level: int) -> np.ndarray:
+    """Numbers the tiles of a zoom level in row-major order, so that sets of tiles are compared as integer arrays."""
+    tiles = np.asarray(tiles, dtype="int64").reshape(-1, 2)
+    return tiles[:, 0] * 2**zoom_level + tiles[:, 1]
+
+
+def _owned_windows(tiles: np.ndarray, stride: int, half_overlap: int) -> tuple:
+    """Finds the windows owning the pixels of some tiles, along both axes. Window 0 also owns the first pixels of an
+    axis, which no window would own otherwise.
+
+    Returns:
+        first_windows (np.ndarray): a [N, 2] array of the (window row, window column) owning the top left pixel of
+            each tile
+        last_windows (np.ndarray): a [N, 2] array of the (window row, window column) owning its bottom right pixel
+    """
+    first_windows = np.maximum((tiles * TILE_SIZE - half_overlap) // stride, 0)
+    last_windows = np.maximum(((tiles + 1) * TILE_SIZE - 1 - half_overlap) // stride, 0)
+    return first_windows, last_windows
+
+
+def plan_chunks(
+    tiles: np.ndarray, window_size: int, overlap: int, chunk_windows: int
+) -> dict:
+    """Lists the windows owning the pixels of some tiles, grouped into chunks of `chunk_windows` * `chunk_windows`
+    windows. Window (i, j) has its top left pixel at (i * stride, j * stride), with stride = window_size - overlap.
+
+    Args:
+        tiles (np.ndarray): a [N, 2] array of the (tile row, tile column) to process
+        window_size (int): width and height of the windows in pixels, i.e. of the model input images
+        overlap (int): number of pixels shared by two neighbouring windows
+        chunk_windows (int): number of windows along each side of a chunk
+
+    Returns:
+        dict: for each (chunk row, chunk column), a [M, 2] array of the (window row, window column) of its windows, in
+            row-major order, and a [K, 2] array of the tiles whose pixels are owned by its windows, in the order of
+            `tiles`
+    """
+    tiles = np.asarray(tiles, dtype="int64").reshape(-1, 2)
+    if len(tiles) == 0:
+        return {}
+    stride, half_overlap = window_size - overlap, overlap // 2
+    first_windows, last_windows = _owned_windows(tiles, stride, half_overlap)
+    spans = last_windows - first_windows + 1
+    # A tile is owned by a few windows along each axis: the (tile, window) pairs are listed one offset at a time.
+    tile_indices, windows = [], []
+    for row_offset in range(spans[:, 0].max()):
+        for column_offset in range(spans[:, 1].max()):
+            indices = np.flatnonzero(
+                (row_offset < spans[:, 0]) & (column_offset < spans[:, 1])
+            )
+            tile_indices.append(indices)
+            windows.append(first_windows[indices] + [row_offset, column_offset])
+    tile_indices, windows = np.concatenate(tile_indices), np.concatenate(windows)
+    chunk_positions = windows // chunk_windows
+    # The pairs are sorted by chunk then by window, and by chunk then by tile, so that each chunk is a slice of both.
+    window_order = np.lexsort(
+        (windows[:, 1], windows[:, 0], chunk_positions[:, 1], chunk_positions[:, 0])
+    )
+    tile_order = np.lexsort(
+        (tile_indices, chunk_positions[:, 1], chunk_positions[:, 0])
+    )
+    windows, chunk_positions, tile_indices = (
+        windows[window_order],
+        chunk_positions[window_order],
+        tile_indices[tile_order],
+    )
+    chunk_starts = np.flatnonzero(
+        np.any(np.diff(chunk_positions, axis=0, prepend=-1) != 0, axis=1)
+    )
+    # A window owning several tiles, and a tile owned by several windows of a chunk, are listed once.
+    kept_windows = np.any(np.diff(windows, axis=0, prepend=-1) != 0, axis=1)
+    kept_tiles = np.diff(tile_indices, prepend=-1) != 0
+    kept_tiles[chunk_starts] = True
+    return {
+        tuple(chunk): (owned_windows, covered_tiles)
+        for chunk, owned_windows, covered_tiles in zip(
+            chunk_positions[chunk_starts].tolist(),
+            np.split(
+                windows[kept_windows], np.cumsum(kept_windows)[chunk_starts[1:] - 1]
+            ),
+            np.split(
+                tiles[tile_indices[kept_tiles]],
+                np.cumsum(kept_tiles)[chunk_starts[1:] - 1],
+            ),
+        )
+    }
+
+
+def filter_area_tiles(
+    tiles: np.ndarray, matrix_index, zoom_level: int, areas: Optional[list]
+) -> np.ndarray:
+    """Keeps the tiles covering some areas.
+
+    Args:
+        tiles (np.ndarray): a [N, 2] array of (tile row, tile column)
+        matrix_index (TileMatrixIndex): the index of the tile matrices
+        zoom_level (int): zoom level of the tiles
+        areas (list, optional): bounding boxes or polygons, as accepted by `compute_covering_tiles`. None keeps every
+            tile.
+
+    Returns:
+        np.ndarray: the tiles covering the areas, in their original order
+    """
+    tiles = np.asarray(tiles, dtype="int64").reshape(-1, 2)
+    if not areas:
+        return tiles
+    area_tiles = np.concatenate(
+        [compute_covering_tiles(matrix_index, zoom_level, area) for area in areas]
+    )
+    return tiles[
+        np.isin(_tile_keys(tiles, zoom_level), _tile_keys(area_tiles, zoom_level))
+    ]
+
+
+# State of the current pipeline worker process, set up once by `_initialize_worker`.
+_worker: dict = {}
+
+
+def _initialize_worker(
+    tile_source_path: str,
+    layer: str,
+    zoom_level: int,
+    window_size: int,
+    overlap: int,
+    interpreter_factory: Callable,
+    classes_dict: dict,
+    detection_threshold: float,
+    queue_size: int,
+    max_cached_tiles: int,
+):
+    interpreter = interpreter_factory()
+    input_shape = interpreter.get_input_details()[0]["shape_signature"][1:3]
+    if tuple(input_shape) != (window_size, window_size):
+        raise ValueError(
+            f"The model input size {tuple(input_shape)} is not the window size {window_size}."
+        )
+    wmts_client = WMTSClient(
+        url="",
+        correspondance_table_path="",
+        correspondance_table_url="",
+        tile_source=open_tile_source(tile_source_path, layer=layer),
+    )
+    _worker.update(
+        interpreter=interpreter,
+        wmts_client=wmts_client,
+        layer=layer,
+        zoom_level=zoom_level,
+        window_size=window_size,
+        overlap=overlap,
+        classes_dict=classes_dict,
+        detection_threshold=detection_threshold,
+        queue_size=queue_size,
+        max_cached_tiles=max_cached_tiles,
+    )
+
+
+def _detect_chunk(
+    chunk: Chunk, windows: np.ndarray, covered_tiles: np.ndarray
+) -> tuple:
+    """Runs the model over the windows of a chunk, in a worker process. The windows are assembled by a decoding thread
+    while the model runs on the previous ones, at most `queue_size` windows ahead. Only the detections owned by their
+    window, whose center lies in a covered tile, are kept.
+
+    Returns:
+        tuple: the chunk, the scores, labels and (min_longitude, min_latitude, max_longitude, max_latitude) bounding
+            boxes of its detections, and the number of tiles missing from the archive
+    """
+    window_size, overlap = _worker["window_size"], _worker["overlap"]
+    stride = window_size - overlap
+    covered_keys = _tile_keys(covered_tiles, _worker["zoom_level"])
+    reader = SlidingWindowReader(
+        _worker["wmts_client"],
+        _worker["layer"],
+        _worker["zoom_level"],
+        window_size,
+        max_cached_tiles=_worker["max_cached_tiles"],
+        fill_missing_tiles=True,
+    )
+    assembled_windows: queue.Queue = queue.Queue(maxsize=_worker["queue_size"])
+    stop_decoding = threading.Event()
+
+    def put(item: tuple) -> bool:
+        # Once the inference stopped, nothing reads the queue anymore: waiting for room would never end.
+        while not stop_decoding.is_set():
+            try:
+                assembled_windows.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decode_windows():
+        try:
+            for window in windows.tolist():
+                image = np.empty((1, window_size, window_size, 3), dtype="uint8")
+                reader.write(image[0], window[0] * stride, window[1] * stride)
+                if not put((window, image)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    decoding_thread = threading.Thread(target=decode_windows, daemon=True)
+    decoding_thread.start()
+    chunk_scores, chunk_labels, chunk_boxes = [], [], []
+    try:
+        while True:
+            window, image = assembled_windows.get()
+            if window is None:
+                if image is not None:
+                    raise image
+                break
+            output = run_detector(_worker["interpreter"], image)
+            scores, labels, bounding_boxes = filter_predictions(
+                output,
+                _worker["classes_dict"],
+                detection_threshold=_worker["detection_threshold"],
+            )
+            pixel_boxes = (
+                np.reshape(bounding_boxes, (-1, 4)) * window_size
+                + [
+                    window[0] * stride,
+                    window[1] * stride,
+                ]
+                * 2
+            )
+            centers = (pixel_boxes[:, :2] + pixel_boxes[:, 2:]) / 2
+            owned = np.all(
+                np.maximum((centers - overlap // 2) // stride, 0) == window, axis=1
+            )
+            owned &= np.isin(
+                _tile_keys(centers // TILE_SIZE, _worker["zoom_level"]), covered_keys
+            )
+            chunk_scores.append(np.asarray(scores)[owned])
+            chunk_labels += [label for label, keep in zip(labels, owned) if keep]
+            chunk_boxes.append(pixel_boxes[owned])
+    finally:
+        stop_decoding.set()
+        decoding_thread.join()
+
+    scores = np.concatenate(chunk_scores) if chunk_scores else np.array([])
+    pixel_boxes = (
+        np.concatenate(chunk_boxes) / TILE_SIZE if chunk_boxes else np.zeros((0, 4))
+    )
+    matrix_index, zoom_level = (
+        _worker["wmts_client"].matrix_index,
+        _worker["zoom_level"],
+    )
+    min_longitudes, max_latitudes = tile_positions_to_coordinates(
+        matrix_index, zoom_level, pixel_boxes[:, 0], pixel_boxes[:, 1]
+    )
+    max_longitudes, min_latitudes = tile_positions_to_coordinates(
+        matrix_index, zoom_level, pixel_boxes[:, 2], pixel_boxes[:, 3]
+    )
+    bounding_boxes = np.stack(
+        [min_longitudes, min_latitudes, max_longitudes, max_latitudes], axis=1
+    )
+    return (
+        chunk,
+        scores,
+        chunk_labels,
+        bounding_boxes,
+        reader.missing_tiles,
+    )
+
+
+def detect_chunks(
+    tile_source_path: str,
+    layer: str,
+    zoom_level: int,
+    chunks: dict,
+    interpreter_factory: Callable,
+    classes_dict: dict,
+    workers: Optional[int] = None,
+    window_size: int = 640,
+    overlap: int = 128,
+    chunk_windows: int = 8,
+    detection_threshold: float = 0.1,
+    queue_size: int = 4,
+) -> Iterator[tuple]:
+    """Runs the model over chunks of a local tile archive with a pool of processes, and yields the detections of each
+    chunk as soon as it is done, in no particular order.
+
+    Args:
+        tile_source_path (str): path of an MBTiles or GeoPackage tile archive
+        layer (str): name of the layer of the archive
+        zoom_level (int): zoom level of the tiles
+        chunks (dict): the chunks to process, as planned by `plan_chunks`
+        interpreter_factory (callable): loads the model in each worker process. It must be picklable.
+        classes_dict (dict): a dictionary containing the label corresponding to each class value
+        workers (int, optional): number of worker processes. Defaults to None (the number of CPUs).
+        window_size (int, optional): width and height of the model input images. Defaults to 640.
+        overlap (int, optional): number of pixels shared by two neighbouring windows. Defaults to 128.
+        chunk_windows (int, optional): number of windows along each side of a chunk. Defaults to 8.
+        detection_threshold (float, optional): minimal score of the kept detections. Defaults to 0.1.
+        queue_size (int, optional): number of windows assembled ahead of the inference in each worker. Defaults to 4.
+
+    Yields:
+        tuple: the chunk, the scores, labels and (min_longitude, min_latitude, max_longitude, max_latitude) bounding
+            boxes of its detections, and the number of tiles missing from the archive
+    """
+    if not chunks:
+        return
+    workers = workers or os.cpu_count()
+    # Processes are spawned rather than forked, so that they do not inherit the threads and connections of the caller.
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_initialize_worker,
+        initargs=(
+            tile_source_path,
+            layer,
+            zoom_level,
+            window_size,
+            overlap,
+            interpreter_factory,
+            classes_dict,
+            detection_threshold,
+            queue_size,
+            max(32, 4 * chunk_windows * (window_size // TILE_SIZE + 2)),
+        ),
+    ) as executor:
+        remaining_chunks, running = iter(chunks.items()), set()
+        while True:
+            # At most two chunks per worker are queued, so that results are written as they come.
+            for chunk, (windows, covered_tiles) in remaining_chunks:
+                running.add(
+                    executor.submit(_detect_chunk, chunk, windows, covered_tiles)
+                )
+                if len(running) >= 2 * workers:
+                    break
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def run_pipeline(
+    tile_source_path: str,
+    writer: DetectionWriter,
+    layer: str,
+    zoom_level: int,
+    interpreter_factory: Callable,
+    classes_dict: dict,
+    areas: Optional[list] = None,
+    workers: Optional[int] = None,
+    window_size: int = 640,
+    overlap: int = 128,
+    chunk_windows: int = 8,
+    detection_threshold: float = 0.1,
+    queue_size: int = 4,
+    progress_interval: float = 10.0,
+) -> dict:
+    """Detects objects over the tiles of a local tile archive, or over the tiles of some areas it holds, with a pool of
+    processes, and writes the detections of each chunk as soon as it is done. Chunks already written are skipped.
+
+    Args:
+        tile_source_path (str): path of an MBTiles or GeoPackage tile archive
+        writer (DetectionWriter): the writer of the detections, which is also the checkpoint of the run
+        layer (str): name of the layer of the archive
+        zoom_level (int): zoom level of the tiles
+        interpreter_factory (callable): loads the model in each worker process, e.g.
+            functools.partial(load_cpu_interpreter, model_path). It must be picklable.
+        classes_dict (dict): a dictionary containing the label corresponding to each class value
+        areas (list, optional): bounding boxes or polygons, as accepted by `compute_covering_tiles`. Defaults to None
+            (every tile of the archive at this zoom level).
+        workers (int, optional): number of worker processes. Defaults to None (the number of CPUs).
+        window_size (int, optional): width and height of the model input images. Defaults to 640.
+        overlap (int, optional): number of pixels shared by two neighbouring windows. Defaults to 128.
+        chunk_windows (int, optional): number of windows along each side of a chunk. Defaults to 8.
+        detection_threshold (float, optional): minimal score of the kept detections. Defaults to 0.1.
+        queue_size (int, optional): number of windows assembled ahead of the inference in each worker. Defaults to 4.
+        progress_interval (float, optional): time between two progress reports, in seconds. Defaults to 10.
+
+    Raises:
+        ValueError: an error is raised when the output holds a run with other parameters
+
+    Returns:
+        dict: the number of processed chunks, tiles, missing tiles and detections, the duration in seconds and the
+            throughput in tiles per second
+    """
+    tile_source = open_tile_source(tile_source_path, layer=layer)
+    tiles = filter_area_tiles(
+        tile_source.list_tiles(layer, zoom_level),
+        tile_source.matrix_index,
+        zoom_level,
+        areas,
+    )
+    tile_source.close()
+    writer.check_parameters(
+        {
+            "layer": layer,
+            "zoom_level": zoom_level,
+            "areas": areas,
+            "window_size": window_size,
+            "overlap": overlap,
+            "chunk_windows": chunk_windows,
+            "detection_threshold": detection_threshold,
+        }
+    )
+    chunks = plan_chunks(tiles, window_size, overlap, chunk_windows)
+    completed_chunks = writer.completed_chunks()
+    pending_chunks = [
+        chunk for chunk in sorted(chunks) if chunk not in completed_chunks
+    ]
+    logger.info(
+        f"{len(tiles)} tiles in {len(chunks)} chunks, {len(chunks) - len(pending_chunks)} chunks already done."
+    )
+
+    progress = {"chunks": 0, "tiles": 0, "missing_tiles": 0, "detections": 0}
+    # Tiles cut by a chunk border are covered by several chunks, they are counted once. The tiles are listed in
+    # row-major order, so their keys are sorted and the covered tiles of a chunk are found by binary search.
+    tile_keys = _tile_keys(tiles, zoom_level)
+    processed_tiles = np.zeros(len(tiles), dtype=bool)
+    start = last_report = time.perf_counter()
+    for chunk, scores, labels, bounding_boxes, missing_tiles in detect_chunks(
+        tile_source_path,
+        layer,
+        zoom_level,
+        {chunk: chunks[chunk] for chunk in pending_chunks},
+        interpreter_factory,
+        classes_dict,
+        workers=workers,
+        window_size=window_size,
+        overlap=overlap,
+        chunk_windows=chunk_windows,
+        detection_threshold=detection_threshold,
+        queue_size=queue_size,
+    ):
+        writer.write(chunk, scores, labels, bounding_boxes)
+        covered_tiles = np.searchsorted(
+            tile_keys, _tile_keys(chunks[chunk][1], zoom_level)
+        )
+        progress["chunks"] += 1
+        progress["tiles"] += int(np.count_nonzero(~processed_tiles[covered_tiles]))
+        processed_tiles[covered_tiles] = True
+        progress["missing_tiles"] += missing_tiles
+        progress["detections"] += len(labels)
+        now = time.perf_counter()
+        if now - last_report >= progress_interval:
+            last_report = now
+            logger.info(
+                f"Processed {progress['chunks']}/{len(pending_chunks)} chunks, "
+                f"{progress['tiles'] / (now - start):.1f} tiles/s, {progress['detections']} detections."
+            )
+    progress["duration"] = time.perf_counter() - start
+    progress["tiles_per_second"] = progress["tiles"] / progress["duration"]
+    return progress
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("tile_source", help="path of an MBTiles or GeoPackage file")
+    parser.add_argument(
+        "output", help="a .gpkg GeoPackage, or a directory of Parquet files"
+    )
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("MIN_LONGITUDE", "MIN_LATITUDE", "MAX_LONGITUDE", "MAX_LATITUDE"),
+    )
+    region.add_argument("--geojson", help="path of a GeoJSON file of polygons")
+    parser.add_argument(
+        "--layer", default=None, help="layer of the archive, its only layer by default"
+    )
+    parser.add_argument("--zoom-level", type=int, default=19)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--overlap", type=int, default=128)
+    parser.add_argument("--chunk-windows", type=int, default=8)
+    parser.add_argument("--detection-threshold", type=float, default=0.1)
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    parser.add_argument("--config", default=CONFIG_FILE_PATH)
+    arguments = parser.parse_args(arguments)
+    logger.setLevel(logging.INFO)
+
+    state = State({"config_file_path": arguments.config})
+    set_state_on_startup(state)
+    tile_source = open_tile_source(arguments.tile_source, layer=arguments.layer)
+    if arguments.layer is None and len(tile_source.layers) > 1:
+        parser.error(f"Choose a layer among {tile_source.layers}.")
+    layer = arguments.layer or tile_source.layers[0]
+    if layer not in tile_source.layers:
+        parser.error(f"Unavailable layer: {layer}.")
+    tile_source.close()
+    _, window_width, window_height = load_inference_model(
+        state.MODEL_PATH, num_threads=1, delegates=[]
+    )
+    writer = open_detection_writer(arguments.output)
+    try:
+        progress = run_pipeline(
+            arguments.tile_source,
+            writer,
+            layer,
+            arguments.zoom_level,
+            functools.partial(
+                load_cpu_interpreter, state.MODEL_PATH, arguments.threads_per_worker
+            ),
+            state.CLASSES_DICT,
+            areas=[tuple(arguments.bbox)]
+            if arguments.bbox
+            else read_geojson_polygons(arguments.geojson)
+            if arguments.geojson
+            else None,
+            workers=arguments.workers,
+            window_size=int(window_width),
+            overlap=arguments.overlap,
+            chunk_windows=arguments.chunk_windows,
+            detection_threshold=arguments.detection_threshold,
+            progress_interval=arguments.progress_interval,
+        )
+    finally:
+        writer.close()
+    logger.info(
+        f"Processed {progress['chunks']} chunks ({progress['tiles']} tiles, {progress['missing_tiles']} missing) in "
+        f"{progress['duration']:.1f} s, {progress['tiles_per_second']:.1f} tiles/s, "
+        f"{progress['detections']} detections."
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,214 @@
+import re
+import time
+import anyio
+import sqlite3
+import asyncio
+import threading
+import unicodedata
+from typing import Optional, Union
+
+GeocodingResult = tuple[Union[float, None], Union[float, None], bool]
+
+
+def normalize_address(address: str) -> str:
+    """Normalizes a postal address so that trivial variations of the same address share a cache entry: unicode
+    normalization, case folding, and whitespace collapsed and trimmed around commas.
+
+    Args:
+        address (str): postal address of the location
+
+    Returns:
+        str: the normalized address
+    """
+    address = unicodedata.normalize("NFKC", address).casefold()
+    address = re.sub(r"\s*,\s*", ", ", address)
+    return re.sub(r"\s+", " ", address).strip(" ,")
+
+
+class GeocodingCache:
+    """A cache of reverse geocoding results keyed by normalized address. Results are kept in memory and, when a file
+    path is given, persisted in a SQLite database shared by every worker. Addresses which were not found are cached as
+    well, with their own (usually shorter) time to live.
+    """
+
+    def __init__(
+        self,
+        database_path: Optional[str] = None,
+        ttl: float = 30 * 24 * 3600,
+        not_found_ttl: float = 24 * 3600,
+    ):
+        self.database_path: Optional[str] = database_path
+        self.ttl: float = ttl
+        self.not_found_ttl: float = not_found_ttl
+        self.hits, self.misses = 0, 0
+        self._results: dict[str, tuple[GeocodingResult, float]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if database_path:
+            with self._connection() as connection:
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS geocoding (
+                        address TEXT PRIMARY KEY, latitude REAL, longitude REAL, found INTEGER, stored_at REAL
+                    )"""
+                )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the SQLite connection of the current thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @property
+    def stats(self) -> dict:
+        """Hit and miss counters of the cache, for the current process.
+
+        Returns:
+            dict: the number of hits, misses and results held in memory
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_entries": len(self._results),
+        }
+
+    def _is_fresh(self, result: GeocodingResult, stored_at: float) -> bool:
+        ttl = self.ttl if result[2] else self.not_found_ttl
+        return time.time() - stored_at < ttl
+
+    def get(self, address: str, count_miss: bool = True) -> Optional[GeocodingResult]:
+        """Looks up the geocoding result of an address.
+
+        Args:
+            address (str): postal address of the location
+            count_miss (bool, optional): whether a miss is counted, False when the address is looked up again after a
+                miss. Defaults to True.
+
+        Returns:
+            GeocodingResult|None: (latitude, longitude, found_coordinates) if a fresh result is cached, None otherwise
+        """
+        key = normalize_address(address)
+        with self._lock:
+            cached = self._results.get(key)
+        if cached is None and self.database_path:
+            row = (
+                self._connection()
+                .execute(
+                    "SELECT latitude, longitude, found, stored_at FROM geocoding WHERE address = ?",
+                    (key,),
+                )
+                .fetchone()
+            )
+            if row is not None:
+                latitude, longitude, found, stored_at = row
+                cached = ((latitude, longitude, bool(found)), stored_at)
+        with self._lock:
+            if cached is not None and self._is_fresh(*cached):
+                self._results[key] = cached
+                self.hits += 1
+                return cached[0]
+            if count_miss:
+                self.misses += 1
+        return None
+
+    def put(self, address: str, result: GeocodingResult):
+        """Stores the geocoding result of an address.
+
+        Args:
+            address (str): postal address of the location
+            result (GeocodingResult): (latitude, longitude, found_coordinates)
+        """
+        key, stored_at = normalize_address(address), time.time()
+        with self._lock:
+            self._results[key] = (result, stored_at)
+        if self.database_path:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO geocoding VALUES (?, ?, ?, ?, ?)",
+                    (key, result[0], result[1], int(result[2]), stored_at),
+                )
+
+
+class RateLimiter:
+    """Spaces out calls so that at most `rate` calls per second are made. Each caller reserves the next free time slot,
+    then waits until it, either blocking its thread or asynchronously.
+
+    Without a database, the slots are reserved within the current process. With a SQLite database, e.g. the one of the
+    geocoding cache, the next free slot is stored in it and reserved in an immediate transaction, so that the rate is
+    shared by every worker using the same database.
+
+    Args:
+        rate (float, optional): maximal number of calls per second. Defaults to 1.
+        database_path (str, optional): path of the SQLite database holding the next free slot. Defaults to None (the
+            slots are reserved in memory).
+    """
+
+    def __init__(self, rate: float = 1.0, database_path: Optional[str] = None):
+        self.interval: float = 1 / rate
+        self.database_path: Optional[str] = database_path
+        self._next_slot: float = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if database_path:
+            self._connection().execute(
+                """CREATE TABLE IF NOT EXISTS rate_limit (
+                    id INTEGER PRIMARY KEY CHECK (id = 0), next_slot REAL NOT NULL
+                )"""
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the SQLite connection of the current thread, opening it on first use. Transactions are explicit."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.database_path, timeout=30, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def reserve(self) -> float:
+        """Reserves the next free time slot.
+
+        Returns:
+            float: the time to wait until the reserved slot, in seconds
+        """
+        with self._lock:
+            if not self.database_path:
+                now = time.monotonic()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + self.interval
+                return slot - now
+            # Workers only share the wall clock.
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = connection.execute(
+                    "SELECT next_slot FROM rate_limit WHERE id = 0"
+                ).fetchone()
+                slot = max(now, row[0] if row else 0.0)
+                connection.execute(
+                    "INSERT OR REPLACE INTO rate_limit VALUES (0, ?)",
+                    (slot + self.interval,),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            return slot - now
+
+    def wait(self):
+        """Blocks until the caller is allowed to perform its call."""
+        time.sleep(self.reserve())
+
+    async def async_wait(self):
+        """Waits asynchronously until the caller is allowed to perform its call."""
+        delay = (
+            await anyio.to_thread.run_sync(self.reserve)
+            if self.database_path
+            else self.reserve()
+        )
+        await asyncio.sleep(delay)
@@ -1,14 +1,35 @@
 import os
 import io
-import pandas as pd
+import time
 import numpy as np
+import httpx
+import anyio
+import asyncio
 import requests
-from typing import Union
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
+from typing import Optional, Union
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from owslib.wmts import WebMapTileService, TileMatrixSet
 import picologging as logging
-from object_detection_ign.wmts.utils import compute_tile_position
-from tqdm import trange
+from object_detection_ign.wmts.tile_cache import TileCache
+from object_detection_ign.wmts.tile_sources import TileSource
+from object_detection_ign.wmts.geocoding import (
+    GeocodingCache,
+    RateLimiter,
+    normalize_address,
+)
+from object_detection_ign.wmts.utils import (
+    TILE_SIZE,
+    TileMatrixIndex,
+    compute_fractional_tile_positions,
+    compute_tile_position,
+    paste_tiles,
+    tile_positions_to_coordinates,
+    window_tile_positions,
+)
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -16,7 +37,11 @@ logger = logging.getLogger()
 
 class SatelliteView:
     """A representation of a given location on Earth. It is represented by a latitude, a longitude, a zoom level and an image of the local zone.
-    It is generated by a WMTS Client.
+    It is generated by a WMTS Client. The position of the image on the tile grid is kept in `tile_origin`, as the (row, column)
+    of its top left pixel expressed in tiles, so that pixels of the image can be located on Earth.
+    The image is kept as the decoded tiles it overlaps (`tile_arrays`) and its pixel window on the tile grid
+    (`pixel_window`), so that it can be written straight into a model input tensor by `write_image`. The PIL image is
+    only assembled when `image` is accessed, e.g. to draw the detections.
     """
 
     def __init__(self):
@@ -24,8 +49,49 @@ class SatelliteView:
         self.longitude = 0.0
         self.zoom_level = 0
         self.address = None
-        self.image: Image.Image = None
         self.found_coordinates: bool = False
+        self.tile_origin: tuple[float, float] = None
+        self.tile_arrays: dict[tuple[int, int], np.ndarray] = {}
+        self.pixel_window: tuple[int, int, int, int] = None
+        self._image: Image.Image = None
+
+    @property
+    def image(self) -> Image.Image:
+        if self._image is None and self.pixel_window is not None:
+            image_array = np.empty((*self.pixel_window[2:], 3), dtype="uint8")
+            self.write_image(image_array)
+            self._image = Image.fromarray(image_array)
+        return self._image
+
+    @image.setter
+    def image(self, image: Image.Image):
+        self._image = image
+        self.tile_arrays, self.pixel_window = {}, None
+
+    @property
+    def size(self) -> tuple[int, int]:
+        """(width, height) of the image, without assembling it."""
+        if self._image is None and self.pixel_window is not None:
+            return self.pixel_window[3], self.pixel_window[2]
+        return self.image.size
+
+    def write_image(self, destination: np.ndarray):
+        """Writes the image into a [height, width, 3] array, such as a view on a model input tensor. When the image is
+        still kept as tiles, they are copied directly to their place, converted to the dtype of the destination.
+
+        Args:
+            destination (np.ndarray): the array to fill
+        """
+        if self._image is None and self.pixel_window is not None:
+            pixel_row, pixel_column = self.pixel_window[:2]
+            paste_tiles(
+                destination,
+                lambda tile_row, tile_column: self.tile_arrays[(tile_row, tile_column)],
+                pixel_row,
+                pixel_column,
+            )
+        else:
+            destination[...] = np.asarray(self.image)
 
     def show_image(self):
         """Shows the image."""
@@ -33,11 +99,42 @@ class SatelliteView:
 
     @property
     def image_array(self):
-        temp_array = np.array(self.image)
-        array_shape = temp_array.shape
-        temp_array = np.reshape(temp_array, [1, array_shape[0], array_shape[1], 3])
+        width, height = self.size
+        temp_array = np.empty([1, height, width, 3], dtype="uint8")
+        self.write_image(temp_array[0])
         return temp_array
 
+    def boxes_to_coordinates(
+        self,
+        bounding_boxes: np.array,
+        matrix_set: Union[TileMatrixSet, TileMatrixIndex],
+    ) -> np.array:
+        """Projects bounding boxes of the image back to GPS coordinates, through the tile grid.
+
+        Args:
+            bounding_boxes (np.array): a [N, 4] array of (ymin, xmin, ymax, xmax) boxes, normalized between 0 and 1
+            matrix_set (TileMatrixSet|TileMatrixIndex): the WMTS matrix set the image was fetched from, or its index
+
+        Returns:
+            np.array: a [N, 4] array of (min_longitude, min_latitude, max_longitude, max_latitude) boxes
+        """
+        width, height = self.size
+        tile_boxes = np.reshape(bounding_boxes, (-1, 4)) * [
+            height / 256,
+            width / 256,
+            height / 256,
+            width / 256,
+        ] + [*self.tile_origin, *self.tile_origin]
+        min_longitudes, max_latitudes = tile_positions_to_coordinates(
+            matrix_set, self.zoom_level, tile_boxes[:, 0], tile_boxes[:, 1]
+        )
+        max_longitudes, min_latitudes = tile_positions_to_coordinates(
+            matrix_set, self.zoom_level, tile_boxes[:, 2], tile_boxes[:, 3]
+        )
+        return np.stack(
+            [min_longitudes, min_latitudes, max_longitudes, max_latitudes], axis=1
+        )
+
     def save_image(self, export_path: str, file_extension="PNG"):
         """Exports the image as a file with the given file extension.
 
@@ -55,35 +152,214 @@ class SatelliteView:
             new_width (int): new desired image width
             new_length (int): new desired image length
         """
-        old_width, old_length = self.image.size
+        old_width, old_length = self.size
         x_center, y_center = old_width // 2, old_length // 2
         new_left = x_center - new_width // 2
         new_upper = y_center - new_length // 2
         new_right = x_center + new_width // 2
         new_lower = y_center + new_length // 2
-        self.image = self.image.crop([new_left, new_upper, new_right, new_lower])
+        if self._image is None and self.pixel_window is not None:
+            # Cropping a tiled image only moves its window on the tile grid.
+            pixel_row, pixel_column = self.pixel_window[:2]
+            self.pixel_window = (
+                pixel_row + new_upper,
+                pixel_column + new_left,
+                new_lower - new_upper,
+                new_right - new_left,
+            )
+        else:
+            self.image = self.image.crop([new_left, new_upper, new_right, new_lower])
+        if self.tile_origin is not None:
+            self.tile_origin = (
+                self.tile_origin[0] + new_upper / 256,
+                self.tile_origin[1] + new_left / 256,
+            )
         logger.info(
-            f"Resized image from size {old_width, old_length} to size {self.image.size}."
+            f"Resized image from size {old_width, old_length} to size {self.size}."
         )
 
 
 class WMTSClient:
     """A WMTS (Web Map Tile Service) Client, used to connect to a WMTS Server. It connects to a given url, with a given version and with
     a chosen TileMatrixSet. It also shows the available zoom levels on the server. It produces SatelliteView objects.
+    Tiles are downloaded concurrently over a pooled HTTP session, with at most `max_concurrent_requests` connections
+    opened towards the WMTS server. When a TileCache is given, tiles are looked up in it before reaching the server.
+    The `async_` methods perform the same operations with non-blocking HTTP calls, for use inside an event loop.
+    Geocoding calls are rate-limited to `geocoding_rate_limit` requests per second, and their results are stored in a
+    GeocodingCache when one is given. Failed requests to the WMTS and Nominatim servers are counted in `errors`.
+    When a capabilities path is given, the server capabilities are read from this snapshot instead of being downloaded,
+    so that creating a client needs no network call once the snapshot exists. It can be kept up to date in the
+    background with `start_capabilities_refresh`.
+    When a TileSource is given, such as an MBTiles file, tiles are read from it instead of the WMTS server, bypassing
+    the tile cache, and the server capabilities are never loaded: the client then needs no network access, except for
+    geocoding.
     """
 
     def __init__(
-        self, url: str, correspondance_table_path: str, correspondance_table_url: str
+        self,
+        url: str,
+        correspondance_table_path: str,
+        correspondance_table_url: str,
+        max_concurrent_requests: int = 9,
+        request_timeout: float = 10.0,
+        tile_cache: Optional[TileCache] = None,
+        geocoding_url: str = "https://nominatim.openstreetmap.org/search",
+        geocoding_cache: Optional[GeocodingCache] = None,
+        geocoding_rate_limit: float = 1.0,
+        capabilities_path: Optional[str] = None,
+        tile_source: Optional[TileSource] = None,
     ):
         self.wmts_server_url: str = url
+        self.correspondance_table_path: str = correspondance_table_path
+        self.capabilities_path: Optional[str] = capabilities_path
+        self.geocoding_url: str = geocoding_url
+        self.geocoding_cache: Optional[GeocodingCache] = geocoding_cache
+        # The rate limit is shared by the workers through the geocoding cache database, when it is persistent.
+        self.geocoding_rate_limiter = RateLimiter(
+            geocoding_rate_limit,
+            database_path=geocoding_cache.database_path if geocoding_cache else None,
+        )
+        self._geocoding_lookups: dict[str, asyncio.Future] = {}
+        self.max_concurrent_requests: int = max_concurrent_requests
         self.correspondance_table_url: str = correspondance_table_url
-        self.wmts_instance = WebMapTileService(self.wmts_server_url, version="1.0.0")
-        self.matrix_set: TileMatrixSet = self.wmts_instance.tilematrixsets["PM"]
-        self.available_options = self._load_available_options(correspondance_table_path)
+        self.request_timeout: float = request_timeout
+        self.tile_cache: Optional[TileCache] = tile_cache
+        self.errors: dict[str, int] = {"wmts": 0, "nominatim": 0}
+        self._errors_lock = threading.Lock()
+        self.tile_source: Optional[TileSource] = tile_source
+        if tile_source is not None:
+            self.wmts_instance, self.matrix_set, self.tile_url = None, None, None
+            self.matrix_index: TileMatrixIndex = tile_source.matrix_index
+        elif capabilities_path and os.path.exists(capabilities_path):
+            with open(capabilities_path, "rb") as capabilities_file:
+                self._set_capabilities(
+                    WebMapTileService(
+                        self.wmts_server_url,
+                        version="1.0.0",
+                        xml=capabilities_file.read(),
+                    )
+                )
+            logger.info(f"WMTS capabilities loaded from {capabilities_path}.")
+        else:
+            self.refresh_capabilities()
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=max_concurrent_requests))
+        self.session.mount(
+            "https://", HTTPAdapter(pool_maxsize=max_concurrent_requests)
+        )
+        self.tile_executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_requests, thread_name_prefix="wmts-tile"
+        )
+        self._async_sessions: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
+    def _count_error(self, service: str):
+        with self._errors_lock:
+            self.errors[service] += 1
+
+    def _get_async_session(self) -> httpx.AsyncClient:
+        """Returns the asynchronous HTTP session of the running event loop, creating it on first use. httpx connections
+        are bound to the event loop which opened them, so each loop gets its own session.
+
+        Returns:
+            httpx.AsyncClient: a pooled asynchronous HTTP session
+        """
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_sessions:
+            self._async_sessions = {
+                other_loop: session
+                for other_loop, session in self._async_sessions.items()
+                if not other_loop.is_closed()
+            }
+            self._async_sessions[loop] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_concurrent_requests),
+                timeout=self.request_timeout,
+            )
+        return self._async_sessions[loop]
+
+    def _set_capabilities(self, wmts_instance: WebMapTileService):
+        self.wmts_instance = wmts_instance
+        self.matrix_set: TileMatrixSet = wmts_instance.tilematrixsets["PM"]
+        self.matrix_index: TileMatrixIndex = TileMatrixIndex(self.matrix_set)
+        self.tile_url: str = self._get_tile_url()
+
+    def refresh_capabilities(self):
+        """Downloads the server capabilities and stores them in the capabilities snapshot, if there is one. Requests in
+        progress keep using the previous capabilities.
+
+        Raises:
+            HTTPError: an error is raised when the WMTS server does not return its capabilities
+        """
+        try:
+            wmts_instance = WebMapTileService(
+                self.wmts_server_url, version="1.0.0", timeout=self.request_timeout
+            )
+        except Exception:
+            self._count_error("wmts")
+            raise
+        self._set_capabilities(wmts_instance)
+        if self.capabilities_path:
+            temporary_path = f"{self.capabilities_path}.{os.getpid()}.tmp"
+            with open(temporary_path, "wb") as capabilities_file:
+                capabilities_file.write(wmts_instance.getServiceXML())
+            os.replace(temporary_path, self.capabilities_path)
+
+    def start_capabilities_refresh(self, interval: float) -> threading.Thread:
+        """Refreshes the server capabilities in a background thread, once the snapshot is `interval` seconds old (right
+        away if it already is), then every `interval` seconds. Failed refreshes are logged, and retried at the next
+        interval.
+
+        Args:
+            interval (float): time between two refreshes, in seconds
+
+        Returns:
+            threading.Thread: the daemon thread performing the refreshes
+        """
+
+        def refresh_periodically():
+            delay = interval
+            if self.capabilities_path and os.path.exists(self.capabilities_path):
+                delay -= time.time() - os.path.getmtime(self.capabilities_path)
+            while True:
+                time.sleep(max(0.0, delay))
+                delay = interval
+                try:
+                    self.refresh_capabilities()
+                    logger.info("WMTS capabilities refreshed.")
+                except Exception as e:
+                    logger.warning(f"The WMTS capabilities could not be refreshed: {e}")
+
+        refresh_thread = threading.Thread(
+            target=refresh_periodically, name="wmts-capabilities", daemon=True
+        )
+        refresh_thread.start()
+        return refresh_thread
+
+    def _get_tile_url(self) -> str:
+        """Finds the url of the GetTile operation advertised in the server capabilities. Defaults to the server url.
+
+        Returns:
+            str: the base url used for GetTile requests
+        """
+        try:
+            methods = self.wmts_instance.getOperationByName("GetTile").methods
+        except KeyError:
+            return self.wmts_server_url
+        get_urls = [
+            method.get("url")
+            for method in methods
+            if method.get("type", "").lower() == "get"
+        ]
+        return get_urls[0] if len(get_urls) > 0 else self.wmts_server_url
+
+    @cached_property
+    def available_options(self) -> list:
+        """Each zoom level available on the WMTS server and what it represents, loaded on first use."""
+        return self._load_available_options(self.correspondance_table_path)
 
     def _load_available_options(self, correspondance_table_path: str) -> list:
         """Loads a correspondance table indicating what each zoom level roughly represents (e.g a street, a country...).
-        It only contains zoom levels which are available on the WMTS server.
+        It only contains zoom levels which are available on the WMTS server. pandas is only imported here, as it takes
+        seconds to import on small devices.
 
         Args:
             correspondance_table_path (str): a path towards the file containing the correspondance table
@@ -91,6 +367,8 @@ class WMTSClient:
         Returns:
             list: a list containing each zoom level and what it represents
         """
+        import pandas as pd
+
         if os.path.exists(correspondance_table_path):
             logger.info("Existing correspondance table found, loading it now.")
             correspondance_table = pd.read_csv(correspondance_table_path, sep=";")
@@ -114,7 +392,7 @@ class WMTSClient:
 
         available_zoom_levels = list(
             set(correspondance_table.index).intersection(
-                set([int(key) for key in self.matrix_set.tilematrix.keys()])
+                set(self.matrix_index.zoom_levels)
             )
         )
         correspondance_table = correspondance_table.iloc[
@@ -132,11 +410,13 @@ class WMTSClient:
         return self.available_options
 
     def list_available_layers(self) -> list:
-        """Lists all available zoom levels and their description.
+        """Lists all available layers, of the WMTS server or of the tile source.
 
         Returns:
-            list: a list containing each zoom level and what it represents
+            list: the names of the layers
         """
+        if self.tile_source is not None:
+            return list(self.tile_source.layers)
         return self.wmts_instance.contents.keys()
 
     def reverse_geocoding(
@@ -153,27 +433,303 @@ class WMTSClient:
             longitude (int|None): latitude of the address if found. Returns None if no address is found.
             found_coordinates (bool): returns True if coordinates where found, False otherwise.
         """
-        target_url = (
-            f"https://nominatim.openstreetmap.org/search?q={address}&format=json"
+        cached_result = (
+            self.geocoding_cache.get(address) if self.geocoding_cache else None
+        )
+        if cached_result is not None:
+            return cached_result
+        target_url = self._geocoding_target_url(address)
+        self.geocoding_rate_limiter.wait()
+        # Another worker may have looked the address up while this one was waiting.
+        cached_result = (
+            self.geocoding_cache.get(address, count_miss=False)
+            if self.geocoding_cache
+            else None
+        )
+        if cached_result is not None:
+            return cached_result
+        try:
+            r = requests.get(target_url, timeout=self.request_timeout)
+        except requests.RequestException:
+            self._count_error("nominatim")
+            raise
+        return self._parse_geocoding_response(
+            address, target_url, r.status_code, r.json
+        )
+
+    async def async_reverse_geocoding(
+        self, address: str
+    ) -> tuple[Union[int, None], Union[int, None], bool]:
+        """Asynchronous version of `reverse_geocoding`. Concurrent lookups of the same address share a single call to
+        the geocoding API.
+
+        Args:
+            address (str): postal address of the location
+
+        Returns:
+            latitude (int|None): latitude of the address if found. Returns None if no address is found.
+            longitude (int|None): latitude of the address if found. Returns None if no address is found.
+            found_coordinates (bool): returns True if coordinates where found, False otherwise.
+        """
+        key = normalize_address(address)
+        lookup = self._geocoding_lookups.get(key)
+        if lookup is None or lookup.get_loop() is not asyncio.get_running_loop():
+            lookup = asyncio.ensure_future(self._async_reverse_geocoding(address))
+            self._geocoding_lookups[key] = lookup
+
+            def forget_lookup(_):
+                if self._geocoding_lookups.get(key) is lookup:
+                    del self._geocoding_lookups[key]
+
+            lookup.add_done_callback(forget_lookup)
+        # A cancelled caller does not cancel the lookup shared with the other callers.
+        return await asyncio.shield(lookup)
+
+    async def _async_reverse_geocoding(
+        self, address: str
+    ) -> tuple[Union[int, None], Union[int, None], bool]:
+        # The cache reads and writes SQLite, it runs in worker threads so that the event loop never blocks.
+        get_cached_result = (
+            partial(anyio.to_thread.run_sync, self.geocoding_cache.get, address)
+            if self.geocoding_cache
+            else None
         )
+        cached_result = await get_cached_result() if get_cached_result else None
+        if cached_result is not None:
+            return cached_result
+        target_url = self._geocoding_target_url(address)
+        await self.geocoding_rate_limiter.async_wait()
+        # Another worker may have looked the address up while this one was waiting.
+        cached_result = await get_cached_result(False) if get_cached_result else None
+        if cached_result is not None:
+            return cached_result
+        try:
+            r = await self._get_async_session().get(target_url)
+        except httpx.HTTPError:
+            self._count_error("nominatim")
+            raise
+        return await anyio.to_thread.run_sync(
+            self._parse_geocoding_response, address, target_url, r.status_code, r.json
+        )
+
+    def _geocoding_target_url(self, address: str) -> str:
+        target_url = f"{self.geocoding_url}?q={address}&format=json"
         target_url = target_url.replace(",", "%2C")
         target_url = target_url.replace(" ", "+")
+        return target_url
 
-        r = requests.get(target_url)
+    def _parse_geocoding_response(
+        self, address: str, target_url: str, status_code: int, read_json
+    ) -> tuple[Union[float, None], Union[float, None], bool]:
+        """Reads the coordinates from a Nominatim response. Found and not found addresses are cached, whereas server
+        errors are not."""
         found_coordinates = True
-        if r.status_code == 200:
+        if status_code == 200:
             try:
-                coordinates = r.json()[0]
-                latitude, longitude = coordinates["lat"], coordinates["lon"]
+                coordinates = read_json()[0]
+                latitude, longitude = float(coordinates["lat"]), float(
+                    coordinates["lon"]
+                )
             except:
                 logger.critical(f"Address not found for: {target_url}")
                 latitude, longitude, found_coordinates = None, None, False
+            if self.geocoding_cache:
+                self.geocoding_cache.put(
+                    address, (latitude, longitude, found_coordinates)
+                )
 
         else:
-            logger.critical(f"Error {r.status_code} ocurred on the request")
+            logger.critical(f"Error {status_code} ocurred on the request")
+            self._count_error("nominatim")
             latitude, longitude, found_coordinates = None, None, False
         return latitude, longitude, found_coordinates
 
+    def get_tile(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> Image.Image:
+        """Loads a single tile from the tile cache, or downloads it from the WMTS server through the pooled HTTP session
+        on a cache miss.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            tile_row (int): WMTS row of the tile
+            tile_column (int): WMTS column of the tile
+
+        Raises:
+            HTTPError: an error is raised when the WMTS server does not return the tile
+
+        Returns:
+            Image.Image: the decoded tile
+        """
+        return Image.open(
+            io.BytesIO(self.get_tile_content(layer, zoom_level, tile_row, tile_column))
+        )
+
+    def get_tile_content(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        """Same as `get_tile`, but returns the encoded tile instead of decoding it.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            tile_row (int): WMTS row of the tile
+            tile_column (int): WMTS column of the tile
+
+        Raises:
+            HTTPError: an error is raised when the WMTS server does not return the tile
+            TileNotFoundError: an error is raised when the tile source does not hold the tile
+
+        Returns:
+            bytes: the encoded tile
+        """
+        tile_key = (layer, zoom_level, tile_row, tile_column)
+        if self.tile_source is not None:
+            return self.tile_source.get_tile(*tile_key)
+        content = self.tile_cache.get(tile_key) if self.tile_cache else None
+        if content is None:
+            content = self._download_tile(*tile_key)
+            if self.tile_cache:
+                self.tile_cache.put(tile_key, content)
+        return content
+
+    def get_tile_array(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> np.ndarray:
+        """Same as `get_tile`, but decodes the tile into a [256, 256, 3] uint8 array.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            tile_row (int): WMTS row of the tile
+            tile_column (int): WMTS column of the tile
+
+        Returns:
+            np.ndarray: the decoded tile
+        """
+        return self._decode_tile(
+            self.get_tile_content(layer, zoom_level, tile_row, tile_column)
+        )
+
+    def get_tile_arrays(
+        self, layer: str, zoom_level: int, tile_positions: list
+    ) -> dict[tuple[int, int], np.ndarray]:
+        """Loads and decodes several tiles concurrently.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            tile_positions (list): the (row, column) of the tiles to load
+
+        Returns:
+            dict: the decoded [256, 256, 3] uint8 tiles, keyed by (row, column)
+        """
+        tile_arrays = self.tile_executor.map(
+            lambda position: self.get_tile_array(layer, zoom_level, *position),
+            tile_positions,
+        )
+        return dict(zip(map(tuple, tile_positions), tile_arrays))
+
+    async def async_get_tile_arrays(
+        self, layer: str, zoom_level: int, tile_positions: list
+    ) -> dict[tuple[int, int], np.ndarray]:
+        """Asynchronous version of `get_tile_arrays`. The tiles are downloaded concurrently on the event loop, then
+        decoded in a worker thread.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            tile_positions (list): the (row, column) of the tiles to load
+
+        Returns:
+            dict: the decoded [256, 256, 3] uint8 tiles, keyed by (row, column)
+        """
+        tiles_content = await asyncio.gather(
+            *(
+                self.async_get_tile_content(layer, zoom_level, *position)
+                for position in tile_positions
+            )
+        )
+        tile_arrays = await anyio.to_thread.run_sync(
+            lambda: [self._decode_tile(content) for content in tiles_content]
+        )
+        return dict(zip(map(tuple, tile_positions), tile_arrays))
+
+    @staticmethod
+    def _decode_tile(content: bytes) -> np.ndarray:
+        tile = Image.open(io.BytesIO(content))
+        return np.asarray(tile if tile.mode == "RGB" else tile.convert("RGB"))
+
+    async def async_get_tile_content(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        """Asynchronous version of `get_tile`, which returns the encoded tile instead of decoding it.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            tile_row (int): WMTS row of the tile
+            tile_column (int): WMTS column of the tile
+
+        Raises:
+            HTTPStatusError: an error is raised when the WMTS server does not return the tile
+            TileNotFoundError: an error is raised when the tile source does not hold the tile
+
+        Returns:
+            bytes: the encoded tile
+        """
+        tile_key = (layer, zoom_level, tile_row, tile_column)
+        if self.tile_source is not None:
+            return await self.tile_source.async_get_tile(*tile_key)
+        # The cache reads and writes SQLite and files, they run in worker threads so that the event loop never blocks.
+        content = (
+            await anyio.to_thread.run_sync(self.tile_cache.get, tile_key)
+            if self.tile_cache
+            else None
+        )
+        if content is None:
+            try:
+                response = await self._get_async_session().get(
+                    self.tile_url, params=self._tile_request_parameters(*tile_key)
+                )
+                response.raise_for_status()
+            except httpx.HTTPError:
+                self._count_error("wmts")
+                raise
+            content = response.content
+            if self.tile_cache:
+                await anyio.to_thread.run_sync(self.tile_cache.put, tile_key, content)
+        return content
+
+    def _tile_request_parameters(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> str:
+        return self.wmts_instance.buildTileRequest(
+            layer=layer,
+            tilematrixset="PM",
+            tilematrix=zoom_level,
+            row=tile_row,
+            column=tile_column,
+        )
+
+    def _download_tile(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        try:
+            response = self.session.get(
+                self.tile_url,
+                params=self._tile_request_parameters(
+                    layer, zoom_level, tile_row, tile_column
+                ),
+                timeout=self.request_timeout,
+            )
+            response.raise_for_status()
+        except requests.RequestException:
+            self._count_error("wmts")
+            raise
+        return response.content
+
     def get_concat_image(
         self,
         grid_length: int,
@@ -184,7 +740,8 @@ class WMTSClient:
         zoom_level: int,
     ) -> Image.Image:
         """Given a specific layer, zoom level, tile row and tile column, fetches all of the tiles around the tile containing the
-        desired location. The number of tiles is personalized
+        desired location. The number of tiles is personalized. The tiles are downloaded concurrently, then pasted in
+        row-major order.
 
         Args:
             grid_length (int): number of tiles along the image length
@@ -196,28 +753,213 @@ class WMTSClient:
         Returns:
             Image.Image: an image formed by the concatenated tiles
         """
-        total_width = 256 * grid_width
-        total_height = 256 * grid_length
-        image = Image.new("RGB", (total_width, total_height))
-        for i, row in enumerate(trange(tile_row - 1, tile_row + 2)):
-            for j, col in enumerate(range(tile_column - 1, tile_column + 2)):
-                request = self.wmts_instance.gettile(
-                    layer=layer,
-                    tilematrixset="PM",
-                    tilematrix=zoom_level,
-                    row=row,
-                    column=col,
-                )
-                temp_img = Image.open(io.BytesIO(request.read()))
-                image.paste(temp_img, (j * 256, i * 256))
+        tile_positions = self._mosaic_tile_positions(
+            grid_length, grid_width, tile_row, tile_column
+        )
+        tiles = self.tile_executor.map(
+            lambda position: self.get_tile(layer, zoom_level, *position),
+            tile_positions,
+        )
+        return self._assemble_mosaic(grid_length, grid_width, tiles)
+
+    async def async_get_concat_image(
+        self,
+        grid_length: int,
+        grid_width: int,
+        tile_row: int,
+        tile_column: int,
+        layer: str,
+        zoom_level: int,
+    ) -> Image.Image:
+        """Asynchronous version of `get_concat_image`. The tiles are downloaded concurrently on the event loop, then
+        decoded and pasted in a worker thread.
+
+        Args:
+            grid_length (int): number of tiles along the image length
+            grid_width (int): number of tiles along the image width
+            tile_row (int): WMTS row where the central tile is located
+            tile_column (int): WMTS column where the central tile is located
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+        Returns:
+            Image.Image: an image formed by the concatenated tiles
+        """
+        tile_positions = self._mosaic_tile_positions(
+            grid_length, grid_width, tile_row, tile_column
+        )
+        tiles_content = await asyncio.gather(
+            *(
+                self.async_get_tile_content(layer, zoom_level, *position)
+                for position in tile_positions
+            )
+        )
+        return await anyio.to_thread.run_sync(
+            self._assemble_mosaic,
+            grid_length,
+            grid_width,
+            [Image.open(io.BytesIO(content)) for content in tiles_content],
+        )
+
+    def _mosaic_tile_positions(
+        self, grid_length: int, grid_width: int, tile_row: int, tile_column: int
+    ) -> list:
+        """Lists the (row, column) positions of the tiles of a mosaic centered on a tile, in row-major order."""
+        first_row, first_column = (
+            tile_row - grid_length // 2,
+            tile_column - grid_width // 2,
+        )
+        return [
+            (first_row + i, first_column + j)
+            for i in range(grid_length)
+            for j in range(grid_width)
+        ]
+
+    def _mosaic_pixel_window(
+        self, grid_length: int, grid_width: int, tile_positions: list
+    ) -> tuple[int, int, int, int]:
+        """Pixel window (row, column, height, width) of a mosaic on the tile grid, from its tile positions."""
+        first_row, first_column = tile_positions[0]
+        return (
+            first_row * TILE_SIZE,
+            first_column * TILE_SIZE,
+            grid_length * TILE_SIZE,
+            grid_width * TILE_SIZE,
+        )
+
+    def _assemble_mosaic(self, grid_length: int, grid_width: int, tiles) -> Image.Image:
+        """Pastes tiles given in row-major order into a single image."""
+        image = Image.new("RGB", (256 * grid_width, 256 * grid_length))
+        for position, temp_img in enumerate(tiles):
+            i, j = divmod(position, grid_width)
+            image.paste(temp_img, (j * 256, i * 256))
         return image
 
+    def _view_window(
+        self,
+        zoom_level: int,
+        latitude: float,
+        longitude: float,
+        grid_length: int,
+        grid_width: int,
+        window_width: Optional[int],
+        window_height: Optional[int],
+    ) -> tuple[int, int, int, int]:
+        """Computes the pixel window of a view on the tile grid. When a window size is given, the window is centered on
+        the exact pixel of the point. Otherwise, it is the mosaic of grid_length * grid_width tiles around the tile of the
+        point.
+
+        Raises:
+            ValueError: an error is raised when the point cannot be projected on the tile grid, or when the window goes
+                beyond the limits of the tile matrix
+
+        Returns:
+            tuple: the (row, column, height, width) of the window, in pixels of the whole tile grid
+        """
+        if window_width is None or window_height is None:
+            tile_row, tile_column = compute_tile_position(
+                self.matrix_index, zoom_level, float(longitude), float(latitude)
+            )
+            tile_positions = self._mosaic_tile_positions(
+                grid_length, grid_width, tile_row, tile_column
+            )
+            pixel_window = self._mosaic_pixel_window(
+                grid_length, grid_width, tile_positions
+            )
+        else:
+            tile_row, tile_column = compute_fractional_tile_positions(
+                self.matrix_index, zoom_level, float(longitude), float(latitude)
+            )
+            if not np.isfinite([tile_row, tile_column]).all():
+                raise ValueError(
+                    f"Could not project {latitude, longitude} on the grid."
+                )
+            pixel_window = (
+                int(np.floor(tile_row * TILE_SIZE)) - window_height // 2,
+                int(np.floor(tile_column * TILE_SIZE)) - window_width // 2,
+                window_height,
+                window_width,
+            )
+        self.matrix_index.check_window(zoom_level, *pixel_window)
+        return pixel_window
+
+    def _locate_satellite_view(
+        self,
+        latitude: float,
+        longitude: float,
+        zoom_level: int,
+        grid_length: int,
+        grid_width: int,
+        window_width: Optional[int],
+        window_height: Optional[int],
+    ) -> SatelliteView:
+        """Creates a SatelliteView located on the tile grid, without loading its tiles."""
+        satellite_view = SatelliteView()
+        satellite_view.latitude = latitude
+        satellite_view.longitude = longitude
+        satellite_view.zoom_level = zoom_level
+        try:
+            pixel_window = self._view_window(
+                zoom_level,
+                latitude,
+                longitude,
+                grid_length,
+                grid_width,
+                window_width,
+                window_height,
+            )
+            satellite_view.found_coordinates = True
+        except:
+            logger.critical("Location not found")
+        if satellite_view.found_coordinates:
+            satellite_view.pixel_window = pixel_window
+            satellite_view.tile_origin = (
+                pixel_window[0] / TILE_SIZE,
+                pixel_window[1] / TILE_SIZE,
+            )
+        return satellite_view
+
+    def load_tiles(self, satellite_view: SatelliteView, layer: str):
+        """Loads the tiles overlapped by a located SatelliteView.
+
+        Args:
+            satellite_view (SatelliteView): a SatelliteView created with `fetch_tiles=False`
+            layer (str): name of the layer containing the images in the WMTS server
+        """
+        satellite_view.tile_arrays = self.get_tile_arrays(
+            layer,
+            satellite_view.zoom_level,
+            window_tile_positions(*satellite_view.pixel_window),
+        )
+
+    async def async_load_tiles(self, satellite_view: SatelliteView, layer: str):
+        """Asynchronous version of `load_tiles`.
+
+        Args:
+            satellite_view (SatelliteView): a SatelliteView created with `fetch_tiles=False`
+            layer (str): name of the layer containing the images in the WMTS server
+        """
+        satellite_view.tile_arrays = await self.async_get_tile_arrays(
+            layer,
+            satellite_view.zoom_level,
+            window_tile_positions(*satellite_view.pixel_window),
+        )
+
     def create_satellite_view_from_address(
-        self, address: str, layer: str, zoom_level: int, grid_length=3, grid_width=3
+        self,
+        address: str,
+        layer: str,
+        zoom_level: int,
+        grid_length=3,
+        grid_width=3,
+        window_width: Optional[int] = None,
+        window_height: Optional[int] = None,
+        fetch_tiles: bool = True,
     ) -> SatelliteView:
         """Creates a new SatelliteView object from a postal address. The location search is performed through the OpenStreetMap API.
         The function searches for the tile containing the point, then loads a number of tiles around this central tile depending on the
         desired grid length and width. By default, a 768*786 pixels image (3 tiles * 3 tiles of 256*256 pixels) is produced.
+        When a window width and height are given, the image is instead a window of this size centered on the exact point,
+        and only the tiles it overlaps are loaded.
 
         Args:
             address (str): postal address of the location
@@ -225,28 +967,32 @@ class WMTSClient:
             zoom_level (int): zoom level to use on the WMTS server
             grid_length (int, optional): number of tiles on the length of the image. Defaults to 3.
             grid_width (int, optional): number of tiles on the width of the image. Defaults to 3.
+            window_width (int, optional): width of the image in pixels, e.g. the model input width. Defaults to None.
+            window_height (int, optional): height of the image in pixels, e.g. the model input height. Defaults to None.
+            fetch_tiles (bool, optional): loads the tiles of the image. When False, the view is only located on the tile
+                grid, and its tiles can be loaded later with `load_tiles`. Defaults to True.
 
         Returns:
             SatelliteView: a SatelliteView containing a custom image of the desired location
         """
-        satellite_view = SatelliteView()
+        latitude, longitude, found_coordinates = self.reverse_geocoding(address)
+        if not found_coordinates:
+            satellite_view = SatelliteView()
+            satellite_view.address = address
+            satellite_view.zoom_level = zoom_level
+            return satellite_view
+        satellite_view = self.create_satellite_view_from_location(
+            latitude,
+            longitude,
+            layer,
+            zoom_level,
+            grid_length,
+            grid_width,
+            window_width,
+            window_height,
+            fetch_tiles,
+        )
         satellite_view.address = address
-        satellite_view.zoom_level = zoom_level
-        (
-            satellite_view.latitude,
-            satellite_view.longitude,
-            satellite_view.found_coordinates,
-        ) = self.reverse_geocoding(address)
-        if satellite_view.found_coordinates:
-            tile_row, tile_column = compute_tile_position(
-                self.matrix_set,
-                zoom_level,
-                satellite_view.longitude,
-                satellite_view.latitude,
-            )
-            satellite_view.image = self.get_concat_image(
-                grid_length, grid_width, tile_row, tile_column, layer, zoom_level
-            )
         return satellite_view
 
     def create_satellite_view_from_location(
@@ -257,10 +1003,15 @@ class WMTSClient:
         zoom_level: int,
         grid_length=3,
         grid_width=3,
+        window_width: Optional[int] = None,
+        window_height: Optional[int] = None,
+        fetch_tiles: bool = True,
     ) -> SatelliteView:
         """Creates a new SatelliteView object from a latitude and a longitude. This method is more precise than the postal address one.
         The function searches for the tile containing the point, then loads a number of tiles around this central tile depending on the
         desired grid length and width. By default, a 768*786 pixels image (3 tiles * 3 tiles of 256*256 pixels) is produced.
+        When a window width and height are given, the image is instead a window of this size centered on the exact point,
+        and only the tiles it overlaps are loaded.
 
         Args:
             latitude (float): the latitude of the point to fetch
@@ -269,21 +1020,114 @@ class WMTSClient:
             zoom_level (int): zoom level to use on the WMTS server
             grid_length (int, optional): number of tiles on the length of the image. Defaults to 3.
             grid_width (int, optional): number of tiles on the width of the image. Defaults to 3.
+            window_width (int, optional): width of the image in pixels, e.g. the model input width. Defaults to None.
+            window_height (int, optional): height of the image in pixels, e.g. the model input height. Defaults to None.
+            fetch_tiles (bool, optional): loads the tiles of the image. When False, the view is only located on the tile
+                grid, and its tiles can be loaded later with `load_tiles`. Defaults to True.
 
         Returns:
             SatelliteView: a SatelliteView containing a custom image of the desired location
         """
-        satellite_view = SatelliteView()
-        satellite_view.latitude = latitude
-        satellite_view.longitude = longitude
-        try:
-            tile_row, tile_column = compute_tile_position(
-                self.matrix_set, zoom_level, longitude, latitude
-            )
-            satellite_view.found_coordinates = True
-        except:
-            logger.critical("Location not found")
-        satellite_view.image = self.get_concat_image(
-            grid_length, grid_width, tile_row, tile_column, layer, zoom_level
+        satellite_view = self._locate_satellite_view(
+            latitude,
+            longitude,
+            zoom_level,
+            grid_length,
+            grid_width,
+            window_width,
+            window_height,
+        )
+        if fetch_tiles and satellite_view.found_coordinates:
+            self.load_tiles(satellite_view, layer)
+        return satellite_view
+
+    async def async_create_satellite_view_from_address(
+        self,
+        address: str,
+        layer: str,
+        zoom_level: int,
+        grid_length=3,
+        grid_width=3,
+        window_width: Optional[int] = None,
+        window_height: Optional[int] = None,
+        fetch_tiles: bool = True,
+    ) -> SatelliteView:
+        """Asynchronous version of `create_satellite_view_from_address`.
+
+        Args:
+            address (str): postal address of the location
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            grid_length (int, optional): number of tiles on the length of the image. Defaults to 3.
+            grid_width (int, optional): number of tiles on the width of the image. Defaults to 3.
+            window_width (int, optional): width of the image in pixels, e.g. the model input width. Defaults to None.
+            window_height (int, optional): height of the image in pixels, e.g. the model input height. Defaults to None.
+            fetch_tiles (bool, optional): loads the tiles of the image. When False, the view is only located on the tile
+                grid, and its tiles can be loaded later with `load_tiles`. Defaults to True.
+
+        Returns:
+            SatelliteView: a SatelliteView containing a custom image of the desired location
+        """
+        latitude, longitude, found_coordinates = await self.async_reverse_geocoding(
+            address
+        )
+        if not found_coordinates:
+            satellite_view = SatelliteView()
+            satellite_view.address = address
+            satellite_view.zoom_level = zoom_level
+            return satellite_view
+        satellite_view = await self.async_create_satellite_view_from_location(
+            latitude,
+            longitude,
+            layer,
+            zoom_level,
+            grid_length,
+            grid_width,
+            window_width,
+            window_height,
+            fetch_tiles,
+        )
+        satellite_view.address = address
+        return satellite_view
+
+    async def async_create_satellite_view_from_location(
+        self,
+        latitude: float,
+        longitude: float,
+        layer: str,
+        zoom_level: int,
+        grid_length=3,
+        grid_width=3,
+        window_width: Optional[int] = None,
+        window_height: Optional[int] = None,
+        fetch_tiles: bool = True,
+    ) -> SatelliteView:
+        """Asynchronous version of `create_satellite_view_from_location`.
+
+        Args:
+            latitude (float): the latitude of the point to fetch
+            longitude (float): the latitude of the point to fetch
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_level (int): zoom level to use on the WMTS server
+            grid_length (int, optional): number of tiles on the length of the image. Defaults to 3.
+            grid_width (int, optional): number of tiles on the width of the image. Defaults to 3.
+            window_width (int, optional): width of the image in pixels, e.g. the model input width. Defaults to None.
+            window_height (int, optional): height of the image in pixels, e.g. the model input height. Defaults to None.
+            fetch_tiles (bool, optional): loads the tiles of the image. When False, the view is only located on the tile
+                grid, and its tiles can be loaded later with `load_tiles`. Defaults to True.
+
+        Returns:
+            SatelliteView: a SatelliteView containing a custom image of the desired location
+        """
+        satellite_view = self._locate_satellite_view(
+            latitude,
+            longitude,
+            zoom_level,
+            grid_length,
+            grid_width,
+            window_width,
+            window_height,
         )
+        if fetch_tiles and satellite_view.found_coordinates:
+            await self.async_load_tiles(satellite_view, layer)
         return satellite_view
@@ -0,0 +1,260 @@
+import os
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Optional
+import picologging as logging
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+TileKey = tuple[str, int, int, int]
+
+
+class TileCache:
+    """A two-tier cache for raw WMTS tiles, keyed by (layer, zoom level, tile row, tile column).
+
+    The first tier is an in-memory LRU holding a bounded number of tiles. The second tier is a content-addressed store
+    on disk: each tile is written once under the SHA-256 digest of its bytes, and a SQLite index maps tile keys to
+    digests. SQLite handles locking between processes, so several uvicorn workers can share the same cache directory.
+    Tile files are written to a temporary file then renamed, so readers never see a partial tile.
+
+    The total size of the disk tier is kept up to date by SQLite triggers in a single row, shared by every worker, so
+    checking the budget on each insert does not scan the index. Once over budget, the least recently accessed tiles are
+    evicted down to `low_water_mark` of the budget, so that the next inserts do not evict again.
+    """
+
+    def __init__(
+        self,
+        cache_directory: str,
+        memory_capacity: int = 512,
+        disk_budget_bytes: int = 1024**3,
+        ttl: float = 30 * 24 * 3600,
+        low_water_mark: float = 0.9,
+    ):
+        self.cache_directory: str = cache_directory
+        self.objects_directory: str = os.path.join(cache_directory, "objects")
+        self.index_path: str = os.path.join(cache_directory, "index.sqlite")
+        self.memory_capacity: int = memory_capacity
+        self.disk_budget_bytes: int = disk_budget_bytes
+        self.ttl: float = ttl
+        self.low_water_mark: float = low_water_mark
+        self.memory_hits, self.disk_hits, self.misses = 0, 0, 0
+
+        self._memory_tiles: OrderedDict[TileKey, tuple[bytes, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        os.makedirs(self.objects_directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS tiles (
+                    layer TEXT, zoom_level INTEGER, tile_row INTEGER, tile_column INTEGER,
+                    digest TEXT, size INTEGER, stored_at REAL, accessed_at REAL,
+                    PRIMARY KEY (layer, zoom_level, tile_row, tile_column)
+                )"""
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS tiles_accessed_at ON tiles (accessed_at)"
+            )
+            connection.executescript(
+                """CREATE TABLE IF NOT EXISTS disk_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL
+                );
+                CREATE TRIGGER IF NOT EXISTS tiles_insert_size AFTER INSERT ON tiles BEGIN
+                    UPDATE disk_size SET total = total + NEW.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS tiles_delete_size AFTER DELETE ON tiles BEGIN
+                    UPDATE disk_size SET total = total - OLD.size;
+                END;
+                CREATE TRIGGER IF NOT EXISTS tiles_update_size AFTER UPDATE OF size ON tiles BEGIN
+                    UPDATE disk_size SET total = total + NEW.size - OLD.size;
+                END;"""
+            )
+            # Indexes created before the size was tracked are summed once, by the first worker to open them.
+            connection.execute(
+                "INSERT OR IGNORE INTO disk_size SELECT 0, COALESCE(SUM(size), 0) FROM tiles"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the SQLite connection of the current thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_directory, digest[:2], digest[2:])
+
+    @property
+    def stats(self) -> dict:
+        """Hit and miss counters of the cache, for the current process.
+
+        Returns:
+            dict: the number of memory hits, disk hits and misses
+        """
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_tiles": len(self._memory_tiles),
+        }
+
+    @property
+    def disk_size(self) -> int:
+        """Total size of the tiles indexed on disk, in bytes, shared by every worker."""
+        (total,) = self._connection().execute("SELECT total FROM disk_size").fetchone()
+        return total
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        """Looks a tile up in memory, then on disk. Disk hits are promoted to the memory tier.
+
+        Args:
+            key (TileKey): (layer, zoom level, tile row, tile column) of the tile
+
+        Returns:
+            bytes|None: the encoded tile if it is cached and not expired, None otherwise
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._memory_tiles.get(key)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._memory_tiles.move_to_end(key)
+                self.memory_hits += 1
+                return cached[0]
+            elif cached is not None:
+                del self._memory_tiles[key]
+
+        content, stored_at = self._read_from_disk(key, now)
+        with self._lock:
+            if content is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store_in_memory(key, content, stored_at)
+        return content
+
+    def put(self, key: TileKey, content: bytes):
+        """Stores a tile in both tiers, then evicts the least recently used tiles if the disk budget is exceeded.
+
+        Args:
+            key (TileKey): (layer, zoom level, tile row, tile column) of the tile
+            content (bytes): the encoded tile, as returned by the WMTS server
+        """
+        now = time.time()
+        with self._lock:
+            self._store_in_memory(key, content, now)
+
+        digest = hashlib.sha256(content).hexdigest()
+        object_path = self._object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            file_descriptor, temporary_path = tempfile.mkstemp(
+                dir=os.path.dirname(object_path)
+            )
+            with os.fdopen(file_descriptor, "wb") as temporary_file:
+                temporary_file.write(content)
+            os.replace(temporary_path, object_path)
+
+        # An upsert rather than a REPLACE, whose implicit delete would not fire the size trigger.
+        with self._connection() as connection:
+            connection.execute(
+                """INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (layer, zoom_level, tile_row, tile_column) DO UPDATE SET
+                    digest = excluded.digest, size = excluded.size,
+                    stored_at = excluded.stored_at, accessed_at = excluded.accessed_at""",
+                (*key, digest, len(content), now, now),
+            )
+        self._evict_disk()
+
+    def stored_positions(self, layer: str, zoom_level: int) -> set:
+        """Lists the tiles of a layer and zoom level stored on disk and not expired, without reading them.
+
+        Args:
+            layer (str): name of the layer
+            zoom_level (int): zoom level of the tiles
+
+        Returns:
+            set: the (tile row, tile column) of the stored tiles
+        """
+        rows = self._connection().execute(
+            """SELECT tile_row, tile_column FROM tiles
+            WHERE layer = ? AND zoom_level = ? AND stored_at > ?""",
+            (layer, zoom_level, time.time() - self.ttl),
+        )
+        return set(rows)
+
+    def _store_in_memory(self, key: TileKey, content: bytes, stored_at: float):
+        self._memory_tiles[key] = (content, stored_at)
+        self._memory_tiles.move_to_end(key)
+        while len(self._memory_tiles) > self.memory_capacity:
+            self._memory_tiles.popitem(last=False)
+
+    def _read_from_disk(
+        self, key: TileKey, now: float
+    ) -> tuple[Optional[bytes], float]:
+        connection = self._connection()
+        row = connection.execute(
+            """SELECT digest, stored_at FROM tiles
+            WHERE layer = ? AND zoom_level = ? AND tile_row = ? AND tile_column = ?""",
+            key,
+        ).fetchone()
+        if row is None:
+            return None, now
+        digest, stored_at = row
+        if now - stored_at >= self.ttl:
+            self._delete_entries(connection, [(*key, digest)])
+            return None, now
+        try:
+            with open(self._object_path(digest), "rb") as tile_file:
+                content = tile_file.read()
+        except FileNotFoundError:
+            # The tile was evicted by another worker between the lookup and the read.
+            return None, now
+        with connection:
+            connection.execute(
+                """UPDATE tiles SET accessed_at = ?
+                WHERE layer = ? AND zoom_level = ? AND tile_row = ? AND tile_column = ?""",
+                (now, *key),
+            )
+        return content, stored_at
+
+    def _delete_entries(self, connection: sqlite3.Connection, entries: list):
+        """Deletes index entries, then removes the tile files which are no longer referenced by any entry."""
+        with connection:
+            connection.executemany(
+                """DELETE FROM tiles
+                WHERE layer = ? AND zoom_level = ? AND tile_row = ? AND tile_column = ?""",
+                [entry[:4] for entry in entries],
+            )
+        for digest in set(entry[4] for entry in entries):
+            (references,) = connection.execute(
+                "SELECT COUNT(*) FROM tiles WHERE digest = ?", (digest,)
+            ).fetchone()
+            if references == 0:
+                try:
+                    os.remove(self._object_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def _evict_disk(self):
+        """Evicts the least recently accessed tiles down to the low water mark, when the disk tier exceeds its budget."""
+        total_size = self.disk_size
+        if total_size <= self.disk_budget_bytes:
+            return
+        target_size = self.disk_budget_bytes * self.low_water_mark
+        evicted_entries = []
+        for *key, digest, size in self._connection().execute(
+            """SELECT layer, zoom_level, tile_row, tile_column, digest, size
+            FROM tiles ORDER BY accessed_at"""
+        ):
+            evicted_entries.append((*key, digest))
+            total_size -= size
+            if total_size <= target_size:
+                break
+        self._delete_entries(self._connection(), evicted_entries)
+        logger.info(f"Evicted {len(evicted_entries)} tiles from the disk cache.")
@@ -0,0 +1,72 @@
+import anyio
+import asyncio
+import numpy as np
+from collections import OrderedDict
+from object_detection_ign.wmts.satellite_view import SatelliteView, WMTSClient
+from object_detection_ign.wmts.tile_cache import TileKey
+from object_detection_ign.wmts.utils import window_tile_positions
+
+
+class SharedTileLoader:
+    """Loads the tiles of many SatelliteViews, such as the items of a batch request, downloading and decoding each tile
+    only once. Views located close to each other overlap the same tiles: a tile requested while it is being downloaded
+    for another view waits for that download instead of starting a new one. The most recently used decoded tiles are
+    kept, so that views processed one after the other share them as well.
+
+    A loader is bound to the event loop it is used on, it is meant to live for the duration of one request.
+
+    Args:
+        wmts_client (WMTSClient): the WMTS client downloading the tiles, through its tile cache if it has one
+        max_tiles (int, optional): number of decoded tiles kept once loaded. Defaults to 256.
+    """
+
+    def __init__(self, wmts_client: WMTSClient, max_tiles: int = 256):
+        self.wmts_client: WMTSClient = wmts_client
+        self.max_tiles: int = max_tiles
+        self.downloads, self.shared = 0, 0
+        self._tiles: OrderedDict[TileKey, asyncio.Task] = OrderedDict()
+
+    async def _load_tile(self, tile_key: TileKey) -> np.ndarray:
+        content = await self.wmts_client.async_get_tile_content(*tile_key)
+        return await anyio.to_thread.run_sync(self.wmts_client._decode_tile, content)
+
+    def _get_tile_task(self, tile_key: TileKey) -> asyncio.Task:
+        task = self._tiles.get(tile_key)
+        if task is not None and not (task.done() and task.exception() is not None):
+            self.shared += 1
+            self._tiles.move_to_end(tile_key)
+            return task
+        self.downloads += 1
+        task = self._tiles[tile_key] = asyncio.ensure_future(self._load_tile(tile_key))
+        self._tiles.move_to_end(tile_key)
+        # Tiles still downloading are never evicted, since views are waiting for them.
+        for evicted_key in [
+            key for key, evicted_task in self._tiles.items() if evicted_task.done()
+        ][: max(0, len(self._tiles) - self.max_tiles)]:
+            del self._tiles[evicted_key]
+        return task
+
+    async def load_tiles(self, satellite_view: SatelliteView, layer: str):
+        """Loads the tiles overlapped by a located SatelliteView, like `WMTSClient.async_load_tiles`.
+
+        Args:
+            satellite_view (SatelliteView): a SatelliteView created with `fetch_tiles=False`
+            layer (str): name of the layer containing the images in the WMTS server
+
+        Raises:
+            HTTPStatusError: an error is raised when the WMTS server does not return a tile
+        """
+        tile_positions = window_tile_positions(*satellite_view.pixel_window)
+        tasks = [
+            self._get_tile_task((layer, satellite_view.zoom_level, *position))
+            for position in tile_positions
+        ]
+        # Shielded, so that a cancelled view does not cancel a download shared with other views.
+        tile_arrays = await asyncio.gather(*(asyncio.shield(task) for task in tasks))
+        satellite_view.tile_arrays = dict(zip(tile_positions, tile_arrays))
+
+    def close(self):
+        """Cancels the downloads in progress and releases the decoded tiles."""
+        for task in self._tiles.values():
+            task.cancel()
+        self._tiles.clear()
@@ -0,0 +1,282 @@
+"""Pre-downloads the tiles covering a region into the tile cache, so that the API serves this region without reaching
+the WMTS server.
+
+The region is a (min_longitude, min_latitude, max_longitude, max_latitude) bounding box, or the polygons of a GeoJSON
+file. Every tile covering it is downloaded for each zoom level of the range, concurrently and within an optional
+bandwidth cap. The tile cache is the checkpoint of the seeding: tiles already stored and not expired are skipped, so an
+interrupted run resumes where it stopped when it is started again. Seeded tiles follow the cache rules: they expire
+after its TTL, and the disk budget of the cache must be large enough to hold them.
+
+Usage, from the root of the repository:
+    python -m object_detection_ign.wmts.tile_seeding --bbox 2.29 48.85 2.31 48.87 --zoom-levels 17 19
+    python -m object_detection_ign.wmts.tile_seeding --geojson paris.geojson --max-bandwidth 2
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import httpx
+import picologging as logging
+from typing import Optional
+from starlite import State
+from object_detection_ign.api.api_configuration import (
+    create_wmts_client,
+    set_state_on_startup,
+)
+from object_detection_ign.wmts.satellite_view import WMTSClient
+from object_detection_ign.wmts.utils import compute_covering_tiles
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+CONFIG_FILE_PATH = "config/api_config.toml"
+
+
+def read_geojson_polygons(geojson_path: str) -> list:
+    """Reads the polygons of a GeoJSON file, which holds a FeatureCollection, a Feature or a geometry. Only the exterior
+    ring of each Polygon and MultiPolygon is kept: the tiles of their holes are seeded as well.
+
+    Args:
+        geojson_path (str): path of the GeoJSON file, in WGS84 coordinates
+
+    Raises:
+        ValueError: an error is raised when the file holds no polygon
+
+    Returns:
+        list: the polygons, as lists of (longitude, latitude) vertices
+    """
+    with open(geojson_path) as geojson_file:
+        geojson = json.load(geojson_file)
+    geometries = [geojson]
+    polygons = []
+    while geometries:
+        geometry = geometries.pop()
+        geometry_type = geometry.get("type") if geometry else None
+        if geometry_type == "FeatureCollection":
+            geometries += [feature.get("geometry") for feature in geometry["features"]]
+        elif geometry_type == "Feature":
+            geometries.append(geometry.get("geometry"))
+        elif geometry_type == "GeometryCollection":
+            geometries += geometry["geometries"]
+        elif geometry_type == "Polygon":
+            polygons.append(geometry["coordinates"][0])
+        elif geometry_type == "MultiPolygon":
+            polygons += [polygon[0] for polygon in geometry["coordinates"]]
+    if not polygons:
+        raise ValueError(f"{geojson_path} does not contain any polygon.")
+    return [[tuple(vertex[:2]) for vertex in polygon] for polygon in polygons]
+
+
+class BandwidthLimiter:
+    """Caps the average download rate of the current process. Each download reserves the time its size takes at the
+    given rate once it is received, and the next downloads wait until this time has elapsed.
+
+    Args:
+        bytes_per_second (float): maximal average download rate
+    """
+
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second: float = bytes_per_second
+        self._next_slot: float = 0.0
+
+    async def consume(self, size: int):
+        """Waits until a download of `size` bytes fits in the bandwidth cap.
+
+        Args:
+            size (int): size of the download in bytes
+        """
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + size / self.bytes_per_second
+        await asyncio.sleep(slot - now)
+
+
+class TileSeeder:
+    """Downloads the tiles covering regions into the tile cache of a WMTS client.
+
+    Args:
+        wmts_client (WMTSClient): a WMTS client with a tile cache
+        max_concurrent_downloads (int, optional): number of tiles downloaded at once. Defaults to None (the number of
+            concurrent requests of the client).
+        max_bytes_per_second (float, optional): bandwidth cap of the downloads. Defaults to None (no cap).
+        progress_interval (float, optional): time between two progress reports, in seconds. Defaults to 10.
+
+    Raises:
+        ValueError: an error is raised when the client has no tile cache
+    """
+
+    def __init__(
+        self,
+        wmts_client: WMTSClient,
+        max_concurrent_downloads: Optional[int] = None,
+        max_bytes_per_second: Optional[float] = None,
+        progress_interval: float = 10.0,
+    ):
+        if wmts_client.tile_cache is None:
+            raise ValueError("Tiles can only be seeded into an enabled tile cache.")
+        self.wmts_client: WMTSClient = wmts_client
+        self.max_concurrent_downloads: int = (
+            max_concurrent_downloads or wmts_client.max_concurrent_requests
+        )
+        self.bandwidth_limiter: Optional[BandwidthLimiter] = (
+            BandwidthLimiter(max_bytes_per_second) if max_bytes_per_second else None
+        )
+        self.progress_interval: float = progress_interval
+
+    def plan(self, layer: str, zoom_levels: list, areas: list) -> tuple[list, int]:
+        """Lists the tiles covering some areas which are not stored in the tile cache yet.
+
+        Args:
+            layer (str): name of the layer containing the images in the WMTS server
+            zoom_levels (list): zoom levels to seed
+            areas (list): bounding boxes or polygons, as accepted by `compute_covering_tiles`
+
+        Returns:
+            tuple: the keys of the tiles to download, and the number of covering tiles already stored
+        """
+        tile_keys, stored_tiles = [], 0
+        for zoom_level in zoom_levels:
+            positions = set()
+            for area in areas:
+                positions.update(
+                    map(
+                        tuple,
+                        compute_covering_tiles(
+                            self.wmts_client.matrix_index, zoom_level, area
+                        ).tolist(),
+                    )
+                )
+            stored_positions = positions & self.wmts_client.tile_cache.stored_positions(
+                layer, zoom_level
+            )
+            stored_tiles += len(stored_positions)
+            tile_keys += [
+                (layer, zoom_level, *position)
+                for position in sorted(positions - stored_positions)
+            ]
+        return tile_keys, stored_tiles
+
+    async def seed(self, tile_keys: list) -> dict:
+        """Downloads tiles into the tile cache. A tile which cannot be downloaded is logged and skipped, so that it is
+        retried by the next run.
+
+        Args:
+            tile_keys (list): keys of the tiles to download
+
+        Returns:
+            dict: the number of downloaded and failed tiles, the downloaded bytes and the duration in seconds
+        """
+        pending_keys = iter(tile_keys)
+        progress = {"downloaded": 0, "failed": 0, "bytes": 0}
+        start = last_report = time.perf_counter()
+
+        async def download_tiles():
+            nonlocal last_report
+            for tile_key in pending_keys:
+                try:
+                    content = await self.wmts_client.async_get_tile_content(*tile_key)
+                except httpx.HTTPError as e:
+                    logger.warning(f"Tile {tile_key} could not be downloaded: {e!r}")
+                    progress["failed"] += 1
+                    continue
+                progress["downloaded"] += 1
+                progress["bytes"] += len(content)
+                if self.bandwidth_limiter is not None:
+                    await self.bandwidth_limiter.consume(len(content))
+                now = time.perf_counter()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    logger.info(
+                        f"Seeded {progress['downloaded'] + progress['failed']}/{len(tile_keys)} tiles, "
+                        f"{progress['bytes'] / 1024**2:.1f} MB at "
+                        f"{progress['bytes'] / 1024**2 / (now - start):.2f} MB/s, "
+                        f"{progress['failed']} failed."
+                    )
+
+        # Workers pull from the same iterator, so that large regions do not create a task per tile.
+        await asyncio.gather(
+            *(download_tiles() for _ in range(self.max_concurrent_downloads))
+        )
+        progress["duration"] = time.perf_counter() - start
+        return progress
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("MIN_LONGITUDE", "MIN_LATITUDE", "MAX_LONGITUDE", "MAX_LATITUDE"),
+    )
+    region.add_argument("--geojson", help="path of a GeoJSON file of polygons")
+    parser.add_argument("--layer", default="HR.ORTHOIMAGERY.ORTHOPHOTOS")
+    parser.add_argument(
+        "--zoom-levels", type=int, nargs=2, default=(19, 19), metavar=("MIN", "MAX")
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="tiles downloaded at once, MAX_CONCURRENT_REQUESTS of the config file by default",
+    )
+    parser.add_argument(
+        "--max-bandwidth", type=float, default=None, help="bandwidth cap, in MB/s"
+    )
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    parser.add_argument("--config", default=CONFIG_FILE_PATH)
+    arguments = parser.parse_args(arguments)
+    logger.setLevel(logging.INFO)
+
+    state = State({"config_file_path": arguments.config})
+    set_state_on_startup(state)
+    if not state.TILE_CACHE_ENABLED:
+        parser.error("The tile cache is disabled in the config file.")
+    if state.TILE_SOURCE_PATH:
+        parser.error("Tiles are read from a local tile source, they are not seeded.")
+    wmts_client = create_wmts_client(state)
+    zoom_levels = list(range(arguments.zoom_levels[0], arguments.zoom_levels[1] + 1))
+    unavailable_zoom_levels = set(zoom_levels) - set(
+        wmts_client.matrix_index.zoom_levels
+    )
+    if not zoom_levels or unavailable_zoom_levels:
+        parser.error(f"Unavailable zoom levels: {sorted(unavailable_zoom_levels)}.")
+    if arguments.layer not in wmts_client.list_available_layers():
+        parser.error(f"Unavailable layer: {arguments.layer}.")
+    areas = (
+        [tuple(arguments.bbox)]
+        if arguments.bbox
+        else read_geojson_polygons(arguments.geojson)
+    )
+
+    seeder = TileSeeder(
+        wmts_client,
+        max_concurrent_downloads=arguments.concurrency,
+        max_bytes_per_second=arguments.max_bandwidth * 1024**2
+        if arguments.max_bandwidth
+        else None,
+        progress_interval=arguments.progress_interval,
+    )
+    tile_keys, stored_tiles = seeder.plan(arguments.layer, zoom_levels, areas)
+    logger.info(
+        f"{len(tile_keys)} tiles to download, {stored_tiles} tiles already stored."
+    )
+    progress = asyncio.run(seeder.seed(tile_keys))
+    logger.info(
+        f"Downloaded {progress['downloaded']} tiles ({progress['bytes'] / 1024**2:.1f} MB) in "
+        f"{progress['duration']:.1f} s, {progress['failed']} failed."
+    )
+    # Tiles still missing either failed, or were evicted by the tiles seeded after them.
+    missing_tiles = len(seeder.plan(arguments.layer, zoom_levels, areas)[0])
+    if missing_tiles > progress["failed"]:
+        logger.warning(
+            f"{missing_tiles - progress['failed']} seeded tiles were evicted from the tile cache, whose disk budget is "
+            "too small for the region."
+        )
+    return 1 if missing_tiles else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
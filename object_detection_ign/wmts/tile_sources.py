@@ -0,0 +1,379 @@
+import os
+import math
+import anyio
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+import picologging as logging
+from abc import ABC, abstractmethod
+from typing import Optional
+from object_detection_ign.wmts.utils import (
+    PIXEL_SIZE_METERS,
+    PM_SCALE_DENOMINATOR,
+    PM_TOP_LEFT_CORNER,
+    TILE_SIZE,
+    TileMatrixIndex,
+)
+
+logging.basicConfig()
+logger = logging.getLogger()
+
+# Pseudo-Mercator tile matrix sets of GeoPackages are identified by their EPSG code.
+PSEUDO_MERCATOR_EPSG_CODE = 3857
+# Tile hashes are 16 bytes BLAKE2b digests.
+HASH_DTYPE = "S16"
+
+
+class TileNotFoundError(LookupError):
+    """Raised when a tile source does not hold a tile of its tile matrices, e.g. out of the area it covers."""
+
+
+class TileSource(ABC):
+    """A source of encoded tiles read by a WMTSClient in place of the WMTS server. The tiles follow the "PM"
+    TileMatrixSet of the IGN, whose index is `matrix_index`, so they are located with `compute_tile_position` and
+    assembled exactly like the tiles of the server.
+
+    Subclasses implement `get_tile`, and set `layers` and `matrix_index`.
+    """
+
+    layers: list
+    matrix_index: TileMatrixIndex
+
+    @abstractmethod
+    def get_tile(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        """Reads an encoded tile.
+
+        Args:
+            layer (str): name of the layer
+            zoom_level (int): zoom level of the tile
+            tile_row (int): WMTS row of the tile
+            tile_column (int): WMTS column of the tile
+
+        Raises:
+            TileNotFoundError: an error is raised when the source does not hold the tile
+
+        Returns:
+            bytes: the encoded tile
+        """
+
+    @abstractmethod
+    def list_tiles(self, layer: str, zoom_level: int) -> np.ndarray:
+        """Lists the tiles held by the source at a zoom level, e.g. to process a whole tile archive.
+
+        Args:
+            layer (str): name of the layer
+            zoom_level (int): zoom level of the tiles
+
+        Returns:
+            np.ndarray: a [N, 2] array of (tile row, tile column), in row-major order
+        """
+
+    @abstractmethod
+    def tile_hashes(self, layer: str, zoom_level: int) -> tuple[np.ndarray, np.ndarray]:
+        """Hashes the content of the tiles held by the source at a zoom level, e.g. to find the tiles which changed
+        between two snapshots of a layer without decoding them.
+
+        Args:
+            layer (str): name of the layer
+            zoom_level (int): zoom level of the tiles
+
+        Returns:
+            tiles (np.ndarray): a [N, 2] array of (tile row, tile column), in row-major order
+            hashes (np.ndarray): the [N] 16 bytes BLAKE2b digests of the encoded tiles
+        """
+
+    async def async_get_tile(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        """Asynchronous version of `get_tile`, which reads the tile in a worker thread."""
+        return await anyio.to_thread.run_sync(
+            self.get_tile, layer, zoom_level, tile_row, tile_column
+        )
+
+    def close(self):
+        """Releases the resources of the source."""
+
+
+class _SQLiteTileSource(TileSource):
+    """A tile source stored in a SQLite database, opened read-only with one connection per thread. The file is memory
+    mapped by SQLite, up to `mmap_size` bytes: tiles are then copied from the page cache, without a read call per tile.
+    """
+
+    def __init__(self, path: str, mmap_size: int):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"The tile source {path} does not exist.")
+        self.path: str = path
+        self.mmap_size: int = mmap_size
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+            connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _read_tile(self, query: str, parameters: tuple, tile_key: tuple) -> bytes:
+        row = self._connection().execute(query, parameters).fetchone()
+        if row is None:
+            raise TileNotFoundError(f"{self.path} does not hold the tile {tile_key}.")
+        return bytes(row[0])
+
+    def _list_tiles(self, query: str, parameters: tuple) -> np.ndarray:
+        tiles = np.array(
+            self._connection().execute(query, parameters).fetchall(), dtype="int64"
+        ).reshape(-1, 2)
+        return tiles[np.lexsort((tiles[:, 1], tiles[:, 0]))]
+
+    def _tile_hashes(
+        self, query: str, parameters: tuple, batch_size: int = 4096
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # Rows are streamed by the cursor, so that only a batch of tiles at a time is held in memory. The digests are
+        # stored in arrays rather than in a dictionary, which would cost a few hundred bytes per tile.
+        cursor = self._connection().execute(query, parameters)
+        tile_batches, hash_batches = [], []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            tile_batches.append(
+                np.array([(row, column) for row, column, _ in rows], dtype="int64")
+            )
+            hash_batches.append(
+                np.array(
+                    [
+                        hashlib.blake2b(tile_data, digest_size=16).digest()
+                        for _, _, tile_data in rows
+                    ],
+                    dtype=HASH_DTYPE,
+                )
+            )
+        if not tile_batches:
+            return np.zeros((0, 2), dtype="int64"), np.zeros(0, dtype=HASH_DTYPE)
+        tiles, hashes = np.concatenate(tile_batches), np.concatenate(hash_batches)
+        order = np.lexsort((tiles[:, 1], tiles[:, 0]))
+        return tiles[order], hashes[order]
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class MBTilesSource(_SQLiteTileSource):
+    """Reads tiles from an MBTiles file, which holds a single layer of web mercator tiles. MBTiles rows follow the TMS
+    scheme, counted from the bottom of the matrix: they are flipped into WMTS rows.
+
+    Args:
+        path (str): path of the MBTiles file
+        layer (str, optional): name under which the layer is served. Defaults to None (the name in the metadata of the
+            file, or else the file name).
+        mmap_size (int, optional): maximal size of the memory mapping of the file, in bytes. Defaults to 256 MB.
+    """
+
+    def __init__(
+        self, path: str, layer: Optional[str] = None, mmap_size: int = 256 * 1024**2
+    ):
+        super().__init__(path, mmap_size)
+        connection = self._connection()
+        metadata = dict(connection.execute("SELECT name, value FROM metadata"))
+        self.layer: str = (
+            layer or metadata.get("name") or os.path.splitext(os.path.basename(path))[0]
+        )
+        self.layers: list = [self.layer]
+        self.matrix_index: TileMatrixIndex = TileMatrixIndex.pseudo_mercator(
+            zoom_level
+            for (zoom_level,) in connection.execute(
+                "SELECT DISTINCT zoom_level FROM tiles"
+            )
+        )
+
+    def get_tile(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        tile_key = (layer, zoom_level, tile_row, tile_column)
+        if layer != self.layer:
+            raise TileNotFoundError(f"{self.path} does not hold the layer {layer}.")
+        return self._read_tile(
+            """SELECT tile_data FROM tiles
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+            (zoom_level, tile_column, 2**zoom_level - 1 - tile_row),
+            tile_key,
+        )
+
+    def list_tiles(self, layer: str, zoom_level: int) -> np.ndarray:
+        if layer != self.layer:
+            return np.zeros((0, 2), dtype="int64")
+        return self._list_tiles(
+            "SELECT ? - tile_row, tile_column FROM tiles WHERE zoom_level = ?",
+            (2**zoom_level - 1, zoom_level),
+        )
+
+    def tile_hashes(self, layer: str, zoom_level: int) -> tuple[np.ndarray, np.ndarray]:
+        if layer != self.layer:
+            return np.zeros((0, 2), dtype="int64"), np.zeros(0, dtype=HASH_DTYPE)
+        return self._tile_hashes(
+            "SELECT ? - tile_row, tile_column, tile_data FROM tiles WHERE zoom_level = ?",
+            (2**zoom_level - 1, zoom_level),
+        )
+
+
+class GeoPackageSource(_SQLiteTileSource):
+    """Reads tiles from a GeoPackage, whose tile tables are served as layers under their table name. Only tile tables
+    aligned on the "PM" TileMatrixSet are served: in EPSG:3857, with 256 pixels tiles whose size matches a PM zoom
+    level, and an origin on a PM tile corner. Their matrices may only cover a region, and their zoom levels may be
+    numbered differently: each GeoPackage zoom level is mapped to the PM zoom level with the same tile size, and the
+    tile positions are shifted by the position of the origin.
+
+    Args:
+        path (str): path of the GeoPackage file
+        mmap_size (int, optional): maximal size of the memory mapping of the file, in bytes. Defaults to 256 MB.
+
+    Raises:
+        ValueError: an error is raised when the GeoPackage has no tile table aligned on the PM TileMatrixSet
+    """
+
+    def __init__(self, path: str, mmap_size: int = 256 * 1024**2):
+        super().__init__(path, mmap_size)
+        connection = self._connection()
+        # (GeoPackage zoom level, row offset, column offset) keyed by (layer, PM zoom level).
+        self._matrices: dict[tuple[str, int], tuple[int, int, int]] = {}
+        tile_width_meters_zoom_0 = PM_SCALE_DENOMINATOR * PIXEL_SIZE_METERS * TILE_SIZE
+        for (
+            table_name,
+            organization,
+            organization_code,
+            min_x,
+            max_y,
+        ) in connection.execute(
+            """SELECT contents.table_name, srs.organization, srs.organization_coordsys_id,
+                matrix_set.min_x, matrix_set.max_y
+            FROM gpkg_contents AS contents
+            JOIN gpkg_tile_matrix_set AS matrix_set ON matrix_set.table_name = contents.table_name
+            JOIN gpkg_spatial_ref_sys AS srs ON srs.srs_id = matrix_set.srs_id
+            WHERE contents.data_type = 'tiles'"""
+        ).fetchall():
+            if (
+                organization.upper() != "EPSG"
+                or organization_code != PSEUDO_MERCATOR_EPSG_CODE
+            ):
+                logger.warning(
+                    f"The tile table {table_name} is not in EPSG:{PSEUDO_MERCATOR_EPSG_CODE}, it is ignored."
+                )
+                continue
+            for zoom_level, tile_width, tile_height, pixel_x_size in connection.execute(
+                """SELECT zoom_level, tile_width, tile_height, pixel_x_size
+                FROM gpkg_tile_matrix WHERE table_name = ?""",
+                (table_name,),
+            ).fetchall():
+                tile_width_meters = pixel_x_size * tile_width
+                pm_zoom_level = round(
+                    math.log2(tile_width_meters_zoom_0 / tile_width_meters)
+                )
+                column_offset = (min_x - PM_TOP_LEFT_CORNER[0]) / tile_width_meters
+                row_offset = (PM_TOP_LEFT_CORNER[1] - max_y) / tile_width_meters
+                if (
+                    tile_width != TILE_SIZE
+                    or tile_height != TILE_SIZE
+                    or not math.isclose(
+                        tile_width_meters,
+                        tile_width_meters_zoom_0 / 2**pm_zoom_level,
+                        rel_tol=1e-9,
+                    )
+                    or abs(column_offset - round(column_offset)) > 1e-6
+                    or abs(row_offset - round(row_offset)) > 1e-6
+                ):
+                    logger.warning(
+                        f"The zoom level {zoom_level} of the tile table {table_name} is not aligned on the PM "
+                        "TileMatrixSet, it is ignored."
+                    )
+                    continue
+                self._matrices[(table_name, pm_zoom_level)] = (
+                    zoom_level,
+                    round(row_offset),
+                    round(column_offset),
+                )
+        if not self._matrices:
+            raise ValueError(
+                f"{path} has no tile table aligned on the PM TileMatrixSet."
+            )
+        self.layers: list = sorted(set(layer for layer, _ in self._matrices))
+        self.matrix_index: TileMatrixIndex = TileMatrixIndex.pseudo_mercator(
+            set(zoom_level for _, zoom_level in self._matrices)
+        )
+
+    def get_tile(
+        self, layer: str, zoom_level: int, tile_row: int, tile_column: int
+    ) -> bytes:
+        tile_key = (layer, zoom_level, tile_row, tile_column)
+        matrix = self._matrices.get((layer, zoom_level))
+        if matrix is None:
+            raise TileNotFoundError(f"{self.path} does not hold the tile {tile_key}.")
+        geopackage_zoom_level, row_offset, column_offset = matrix
+        # Table names are not parameters, they can only come from gpkg_contents through the lookup above.
+        return self._read_tile(
+            f"""SELECT tile_data FROM "{layer}"
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?""",
+            (
+                geopackage_zoom_level,
+                tile_column - column_offset,
+                tile_row - row_offset,
+            ),
+            tile_key,
+        )
+
+    def list_tiles(self, layer: str, zoom_level: int) -> np.ndarray:
+        matrix = self._matrices.get((layer, zoom_level))
+        if matrix is None:
+            return np.zeros((0, 2), dtype="int64")
+        geopackage_zoom_level, row_offset, column_offset = matrix
+        return self._list_tiles(
+            f"""SELECT tile_row + ?, tile_column + ? FROM "{layer}" WHERE zoom_level = ?""",
+            (row_offset, column_offset, geopackage_zoom_level),
+        )
+
+    def tile_hashes(self, layer: str, zoom_level: int) -> tuple[np.ndarray, np.ndarray]:
+        matrix = self._matrices.get((layer, zoom_level))
+        if matrix is None:
+            return np.zeros((0, 2), dtype="int64"), np.zeros(0, dtype=HASH_DTYPE)
+        geopackage_zoom_level, row_offset, column_offset = matrix
+        return self._tile_hashes(
+            f"""SELECT tile_row + ?, tile_column + ?, tile_data FROM "{layer}" WHERE zoom_level = ?""",
+            (row_offset, column_offset, geopackage_zoom_level),
+        )
+
+
+def open_tile_source(
+    path: str, layer: Optional[str] = None, mmap_size: int = 256 * 1024**2
+) -> TileSource:
+    """Opens a local tile source, whose type is given by the extension of its file: .mbtiles or .gpkg.
+
+    Args:
+        path (str): path of the tile source
+        layer (str, optional): name of the layer of an MBTiles file. Defaults to None (the name in its metadata).
+        mmap_size (int, optional): maximal size of the memory mapping of the file, in bytes. Defaults to 256 MB.
+
+    Raises:
+        ValueError: an error is raised when the type of the file is not supported
+
+    Returns:
+        TileSource: the tile source
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".mbtiles":
+        return MBTilesSource(path, layer=layer, mmap_size=mmap_size)
+    elif extension == ".gpkg":
+        return GeoPackageSource(path, mmap_size=mmap_size)
+    raise ValueError(f"Unsupported tile source {path}, expected .mbtiles or .gpkg.")
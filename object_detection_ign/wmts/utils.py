@@ -1,31 +1,250 @@
+import math
+import weakref
+import threading
+import numpy as np
+from typing import Union
 from pyproj import CRS, Transformer
-from owslib.wmts import TileMatrix, TileMatrixSet
+from owslib.wmts import TileMatrixSet
+
+_thread_local = threading.local()
+
+TILE_SIZE = 256
+# Size of a pixel in meters at a scale denominator of 1, as defined by the WMTS standard.
+PIXEL_SIZE_METERS = 0.00028
+# Top left corner in meters and scale denominator at zoom level 0 of the "PM" (Pseudo-Mercator) TileMatrixSet.
+PM_TOP_LEFT_CORNER = (-20037508.3427892, 20037508.3427892)
+PM_SCALE_DENOMINATOR = 559082264.0287178
+
+
+class TileMatrixIndex:
+    """A compact index of a TileMatrixSet, compiled once when the capabilities are loaded. Each tile matrix is a row
+    of a single array indexed by zoom level, holding its (x, y) top left corner in meters, its tile width in meters and
+    its height and width in tiles. Lookups are thus an array access, instead of parsing the owslib TileMatrix strings and
+    recomputing the tile width on every call.
+
+    Args:
+        matrix_set (TileMatrixSet): the WMTS matrix set. Matrices whose identifier is not a zoom level are ignored.
+    """
+
+    def __init__(self, matrix_set: TileMatrixSet):
+        zoom_levels = {
+            int(identifier): tile_matrix
+            for identifier, tile_matrix in matrix_set.tilematrix.items()
+            if str(identifier).isdigit()
+        }
+        self._set_matrices(
+            {
+                zoom_level: (
+                    *map(float, tile_matrix.topleftcorner),
+                    tile_matrix.scaledenominator
+                    * PIXEL_SIZE_METERS
+                    * tile_matrix.tilewidth,
+                    tile_matrix.matrixheight,
+                    tile_matrix.matrixwidth,
+                )
+                for zoom_level, tile_matrix in zoom_levels.items()
+            }
+        )
+
+    @classmethod
+    def pseudo_mercator(cls, zoom_levels) -> "TileMatrixIndex":
+        """Builds the index of the "PM" TileMatrixSet served by the IGN, without any capabilities document, for tile
+        sources which are not WMTS servers. The matrix of zoom level z has 2^z rows and columns of 256 pixels tiles,
+        the same as the XYZ tiles of web maps.
+
+        Args:
+            zoom_levels (iterable): zoom levels of the matrices
+
+        Returns:
+            TileMatrixIndex: the index of the matrix set
+        """
+        matrix_index = cls.__new__(cls)
+        matrix_index._set_matrices(
+            {
+                zoom_level: (
+                    *PM_TOP_LEFT_CORNER,
+                    PM_SCALE_DENOMINATOR
+                    / 2**zoom_level
+                    * PIXEL_SIZE_METERS
+                    * TILE_SIZE,
+                    2**zoom_level,
+                    2**zoom_level,
+                )
+                for zoom_level in zoom_levels
+            }
+        )
+        return matrix_index
+
+    def _set_matrices(self, matrices: dict):
+        self.zoom_levels: list[int] = sorted(matrices)
+        # Columns: x0, y0, tile width in meters, matrix height, matrix width. Missing zoom levels are NaN rows.
+        self.matrices: np.ndarray = np.full(
+            (max(self.zoom_levels, default=-1) + 1, 5), np.nan
+        )
+        for zoom_level, matrix in matrices.items():
+            self.matrices[zoom_level] = matrix
+
+    def matrix(self, zoom_level: int) -> tuple[float, float, float, int, int]:
+        """Looks a tile matrix up.
+
+        Args:
+            zoom_level (int): zoom level of the tile matrix
+
+        Raises:
+            ValueError: an error is raised when the matrix set has no matrix at this zoom level
+
+        Returns:
+            tuple: the (x0, y0) top left corner and tile width in meters, and the height and width in tiles of the matrix
+        """
+        if not 0 <= zoom_level < len(self.matrices) or np.isnan(
+            self.matrices[zoom_level, 0]
+        ):
+            raise ValueError(f"The matrix set has no zoom level {zoom_level}.")
+        x0, y0, tile_width_meters, matrix_height, matrix_width = self.matrices[
+            zoom_level
+        ].tolist()
+        return x0, y0, tile_width_meters, int(matrix_height), int(matrix_width)
+
+    def contains(
+        self, zoom_level: int, tile_rows: np.ndarray, tile_columns: np.ndarray
+    ) -> np.ndarray:
+        """Tells whether positions on the tile grid, fractional or not, lie inside the limits of a tile matrix.
+
+        Args:
+            zoom_level (int): zoom level of the tile matrix
+            tile_rows (np.ndarray): the rows of the positions
+            tile_columns (np.ndarray): the columns of the positions
+
+        Returns:
+            np.ndarray: a boolean per position, False for NaN positions
+        """
+        _, _, _, matrix_height, matrix_width = self.matrix(zoom_level)
+        tile_rows, tile_columns = np.asarray(tile_rows), np.asarray(tile_columns)
+        return (
+            (tile_rows >= 0)
+            & (tile_rows < matrix_height)
+            & (tile_columns >= 0)
+            & (tile_columns < matrix_width)
+        )
+
+    def check_window(
+        self,
+        zoom_level: int,
+        pixel_row: int,
+        pixel_column: int,
+        height: int,
+        width: int,
+    ):
+        """Checks that a window of the tile grid only overlaps tiles of the matrix, so that no request is sent for a tile
+        which does not exist.
+
+        Args:
+            zoom_level (int): zoom level of the tile matrix
+            pixel_row (int): row of the top left pixel of the window, in pixels of the whole tile grid
+            pixel_column (int): column of the top left pixel of the window, in pixels of the whole tile grid
+            height (int): height of the window in pixels
+            width (int): width of the window in pixels
+
+        Raises:
+            ValueError: an error is raised when the window goes beyond the limits of the matrix
+        """
+        _, _, _, matrix_height, matrix_width = self.matrix(zoom_level)
+        if (
+            pixel_row < 0
+            or pixel_column < 0
+            or pixel_row + height > matrix_height * TILE_SIZE
+            or pixel_column + width > matrix_width * TILE_SIZE
+        ):
+            raise ValueError(
+                f"The window {pixel_row, pixel_column, height, width} is out of the tile matrix {zoom_level}."
+            )
+
+
+_matrix_indexes: "weakref.WeakKeyDictionary[TileMatrixSet, TileMatrixIndex]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_matrix_index(
+    matrix_set: Union[TileMatrixSet, TileMatrixIndex]
+) -> TileMatrixIndex:
+    """Returns the index of a matrix set, compiled on the first call for this matrix set.
+
+    Args:
+        matrix_set (TileMatrixSet|TileMatrixIndex): a WMTS matrix set, or its index
+
+    Returns:
+        TileMatrixIndex: the index of the matrix set
+    """
+    if isinstance(matrix_set, TileMatrixIndex):
+        return matrix_set
+    matrix_index = _matrix_indexes.get(matrix_set)
+    if matrix_index is None:
+        matrix_index = _matrix_indexes[matrix_set] = TileMatrixIndex(matrix_set)
+    return matrix_index
+
+
+def _get_coordinates_transformer(to_gps: bool = False) -> Transformer:
+    """Returns the GPS (EPSG 4326) to Mercator (EPSG 3857) transformer of the current thread. Building a transformer is
+    far more expensive than a projection, so it is built once per thread (pyproj transformers are not thread-safe).
+
+    Args:
+        to_gps (bool, optional): returns the Mercator to GPS transformer instead. Defaults to False.
+
+    Returns:
+        Transformer: a pyproj Transformer
+    """
+    attribute = "to_gps_transformer" if to_gps else "coordinates_transformer"
+    coordinates_transformer = getattr(_thread_local, attribute, None)
+    if coordinates_transformer is None:
+        gps_crs, mercator_crs = CRS("EPSG:4326"), CRS("EPSG:3857")
+        coordinates_transformer = (
+            Transformer.from_crs(mercator_crs, gps_crs, always_xy=True)
+            if to_gps
+            else Transformer.from_crs(gps_crs, mercator_crs, always_xy=True)
+        )
+        setattr(_thread_local, attribute, coordinates_transformer)
+    return coordinates_transformer
 
 
 def _convert_coordinates(longitude: float, latitude: float) -> tuple[float, float]:
     """Takes GPS coordinates (EPSG 4326) as input and converts them to the Mercator projection (EPSG 3857).
     This function is used to easily find coordinates on a GPS-enabled system such as Google Maps or OpenStreetMap, and
-    to convert them to a format compatible with the WMTS format.
+    to convert them to a format compatible with the WMTS format. NumPy arrays of coordinates are converted at once.
 
     Args:
-        longitude (float): GPS longitude
-        latitude (float): GPS latitude
+        longitude (float|np.ndarray): GPS longitude
+        latitude (float|np.ndarray): GPS latitude
 
     Returns:
-        x (float): Mercator longitude
-        y (float): Mercator latitude
+        x (float|np.ndarray): Mercator longitude
+        y (float|np.ndarray): Mercator latitude
     """
-    gps_crs = CRS("EPSG:4326")
-    mercator_crs = CRS("EPSG:3857")
-    coordinates_transformer = Transformer.from_crs(
-        gps_crs, mercator_crs, always_xy=True
-    )
-    x, y = coordinates_transformer.transform(longitude, latitude)
+    x, y = _get_coordinates_transformer().transform(longitude, latitude)
     return x, y
 
 
+def _convert_coordinates_to_gps(x: float, y: float) -> tuple[float, float]:
+    """Takes Mercator coordinates (EPSG 3857) as input and converts them to GPS coordinates (EPSG 4326). This is the
+    inverse of `_convert_coordinates`.
+
+    Args:
+        x (float|np.ndarray): Mercator longitude
+        y (float|np.ndarray): Mercator latitude
+
+    Returns:
+        longitude (float|np.ndarray): GPS longitude
+        latitude (float|np.ndarray): GPS latitude
+    """
+    longitude, latitude = _get_coordinates_transformer(to_gps=True).transform(x, y)
+    return longitude, latitude
+
+
 def compute_tile_position(
-    matrix_set: TileMatrixSet, zoom_level: int, longitude: float, latitude: float
+    matrix_set: Union[TileMatrixSet, TileMatrixIndex],
+    zoom_level: int,
+    longitude: float,
+    latitude: float,
 ) -> tuple[int, int]:
     """Locates the tile containing the targeted location. It is located on a matrix set, i.e a grid containing multiples tiles
     defined by their row and column. The row and the column are obtained by converting the width and length in meters: this operation
@@ -34,24 +253,241 @@ def compute_tile_position(
     computed to accomodate WMTS servers using rectangular tiles.
 
     Args:
-        matrix_set (TileMatrixSet): the WMTS matrix set. There is one matrix set per zoom level. It contains rows and columns
+        matrix_set (TileMatrixSet|TileMatrixIndex): the WMTS matrix set, or its index. There is one matrix per zoom
+            level. It contains rows and columns
         zoom_level (int): zoom level to use on the WMTS server
         longitude (float): the longitude of the point contained in the desired tile
         latitude (float): the latitude of the point contained in the desired tile
 
+    Raises:
+        ValueError: an error is raised when the zoom level is not in the matrix set, or when the point is out of the
+            limits of its matrix
+
     Returns:
         tile_row (int): the row of the desired tile in the matrix set
         tile_column (int): the column of the desired tile in the matrix set
     """
-
-    # TileMatrixSet.tilematrix is a dictionnary containing the matrices !
-    matrix_set_dict: dict[str, TileMatrix] = matrix_set.tilematrix
-    target_matrix = matrix_set_dict[str(zoom_level)]
-    tile_width_meters = target_matrix.scaledenominator * 0.00028 * 256
-    print(f"Tile width in meters : {tile_width_meters}")
-    x0, y0 = map(lambda x: float(x), target_matrix.topleftcorner)
+    x0, y0, tile_width_meters, matrix_height, matrix_width = get_matrix_index(
+        matrix_set
+    ).matrix(zoom_level)
     x, y = _convert_coordinates(longitude=longitude, latitude=latitude)
-    print(f"X = {x}, Y = {y}, identifier = {target_matrix.identifier}")
     tile_col, tile_row = (x - x0) / tile_width_meters, (y0 - y) / tile_width_meters
-    tile_col, tile_row = int(round(tile_col, 0)), int(round(tile_row, 0))
-    return tile_row, tile_col
+    if not (0 <= tile_row < matrix_height and 0 <= tile_col < matrix_width):
+        raise ValueError(
+            f"The point {latitude, longitude} is out of the tile matrix {zoom_level}."
+        )
+    return math.floor(tile_row), math.floor(tile_col)
+
+
+def compute_tile_positions(
+    matrix_set: Union[TileMatrixSet, TileMatrixIndex],
+    zoom_level: int,
+    longitudes: np.ndarray,
+    latitudes: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Vectorized version of `compute_tile_position`, which locates the tiles containing many locations at once. Points
+    out of the limits of the matrix are not rejected, they can be filtered with `TileMatrixIndex.contains`.
+
+    Args:
+        matrix_set (TileMatrixSet|TileMatrixIndex): the WMTS matrix set, or its index. There is one matrix per zoom
+            level. It contains rows and columns
+        zoom_level (int): zoom level to use on the WMTS server
+        longitudes (np.ndarray): the longitudes of the points
+        latitudes (np.ndarray): the latitudes of the points
+
+    Returns:
+        tile_rows (np.ndarray): the rows of the tiles in the matrix set
+        tile_columns (np.ndarray): the columns of the tiles in the matrix set
+    """
+    tile_rows, tile_columns = compute_fractional_tile_positions(
+        matrix_set, zoom_level, longitudes, latitudes
+    )
+    return np.floor(tile_rows).astype("int64"), np.floor(tile_columns).astype("int64")
+
+
+def compute_fractional_tile_positions(
+    matrix_set: Union[TileMatrixSet, TileMatrixIndex],
+    zoom_level: int,
+    longitudes: np.ndarray,
+    latitudes: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Converts GPS coordinates to continuous positions on the tile grid: the integer part is the tile containing the
+    point, and the fractional part its position inside the tile (multiplied by 256, it gives the pixel).
+
+    Args:
+        matrix_set (TileMatrixSet|TileMatrixIndex): the WMTS matrix set, or its index. There is one matrix per zoom
+            level. It contains rows and columns
+        zoom_level (int): zoom level to use on the WMTS server
+        longitudes (np.ndarray): the longitudes of the points
+        latitudes (np.ndarray): the latitudes of the points
+
+    Returns:
+        tile_rows (np.ndarray): the fractional rows of the points in the matrix set
+        tile_columns (np.ndarray): the fractional columns of the points in the matrix set
+    """
+    x0, y0, tile_width_meters, _, _ = get_matrix_index(matrix_set).matrix(zoom_level)
+    x, y = _convert_coordinates(
+        longitude=np.asarray(longitudes, dtype="float64"),
+        latitude=np.asarray(latitudes, dtype="float64"),
+    )
+    return (y0 - y) / tile_width_meters, (x - x0) / tile_width_meters
+
+
+def tile_positions_to_coordinates(
+    matrix_set: Union[TileMatrixSet, TileMatrixIndex],
+    zoom_level: int,
+    tile_rows: np.ndarray,
+    tile_columns: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Converts continuous positions on the tile grid back to GPS coordinates. This is the inverse of
+    `compute_fractional_tile_positions`.
+
+    Args:
+        matrix_set (TileMatrixSet|TileMatrixIndex): the WMTS matrix set, or its index. There is one matrix per zoom
+            level. It contains rows and columns
+        zoom_level (int): zoom level to use on the WMTS server
+        tile_rows (np.ndarray): the fractional rows of the points in the matrix set
+        tile_columns (np.ndarray): the fractional columns of the points in the matrix set
+
+    Returns:
+        longitudes (np.ndarray): the longitudes of the points
+        latitudes (np.ndarray): the latitudes of the points
+    """
+    x0, y0, tile_width_meters, _, _ = get_matrix_index(matrix_set).matrix(zoom_level)
+    x = x0 + np.asarray(tile_columns, dtype="float64") * tile_width_meters
+    y = y0 - np.asarray(tile_rows, dtype="float64") * tile_width_meters
+    return _convert_coordinates_to_gps(x, y)
+
+
+def _points_in_polygon(
+    rows: np.ndarray, columns: np.ndarray, polygon_rows, polygon_columns
+) -> np.ndarray:
+    """Vectorized ray casting test, which returns whether each point lies inside the polygon."""
+    inside = np.zeros(rows.shape, dtype=bool)
+    previous_rows, previous_columns = np.roll(polygon_rows, 1), np.roll(
+        polygon_columns, 1
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for row_i, column_i, row_j, column_j in zip(
+            polygon_rows, polygon_columns, previous_rows, previous_columns
+        ):
+            crossing_column = (column_j - column_i) * (rows - row_i) / (
+                row_j - row_i
+            ) + column_i
+            inside ^= ((row_i > rows) != (row_j > rows)) & (columns < crossing_column)
+    return inside
+
+
+def compute_covering_tiles(
+    matrix_set: Union[TileMatrixSet, TileMatrixIndex], zoom_level: int, area
+) -> np.ndarray:
+    """Lists every tile covering an area, given either as a bounding box or as a polygon. For a polygon, a tile is kept
+    when its center or one of its corners lies inside the polygon, or when it contains one of the polygon vertices.
+    Tiles out of the limits of the matrix are dropped.
+
+    Args:
+        matrix_set (TileMatrixSet|TileMatrixIndex): the WMTS matrix set, or its index. There is one matrix per zoom
+            level. It contains rows and columns
+        zoom_level (int): zoom level to use on the WMTS server
+        area (tuple|list): a (min_longitude, min_latitude, max_longitude, max_latitude) bounding box, or a list of
+            (longitude, latitude) polygon vertices
+
+    Returns:
+        np.ndarray: a [N, 2] array of (tile row, tile column), in row-major order
+    """
+    if len(area) == 4 and all(np.isscalar(value) for value in area):
+        min_longitude, min_latitude, max_longitude, max_latitude = area
+        vertices = np.array(
+            [
+                (min_longitude, min_latitude),
+                (max_longitude, min_latitude),
+                (max_longitude, max_latitude),
+                (min_longitude, max_latitude),
+            ]
+        )
+        is_bounding_box = True
+    else:
+        vertices, is_bounding_box = np.asarray(area, dtype="float64"), False
+    polygon_rows, polygon_columns = compute_fractional_tile_positions(
+        matrix_set, zoom_level, vertices[:, 0], vertices[:, 1]
+    )
+    rows, columns = np.meshgrid(
+        np.arange(np.floor(polygon_rows.min()), np.floor(polygon_rows.max()) + 1),
+        np.arange(np.floor(polygon_columns.min()), np.floor(polygon_columns.max()) + 1),
+        indexing="ij",
+    )
+    tiles = np.stack([rows.ravel(), columns.ravel()], axis=1).astype("int64")
+    tiles = tiles[
+        get_matrix_index(matrix_set).contains(zoom_level, tiles[:, 0], tiles[:, 1])
+    ]
+    if is_bounding_box:
+        return tiles
+
+    covered = np.zeros(len(tiles), dtype=bool)
+    for row_offset, column_offset in ((0, 0), (0, 1), (1, 0), (1, 1), (0.5, 0.5)):
+        covered |= _points_in_polygon(
+            tiles[:, 0] + row_offset,
+            tiles[:, 1] + column_offset,
+            polygon_rows,
+            polygon_columns,
+        )
+    vertex_tiles = set(
+        zip(np.floor(polygon_rows).astype(int), np.floor(polygon_columns).astype(int))
+    )
+    covered |= np.array([(row, column) in vertex_tiles for row, column in tiles])
+    return tiles[covered]
+
+
+def window_tile_positions(
+    pixel_row: int, pixel_column: int, height: int, width: int
+) -> list:
+    """Lists the (row, column) of the tiles overlapped by a window of the tile grid, in row-major order.
+
+    Args:
+        pixel_row (int): row of the top left pixel of the window, in pixels of the whole tile grid
+        pixel_column (int): column of the top left pixel of the window, in pixels of the whole tile grid
+        height (int): height of the window in pixels
+        width (int): width of the window in pixels
+
+    Returns:
+        list: the (row, column) positions of the tiles
+    """
+    return [
+        (tile_row, tile_column)
+        for tile_row in range(
+            pixel_row // TILE_SIZE, (pixel_row + height - 1) // TILE_SIZE + 1
+        )
+        for tile_column in range(
+            pixel_column // TILE_SIZE, (pixel_column + width - 1) // TILE_SIZE + 1
+        )
+    ]
+
+
+def paste_tiles(
+    destination: np.ndarray, get_tile_array, pixel_row: int, pixel_column: int
+):
+    """Writes a window of the tile grid into a [height, width, 3] array, copying each overlapped tile part directly to
+    its place. The pixels are converted to the dtype of the destination during the copy.
+
+    Args:
+        destination (np.ndarray): the [height, width, 3] array to fill, e.g. a view on a model input tensor
+        get_tile_array (callable): returns the decoded [256, 256, 3] tile at a given (row, column)
+        pixel_row (int): row of the top left pixel of the window, in pixels of the whole tile grid
+        pixel_column (int): column of the top left pixel of the window, in pixels of the whole tile grid
+    """
+    height, width = destination.shape[:2]
+    for tile_row, tile_column in window_tile_positions(
+        pixel_row, pixel_column, height, width
+    ):
+        tile_array = get_tile_array(tile_row, tile_column)
+        top = max(pixel_row, tile_row * TILE_SIZE)
+        bottom = min(pixel_row + height, (tile_row + 1) * TILE_SIZE)
+        left = max(pixel_column, tile_column * TILE_SIZE)
+        right = min(pixel_column + width, (tile_column + 1) * TILE_SIZE)
+        destination[
+            top - pixel_row : bottom - pixel_row,
+            left - pixel_column : right - pixel_column,
+        ] = tile_array[
+            top - tile_row * TILE_SIZE : bottom - tile_row * TILE_SIZE,
+            left - tile_column * TILE_SIZE : right - tile_column * TILE_SIZE,
+        ]
@@ -0,0 +1,464 @@
+"""Offline benchmark of the API endpoints, served by local WMTS and Nominatim stand-ins and stub interpreters.
+
+Each scenario sends the same request repeatedly with a fixed concurrency, and reports its throughput, the p50/p95/p99
+latencies of the requests and of each stage of the pipeline. The report is compared to the baseline stored in
+`tests/benchmark_baseline.json`, and the run fails when a scenario regressed beyond the tolerance.
+
+The rendering benchmark measures the time spent drawing detections against their number, for the per-box ImageDraw
+drawing the API used to do, and for the AnnotationRenderer with outlines drawn box by box or all at once.
+
+The pipeline benchmark runs the offline detection pipeline over a synthetic MBTiles archive with an increasing number
+of worker processes, and reports its throughput in tiles per second. It scales with the number of cores of the machine.
+
+Usage, from the root of the repository:
+    python -m tests.benchmark                     # compares the run to the baseline
+    python -m tests.benchmark --update-baseline   # stores the run as the new baseline
+    python -m tests.benchmark --rendering         # only runs the rendering benchmark
+    python -m tests.benchmark --pipeline          # only runs the offline pipeline benchmark
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import functools
+import asyncio
+import argparse
+import httpx
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from starlite import Starlite
+from object_detection_ign.api.instrumentation import StageMetrics
+from object_detection_ign.detector.annotation import (
+    DEFAULT_FONT_PATH,
+    AnnotationRenderer,
+)
+from object_detection_ign.detector.detection_writers import GeoPackageDetectionWriter
+from object_detection_ign.detector.offline_pipeline import run_pipeline
+from tests.stand_ins import (
+    LocalNominatimServer,
+    LocalWMTSServer,
+    StubInterpreter,
+    create_stand_in_app,
+    write_synthetic_mbtiles,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+
+ADDRESS = "E.Leclerc, 60290 Cauffry"
+LATITUDE, LONGITUDE = 48.83980726885963, -1.5490468522920273
+LAYER = "HR.ORTHOIMAGERY.ORTHOPHOTOS"
+
+SCENARIOS = {
+    "address/png": (
+        "/inference/address",
+        {"address": ADDRESS, "layer": LAYER, "zoom_level": 19},
+    ),
+    "location/png": (
+        "/inference/location",
+        {
+            "latitude": LATITUDE,
+            "longitude": LONGITUDE,
+            "layer": LAYER,
+            "zoom_level": 19,
+        },
+    ),
+    "location/jpeg": (
+        "/inference/location",
+        {
+            "latitude": LATITUDE,
+            "longitude": LONGITUDE,
+            "layer": LAYER,
+            "zoom_level": 19,
+            "output_format": "jpeg",
+        },
+    ),
+    "location/json": (
+        "/inference/location",
+        {
+            "latitude": LATITUDE,
+            "longitude": LONGITUDE,
+            "layer": LAYER,
+            "zoom_level": 19,
+            "output_format": "json",
+        },
+    ),
+}
+PERCENTILES = (50, 95, 99)
+
+
+class RecordingStageMetrics(StageMetrics):
+    """StageMetrics which also keep every duration, to compute exact percentiles of each stage."""
+
+    def __init__(self):
+        super().__init__()
+        self.durations: dict[str, list] = {}
+
+    def observe(self, stage: str, duration: float):
+        super().observe(stage, duration)
+        self.durations.setdefault(stage, []).append(duration)
+
+
+def _percentiles(durations: list) -> dict:
+    return {
+        f"p{percentile}": float(np.percentile(durations, percentile))
+        for percentile in PERCENTILES
+    }
+
+
+async def _run_scenario(
+    app: Starlite, path: str, data: dict, requests_count: int, concurrency: int
+) -> tuple[float, list]:
+    transport = httpx.ASGITransport(app=app)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://benchmark", timeout=60
+    ) as client:
+
+        async def send_request():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(path, json=data)
+                latencies.append(time.perf_counter() - start)
+            if response.status_code >= 300:
+                raise RuntimeError(
+                    f"{path} answered {response.status_code}: {response.text}"
+                )
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send_request() for _ in range(requests_count)))
+        elapsed_time = time.perf_counter() - start
+    return elapsed_time, latencies
+
+
+def run_benchmark(
+    requests_count: int = 40,
+    concurrency: int = 4,
+    interpreters: int = 1,
+    invoke_time: float = 0.01,
+    tile_latency: float = 0.01,
+    geocoding_latency: float = 0.02,
+    scenarios: dict = SCENARIOS,
+) -> dict:
+    """Runs every scenario against a stand-in app, after one warm-up request.
+
+    Args:
+        requests_count (int, optional): number of requests of each scenario. Defaults to 40.
+        concurrency (int, optional): number of requests in flight at the same time. Defaults to 4.
+        interpreters (int, optional): number of stub interpreters in the pool. Defaults to 1.
+        invoke_time (float, optional): duration of an invoke of the stub interpreters in seconds. Defaults to 0.01.
+        tile_latency (float, optional): latency of the WMTS stand-in in seconds. Defaults to 0.01.
+        geocoding_latency (float, optional): latency of the Nominatim stand-in in seconds. Defaults to 0.02.
+        scenarios (dict, optional): (path, json data) of each scenario, keyed by name. Defaults to SCENARIOS.
+
+    Returns:
+        dict: the settings of the run, and the throughput in requests per second, latency percentiles in seconds and
+        stage percentiles in seconds of each scenario
+    """
+    settings = {
+        "requests": requests_count,
+        "concurrency": concurrency,
+        "interpreters": interpreters,
+        "invoke_time": invoke_time,
+        "tile_latency": tile_latency,
+        "geocoding_latency": geocoding_latency,
+    }
+    report = {"settings": settings, "scenarios": {}}
+    with LocalWMTSServer(
+        latency=tile_latency, keep_alive=True
+    ) as wmts_server, LocalNominatimServer(
+        {ADDRESS: (LATITUDE, LONGITUDE)}, latency=geocoding_latency, keep_alive=True
+    ) as nominatim_server:
+        app = create_stand_in_app(
+            wmts_server.url,
+            nominatim_server.url,
+            interpreters=[
+                StubInterpreter(invoke_overhead=invoke_time)
+                for _ in range(interpreters)
+            ],
+            # The local geocoder has no usage policy to respect.
+            geocoding_rate_limit=1e6,
+        )
+        for name, (path, data) in scenarios.items():
+            asyncio.run(_run_scenario(app, path, data, 1, 1))
+            stage_metrics = app.state.stage_metrics = RecordingStageMetrics()
+            elapsed_time, latencies = asyncio.run(
+                _run_scenario(app, path, data, requests_count, concurrency)
+            )
+            report["scenarios"][name] = {
+                "throughput": requests_count / elapsed_time,
+                "latency": _percentiles(latencies),
+                "stages": {
+                    stage: _percentiles(durations)
+                    for stage, durations in sorted(stage_metrics.durations.items())
+                },
+            }
+    return report
+
+
+def legacy_draw_boxes(image: Image.Image, boxes: np.ndarray, scores, labels):
+    """Per-box drawing the API used before the AnnotationRenderer: the font is loaded and an ImageDraw is created for
+    every box. It is kept as the reference of the rendering benchmark."""
+    for (ymin, xmin, ymax, xmax), label, score in zip(boxes, labels, scores):
+        font = ImageFont.truetype(DEFAULT_FONT_PATH, 15)
+        left, right = xmin * image.width, xmax * image.width
+        top, bottom = ymin * image.height, ymax * image.height
+        text_left, text_top, text_right, text_bottom = font.getbbox(label)
+        text_width, text_height = text_right - text_left, text_bottom - text_top
+        total_display_str_height = (1 + 2 * 0.05) * text_height
+        text_bottom = (
+            top if top > total_display_str_height else bottom + total_display_str_height
+        )
+        margin = np.ceil(0.01 * text_height)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((left, top, right, bottom), outline="orange", width=2)
+        draw.rectangle(
+            [
+                (left, text_bottom - text_height - 2 * margin),
+                (left + text_width + 2 * margin, text_bottom),
+            ],
+            fill="red",
+        )
+        draw.text(
+            (left + margin, text_bottom - text_height - margin),
+            label + "/" + str(score),
+            fill="black",
+            font=font,
+        )
+
+
+def random_detections(count: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray, list]:
+    """Detections of car-sized boxes spread over the image, with random scores and labels."""
+    random_generator = np.random.default_rng(seed)
+    corners = random_generator.uniform(0, 0.95, size=(count, 2))
+    sizes = random_generator.uniform(0.01, 0.05, size=(count, 2))
+    boxes = np.concatenate([corners, corners + sizes], axis=1)
+    scores = random_generator.uniform(0.1, 1, size=count).astype("float32")
+    labels = list(random_generator.choice(["car", "truck", "van", "boat"], size=count))
+    return boxes, scores, labels
+
+
+def run_rendering_benchmark(
+    detection_counts: tuple = (1, 10, 100, 1000),
+    image_size: int = 640,
+    repeats: int = 5,
+) -> dict:
+    """Measures the median time spent drawing detections on an image, against the number of detections.
+
+    Args:
+        detection_counts (tuple, optional): numbers of detections. Defaults to (1, 10, 100, 1000).
+        image_size (int, optional): width and height of the image. Defaults to 640.
+        repeats (int, optional): number of drawings of each measure. Defaults to 5.
+
+    Returns:
+        dict: the median drawing time in seconds of the "legacy" per-box drawing, and of the renderer drawing outlines
+        "per_box" or "at_once", keyed by number of detections
+    """
+    image = Image.new("RGB", (image_size, image_size), (90, 110, 80))
+    renderers = {
+        "per_box": AnnotationRenderer(vectorize_above=None),
+        "at_once": AnnotationRenderer(vectorize_above=0),
+    }
+
+    def measure(draw) -> float:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            draw()
+            timings.append(time.perf_counter() - start)
+        return float(np.median(timings))
+
+    report = {}
+    for count in detection_counts:
+        boxes, scores, labels = random_detections(count)
+        report[count] = {
+            "legacy": measure(
+                lambda: legacy_draw_boxes(image.copy(), boxes, scores, labels)
+            )
+        }
+        for name, renderer in renderers.items():
+            # The labels are rasterized on the first drawing, then reused.
+            renderer.draw(np.array(image), boxes, scores, labels)
+            report[count][name] = measure(
+                lambda: renderer.draw(np.array(image), boxes, scores, labels)
+            )
+    return report
+
+
+def format_rendering_report(report: dict) -> str:
+    return "\n".join(
+        f"{count} detections: "
+        + ", ".join(f"{name} {value * 1000:.2f}ms" for name, value in timings.items())
+        for count, timings in report.items()
+    )
+
+
+def run_pipeline_benchmark(
+    worker_counts: tuple = (1, 2, 4),
+    archive_size: int = 32,
+    per_image_time: float = 0.0,
+) -> dict:
+    """Measures the throughput of the offline pipeline over a synthetic archive, against the number of workers.
+
+    Args:
+        worker_counts (tuple, optional): numbers of worker processes. Defaults to (1, 2, 4).
+        archive_size (int, optional): number of tiles along each side of the archive. Defaults to 32.
+        per_image_time (float, optional): inference time of the stub interpreter per window, in seconds. Defaults to 0.
+
+    Returns:
+        dict: the throughput in tiles per second, keyed by number of workers
+    """
+    report = {}
+    with tempfile.TemporaryDirectory() as directory:
+        archive_path = os.path.join(directory, "archive.mbtiles")
+        write_synthetic_mbtiles(
+            archive_path, LAYER, 19, (180224, 259840), (archive_size, archive_size)
+        )
+        for workers in worker_counts:
+            writer = GeoPackageDetectionWriter(
+                os.path.join(directory, f"detections_{workers}.gpkg")
+            )
+            try:
+                progress = run_pipeline(
+                    archive_path,
+                    writer,
+                    LAYER,
+                    19,
+                    functools.partial(StubInterpreter, per_image_time=per_image_time),
+                    {label: str(label) for label in range(13)},
+                    workers=workers,
+                    chunk_windows=4,
+                    progress_interval=float("inf"),
+                )
+            finally:
+                writer.close()
+            report[workers] = progress["tiles_per_second"]
+    return report
+
+
+def format_pipeline_report(report: dict) -> str:
+    return "\n".join(
+        f"{workers} workers: {tiles_per_second:.1f} tiles/s, "
+        f"{tiles_per_second / workers:.1f} tiles/s per worker"
+        for workers, tiles_per_second in report.items()
+    )
+
+
+def find_regressions(
+    report: dict,
+    baseline: dict,
+    tolerance: float = 0.5,
+    min_delta: float = 0.01,
+    compared_percentiles: tuple = ("p50", "p95"),
+) -> list:
+    """Compares a benchmark report to a baseline. A scenario regressed when its throughput dropped, or when one of its
+    latency or stage percentiles grew, by more than the tolerance. Percentiles which grew by less than `min_delta`
+    seconds are ignored, so that short stages do not fail the run on scheduling noise. The p99 of a few dozen requests
+    is their maximum, so it is reported but only compared when asked for.
+
+    Args:
+        report (dict): a report of `run_benchmark`
+        baseline (dict): a report of `run_benchmark` obtained with the same settings
+        tolerance (float, optional): relative change allowed. Defaults to 0.5.
+        min_delta (float, optional): absolute growth of percentiles allowed, in seconds. Defaults to 0.01.
+        compared_percentiles (tuple, optional): percentiles which are compared. Defaults to ("p50", "p95").
+
+    Returns:
+        list: a description of each regression, empty when there is none
+    """
+    regressions = []
+    for name, reference in baseline["scenarios"].items():
+        result = report["scenarios"].get(name)
+        if result is None:
+            continue
+        if result["throughput"] < reference["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: throughput {result['throughput']:.1f} req/s, baseline {reference['throughput']:.1f} req/s"
+            )
+        timings = [("latency", reference["latency"], result["latency"])] + [
+            (f"stage {stage}", percentiles, result["stages"].get(stage))
+            for stage, percentiles in reference["stages"].items()
+        ]
+        for label, reference_percentiles, percentiles in timings:
+            if percentiles is None:
+                continue
+            for percentile in compared_percentiles:
+                reference_value, value = (
+                    reference_percentiles[percentile],
+                    percentiles[percentile],
+                )
+                if (
+                    value > reference_value * (1 + tolerance)
+                    and value - reference_value > min_delta
+                ):
+                    regressions.append(
+                        f"{name}: {label} {percentile} {value * 1000:.1f}ms, baseline {reference_value * 1000:.1f}ms"
+                    )
+    return regressions
+
+
+def format_report(report: dict) -> str:
+    lines = []
+    for name, result in report["scenarios"].items():
+        latency = result["latency"]
+        lines.append(
+            f"{name}: {result['throughput']:.1f} req/s, "
+            + ", ".join(f"{key} {value * 1000:.1f}ms" for key, value in latency.items())
+        )
+        lines += [
+            f"    {stage}: "
+            + ", ".join(
+                f"{key} {value * 1000:.2f}ms" for key, value in percentiles.items()
+            )
+            for stage, percentiles in result["stages"].items()
+        ]
+    return "\n".join(lines)
+
+
+def main(arguments: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--interpreters", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--rendering", action="store_true")
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    arguments = parser.parse_args(arguments)
+    if arguments.rendering:
+        print(format_rendering_report(run_rendering_benchmark()))
+        return 0
+    if arguments.pipeline:
+        print(format_pipeline_report(run_pipeline_benchmark(tuple(arguments.workers))))
+        return 0
+
+    report = run_benchmark(
+        requests_count=arguments.requests,
+        concurrency=arguments.concurrency,
+        interpreters=arguments.interpreters,
+    )
+    print(format_report(report))
+    if arguments.update_baseline:
+        with open(arguments.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline stored in {arguments.baseline}.")
+        return 0
+    if not os.path.exists(arguments.baseline):
+        print(f"No baseline found in {arguments.baseline}, run with --update-baseline.")
+        return 0
+    with open(arguments.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["settings"] != report["settings"]:
+        print("The baseline was measured with other settings, it cannot be compared.")
+        return 1
+    regressions = find_regressions(report, baseline, tolerance=arguments.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
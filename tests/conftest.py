@@ -1,8 +1,14 @@
 import os
 from pytest import fixture
+from starlite import Starlite
 from starlite.testing import TestClient
 from object_detection_ign.wmts.satellite_view import WMTSClient
 from main import app
+from tests.stand_ins import (
+    LocalNominatimServer,
+    LocalWMTSServer,
+    create_stand_in_app,
+)
 
 
 # API fixtures
@@ -48,6 +54,40 @@ def wmts_test_client(wmts_client_config) -> WMTSClient:
     )
 
 
+@fixture
+def local_wmts_server() -> LocalWMTSServer:
+    with LocalWMTSServer(latency=0.05) as server:
+        yield server
+
+
+@fixture
+def local_wmts_client(local_wmts_server, wmts_client_config) -> WMTSClient:
+    return WMTSClient(
+        url=local_wmts_server.url,
+        correspondance_table_path=wmts_client_config["correspondance_table_path"],
+        correspondance_table_url=wmts_client_config["correspondance_table_url"],
+    )
+
+
+@fixture
+def local_nominatim_server(address_data, location_data) -> LocalNominatimServer:
+    addresses = {
+        address_data["address"]: (
+            location_data["latitude"],
+            location_data["longitude"],
+        )
+    }
+    with LocalNominatimServer(addresses, latency=0.05) as server:
+        yield server
+
+
+@fixture
+def stand_in_app(local_wmts_server, local_nominatim_server) -> Starlite:
+    """The API, served by the local WMTS and Nominatim stand-ins and a stub interpreter instead of the live services and
+    the model file."""
+    return create_stand_in_app(local_wmts_server.url, local_nominatim_server.url)
+
+
 @fixture
 def model_definition():
     return {
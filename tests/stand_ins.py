@@ -0,0 +1,430 @@
+import io
+import os
+import functools
+import json
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from PIL import Image
+from starlite import Starlite
+
+from main import CONFIG_FILE_PATH
+from object_detection_ign.api.api_configuration import set_state_on_startup
+from object_detection_ign.api.routes import (
+    ObjectDetectionController,
+    health_check,
+    metrics,
+    readiness_check,
+)
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+from object_detection_ign.wmts.satellite_view import WMTSClient
+
+PM_TOP_LEFT_CORNER = "-20037508.3427892 20037508.3427892"
+PM_SCALE_DENOMINATOR_ZOOM_0 = 559082264.0287178
+
+
+class _KeepAliveHTTPServer(ThreadingHTTPServer):
+    """A threaded HTTP server with a listen backlog deep enough for bursts of concurrent tile requests, which would
+    otherwise wait for TCP retransmissions."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def _create_server(handler_class, keep_alive: bool) -> ThreadingHTTPServer:
+    """Serves a stand-in on a free local port. By default, connections are closed after each response. With
+    `keep_alive`, HTTP/1.1 connections are kept open and bursts of new connections are accepted, like on a production
+    server, which the benchmarks rely on.
+    """
+    if keep_alive:
+        handler_class.protocol_version = "HTTP/1.1"
+        return _KeepAliveHTTPServer(("127.0.0.1", 0), handler_class)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    return server
+
+
+def _capabilities_xml(base_url: str, layers: list, max_zoom_level: int) -> str:
+    """Builds a minimal WMTS 1.0.0 GetCapabilities document exposing a "PM" (Pseudo-Mercator) TileMatrixSet,
+    mirroring the structure of the IGN Geoportail capabilities.
+    """
+    tile_matrices = "".join(
+        f"""
+        <TileMatrix>
+          <ows:Identifier>{zoom_level}</ows:Identifier>
+          <ScaleDenominator>{PM_SCALE_DENOMINATOR_ZOOM_0 / 2 ** zoom_level}</ScaleDenominator>
+          <TopLeftCorner>{PM_TOP_LEFT_CORNER}</TopLeftCorner>
+          <TileWidth>256</TileWidth>
+          <TileHeight>256</TileHeight>
+          <MatrixWidth>{2 ** zoom_level}</MatrixWidth>
+          <MatrixHeight>{2 ** zoom_level}</MatrixHeight>
+        </TileMatrix>"""
+        for zoom_level in range(max_zoom_level + 1)
+    )
+    layers_xml = "".join(
+        f"""
+      <Layer>
+        <ows:Title>{layer}</ows:Title>
+        <ows:Identifier>{layer}</ows:Identifier>
+        <Style isDefault="true"><ows:Identifier>normal</ows:Identifier></Style>
+        <Format>image/png</Format>
+        <TileMatrixSetLink><TileMatrixSet>PM</TileMatrixSet></TileMatrixSetLink>
+      </Layer>"""
+        for layer in layers
+    )
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<Capabilities xmlns="http://www.opengis.net/wmts/1.0" xmlns:ows="http://www.opengis.net/ows/1.1"
+    xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:ServiceIdentification>
+    <ows:Title>Local WMTS stand-in</ows:Title>
+    <ows:ServiceType>OGC WMTS</ows:ServiceType>
+    <ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion>
+  </ows:ServiceIdentification>
+  <ows:OperationsMetadata>
+    <ows:Operation name="GetCapabilities">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{base_url}"/></ows:HTTP></ows:DCP>
+    </ows:Operation>
+    <ows:Operation name="GetTile">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="{base_url}"/></ows:HTTP></ows:DCP>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <Contents>{layers_xml}
+    <TileMatrixSet>
+      <ows:Identifier>PM</ows:Identifier>
+      <ows:SupportedCRS>EPSG:3857</ows:SupportedCRS>{tile_matrices}
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>"""
+
+
+class LocalNominatimServer:
+    """A local stand-in for the Nominatim search API. It answers `/search?q=...&format=json` requests with the
+    coordinates of the known addresses, and an empty list otherwise.
+    """
+
+    def __init__(self, addresses: dict, latency: float = 0.0, keep_alive: bool = False):
+        self.addresses = addresses
+        self.latency = latency
+        self.search_requests = 0
+        self._lock = threading.Lock()
+        self._server = _create_server(self._handler_class(), keep_alive)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/search"
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.search_requests += 1
+                if stand_in.latency:
+                    time.sleep(stand_in.latency)
+                address = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+                if address in stand_in.addresses:
+                    latitude, longitude = stand_in.addresses[address]
+                    results = [{"lat": str(latitude), "lon": str(longitude)}]
+                else:
+                    results = []
+                body = json.dumps(results).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def __enter__(self) -> "LocalNominatimServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class StubInterpreter:
+    """Mimics the parts of tflite.Interpreter used by the detector, without needing a model file. Each invoke takes
+    `invoke_overhead` seconds plus `per_image_time` seconds per image of the batch, and invokes are serialized like on a
+    real interpreter. The outputs follow the layout of the object detection model: scores, labels and boxes. Every
+    detection of an image gets the mean pixel value of this image, divided by 255, as score. The input tensor is a
+    preallocated array of `input_dtype`, exposed through `tensor` like on a real interpreter.
+    """
+
+    def __init__(
+        self,
+        input_size: int = 640,
+        num_detections: int = 25,
+        num_classes: int = 13,
+        invoke_overhead: float = 0.0,
+        per_image_time: float = 0.0,
+        dynamic_batch: bool = True,
+        input_dtype=np.float32,
+    ):
+        self.input_size = input_size
+        self.num_detections = num_detections
+        self.num_classes = num_classes
+        self.invoke_overhead = invoke_overhead
+        self.per_image_time = per_image_time
+        self.dynamic_batch = dynamic_batch
+        self.input_dtype = input_dtype
+        self.invocations = 0
+        self._lock = threading.Lock()
+        self._input = np.zeros((1, input_size, input_size, 3), dtype=input_dtype)
+        self._outputs: dict = {}
+
+    def allocate_tensors(self):
+        pass
+
+    def get_input_details(self) -> list:
+        batch_dimension = -1 if self.dynamic_batch else 1
+        return [
+            {
+                "index": 0,
+                "dtype": self.input_dtype,
+                "shape": np.array(self._input.shape),
+                "shape_signature": np.array(
+                    [batch_dimension, self.input_size, self.input_size, 3]
+                ),
+            }
+        ]
+
+    def resize_tensor_input(self, index: int, shape: list):
+        if not self.dynamic_batch and shape[0] != 1:
+            raise ValueError("The stub model has a fixed batch size of 1.")
+        self._input = np.zeros(shape, dtype=self.input_dtype)
+
+    def tensor(self, index: int):
+        return lambda: self._input
+
+    def get_tensor(self, index: int) -> np.ndarray:
+        return self._outputs[f"output_{index}"].copy()
+
+    def get_signature_runner(self) -> "_StubSignatureRunner":
+        return _StubSignatureRunner(self)
+
+    def invoke(self):
+        # Like TFLite, which checks the reference count of its tensors, invokes are refused while views on the input
+        # tensor are alive: the attribute and the argument of getrefcount are the only expected references.
+        if sys.getrefcount(self._input) > 2:
+            raise RuntimeError(
+                "There is at least 1 reference to internal data in the interpreter."
+            )
+        batch_size = self._input.shape[0]
+        with self._lock:
+            time.sleep(self.invoke_overhead + self.per_image_time * batch_size)
+            self.invocations += 1
+        image_scores = self._input.reshape(batch_size, -1).mean(axis=1) / 255
+        rng = np.random.default_rng(0)
+        # Sorting each (y, x) coordinate across two random points yields (ymin, xmin, ymax, xmax) boxes.
+        corners = np.sort(rng.random((self.num_detections, 2, 2)), axis=1)
+        boxes = corners.reshape(self.num_detections, 4).astype("float32")
+        self._outputs = {
+            "output_1": np.repeat(
+                image_scores[:, np.newaxis], self.num_detections, axis=1
+            ).astype("float32"),
+            "output_2": np.tile(
+                np.arange(self.num_detections) % self.num_classes, (batch_size, 1)
+            ).astype("float32"),
+            "output_3": np.tile(boxes, (batch_size, 1, 1)),
+        }
+
+
+class _StubSignatureRunner:
+    """Mimics tflite.SignatureRunner: calling it copies the images into the input tensor, then invokes the model."""
+
+    def __init__(self, interpreter: StubInterpreter):
+        self.interpreter = interpreter
+
+    def get_input_details(self) -> dict:
+        return {"images": self.interpreter.get_input_details()[0]}
+
+    def get_output_details(self) -> dict:
+        return {f"output_{i}": {"index": i} for i in range(1, 4)}
+
+    def __call__(self, images: np.ndarray) -> dict:
+        if images.shape != self.interpreter._input.shape:
+            self.interpreter.resize_tensor_input(0, list(images.shape))
+        self.interpreter._input[...] = images
+        self.interpreter.invoke()
+        return {
+            name: self.interpreter.get_tensor(details["index"])
+            for name, details in self.get_output_details().items()
+        }
+
+
+def synthetic_tile(layer: str, zoom_level: int, row: int, column: int) -> Image.Image:
+    """Generates a deterministic 256*256 tile whose color encodes its position, so that mosaics can be checked
+    for tile ordering.
+    """
+    return Image.new("RGB", (256, 256), (row % 256, column % 256, zoom_level))
+
+
+@functools.lru_cache(maxsize=4096)
+def _encoded_synthetic_tile(
+    layer: str, zoom_level: int, row: int, column: int
+) -> bytes:
+    buffer = io.BytesIO()
+    synthetic_tile(layer, zoom_level, row, column).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def write_synthetic_mbtiles(
+    path: str, layer: str, zoom_level: int, first_tile: tuple, size: tuple
+):
+    """Writes an MBTiles archive of synthetic tiles, covering `size` (rows, columns) tiles from `first_tile`."""
+    connection = sqlite3.connect(path)
+    connection.executescript(
+        """CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);"""
+    )
+    connection.execute("INSERT INTO metadata VALUES ('name', ?)", (layer,))
+    connection.executemany(
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [
+            (
+                zoom_level,
+                column,
+                2**zoom_level - 1 - row,
+                _encoded_synthetic_tile(layer, zoom_level, row, column),
+            )
+            for row in range(first_tile[0], first_tile[0] + size[0])
+            for column in range(first_tile[1], first_tile[1] + size[1])
+        ],
+    )
+    connection.commit()
+    connection.close()
+
+
+class LocalWMTSServer:
+    """A local stand-in for the IGN WMTS server. It answers GetCapabilities and GetTile KVP requests with synthetic
+    content, optionally after an artificial latency, and counts the GetTile requests it receives, as well as the most
+    GetTile requests it served at once.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        layers=("HR.ORTHOIMAGERY.ORTHOPHOTOS",),
+        max_zoom_level: int = 19,
+        keep_alive: bool = False,
+    ):
+        self.latency = latency
+        self.layers = list(layers)
+        self.max_zoom_level = max_zoom_level
+        self.tile_requests = 0
+        self.max_tile_requests_in_flight = 0
+        self._tile_requests_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = _create_server(self._handler_class(), keep_alive)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/wmts?SERVICE=WMTS"
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = {
+                    key.upper(): values[0]
+                    for key, values in parse_qs(urlparse(self.path).query).items()
+                }
+                request = query.get("REQUEST", "").lower()
+                if request == "getcapabilities":
+                    body = _capabilities_xml(
+                        stand_in.url, stand_in.layers, stand_in.max_zoom_level
+                    ).encode()
+                    content_type = "application/xml"
+                elif request == "gettile":
+                    with stand_in._lock:
+                        stand_in.tile_requests += 1
+                        stand_in._tile_requests_in_flight += 1
+                        stand_in.max_tile_requests_in_flight = max(
+                            stand_in.max_tile_requests_in_flight,
+                            stand_in._tile_requests_in_flight,
+                        )
+                    if stand_in.latency:
+                        time.sleep(stand_in.latency)
+                    with stand_in._lock:
+                        stand_in._tile_requests_in_flight -= 1
+                    body = _encoded_synthetic_tile(
+                        query["LAYER"],
+                        int(query["TILEMATRIX"]),
+                        int(query["TILEROW"]),
+                        int(query["TILECOL"]),
+                    )
+                    content_type = "image/png"
+                else:
+                    self.send_error(400)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def __enter__(self) -> "LocalWMTSServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def create_stand_in_app(
+    wmts_url: str,
+    geocoding_url: str,
+    interpreters: Optional[list] = None,
+    geocoding_rate_limit: float = 1.0,
+) -> Starlite:
+    """The API, served by local WMTS and Nominatim stand-ins and stub interpreters instead of the live services and the
+    model file. The app is configured from the config file, without loading the model nor the caches.
+    """
+    stand_in_app = Starlite(
+        route_handlers=[
+            ObjectDetectionController,
+            health_check,
+            readiness_check,
+            metrics,
+        ],
+        initial_state={"config_file_path": CONFIG_FILE_PATH},
+    )
+    set_state_on_startup(stand_in_app.state)
+    stand_in_app.state.wmts_client = WMTSClient(
+        url=wmts_url,
+        correspondance_table_path=os.path.join("data", "correspondance_table.csv"),
+        correspondance_table_url="https://developers.arcgis.com/documentation/mapping-apis-and-services/reference/zoom-levels-and-scale/",
+        geocoding_url=geocoding_url,
+        geocoding_rate_limit=geocoding_rate_limit,
+    )
+    stand_in_app.state.interpreter_pool = InterpreterPool(
+        interpreters or [StubInterpreter(invoke_overhead=0.01)]
+    )
+    stand_in_app.state.inference_engine = stand_in_app.state.interpreter_pool
+    stand_in_app.state.input_img_width = 640
+    stand_in_app.state.input_img_height = 640
+    return stand_in_app
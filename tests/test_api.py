@@ -1,5 +1,51 @@
-from starlite.status_codes import HTTP_200_OK, HTTP_201_CREATED
+import io
+import os
+import base64
+import copy
+import json
+import time
+import threading
+import pytest
+import httpx
+import asyncio
+from types import SimpleNamespace
+from PIL import Image
+from starlite import Starlite, State
+from starlite.status_codes import (
+    HTTP_200_OK,
+    HTTP_201_CREATED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
+from starlite.exceptions import ServiceUnavailableException
 from starlite.testing import TestClient
+from main import CONFIG_FILE_PATH
+from object_detection_ign.api import api_configuration
+from object_detection_ign.api.instrumentation import StageMetrics
+from object_detection_ign.api.routes import (
+    ObjectDetectionController,
+    _require_ready,
+    health_check,
+    readiness_check,
+)
+from object_detection_ign.detector.detection_cache import DetectionCache
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+from object_detection_ign.wmts.satellite_view import WMTSClient
+from tests.benchmark import SCENARIOS, find_regressions, run_benchmark
+from tests.stand_ins import StubInterpreter
+
+
+def _read_metrics(exposition: str) -> dict:
+    """Parses the samples of a Prometheus text exposition, keyed by metric name and labels."""
+    return {
+        sample: float(value)
+        for sample, value in (
+            line.rsplit(" ", 1)
+            for line in exposition.splitlines()
+            if line and not line.startswith("#")
+        )
+    }
 
 
 def test_health_check(test_client: TestClient):
@@ -21,3 +67,431 @@ def test_location(test_client: TestClient, location_data: dict):
         response = client.post("/inference/location", json=location_data)
         assert response.status_code == HTTP_201_CREATED
         assert type(response.content) == bytes
+
+
+def test_stand_in_endpoints(
+    stand_in_app: Starlite, address_data: dict, location_data: dict
+):
+    with TestClient(app=stand_in_app) as client:
+        for endpoint, data in (("address", address_data), ("location", location_data)):
+            response = client.post(f"/inference/{endpoint}", json=data)
+            assert response.status_code == HTTP_201_CREATED
+            assert response.content.startswith(b"\x89PNG")
+        response = client.post(
+            "/inference/address", json={**address_data, "address": "Nowhere"}
+        )
+        assert response.status_code == HTTP_400_BAD_REQUEST
+
+
+def test_batch_endpoint(
+    local_wmts_server,
+    stand_in_app: Starlite,
+    address_data: dict,
+    location_data: dict,
+):
+    items = [
+        {**location_data, "output_format": "json"},
+        {**location_data, "output_format": "geojson"},
+        location_data,
+        address_data,
+        {**address_data, "address": "Nowhere"},
+        {**location_data, "latitude": 89.0},
+    ]
+    requests_before = local_wmts_server.tile_requests
+    with TestClient(app=stand_in_app) as client:
+        response = client.post("/inference/batch", json={"items": items})
+        assert response.status_code == HTTP_200_OK
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        results = {
+            result["index"]: result
+            for result in map(json.loads, response.text.splitlines())
+        }
+        assert (
+            client.post("/inference/batch", json={"items": []}).status_code
+            == HTTP_400_BAD_REQUEST
+        )
+        batch_tile_requests = local_wmts_server.tile_requests - requests_before
+        single_response = client.post("/inference/location", json=location_data)
+        single_tile_requests = (
+            local_wmts_server.tile_requests - requests_before - batch_tile_requests
+        )
+
+    assert sorted(results) == list(range(len(items)))
+    assert [results[i]["status_code"] for i in range(len(items))] == [
+        HTTP_201_CREATED
+    ] * 4 + [HTTP_400_BAD_REQUEST] * 2
+    assert len(results[0]["content"]["detections"]) > 0
+    assert results[1]["content"]["type"] == "FeatureCollection"
+    assert results[2]["media_type"] == "image/png"
+    assert base64.b64decode(results[2]["content"]) == single_response.content
+    # The four located items overlap the same tiles, which are downloaded once.
+    assert batch_tile_requests == single_tile_requests > 0
+
+
+def test_concurrent_requests(stand_in_app: Starlite, location_data: dict):
+    requests_count = 8
+    in_flight = {"current": 0, "max": 0}
+
+    async def counting_app(scope, receive, send):
+        in_flight["current"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["current"])
+        try:
+            await stand_in_app(scope, receive, send)
+        finally:
+            in_flight["current"] -= 1
+
+    async def send_requests(concurrently: bool) -> int:
+        in_flight["max"] = 0
+        transport = httpx.ASGITransport(app=counting_app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=60
+        ) as client:
+            send_request = lambda: client.post(
+                "/inference/location", json=location_data
+            )
+            if concurrently:
+                responses = await asyncio.gather(
+                    *(send_request() for _ in range(requests_count))
+                )
+            else:
+                responses = [await send_request() for _ in range(requests_count)]
+        assert all(response.status_code == HTTP_201_CREATED for response in responses)
+        return in_flight["max"]
+
+    # While a request waits for its tiles, the event loop serves the others. The latencies are measured by
+    # tests/benchmark.py.
+    assert asyncio.run(send_requests(concurrently=False)) == 1
+    assert asyncio.run(send_requests(concurrently=True)) > 1
+
+
+def test_detection_output_formats(stand_in_app: Starlite, location_data: dict):
+    with TestClient(app=stand_in_app) as client:
+        png_response = client.post("/inference/location", json=location_data)
+        json_response = client.post(
+            "/inference/location", json={**location_data, "output_format": "json"}
+        )
+        geojson_response = client.post(
+            "/inference/location", json={**location_data, "output_format": "geojson"}
+        )
+    assert json_response.status_code == geojson_response.status_code == HTTP_201_CREATED
+    assert len(json_response.content) < len(png_response.content)
+
+    detections = json_response.json()["detections"]
+    assert len(detections) > 0
+    for detection in detections:
+        min_longitude, min_latitude, max_longitude, max_latitude = detection[
+            "bounding_box"
+        ]
+        # The detections lie in the 640*640 image around the requested point.
+        assert min_longitude < max_longitude and min_latitude < max_latitude
+        assert abs(min_longitude - location_data["longitude"]) < 0.0035
+        assert abs(min_latitude - location_data["latitude"]) < 0.0025
+
+    features = geojson_response.json()["features"]
+    assert geojson_response.headers["content-type"].startswith("application/geo+json")
+    assert len(features) == len(detections)
+    assert features[0]["geometry"]["coordinates"][0][0] == pytest.approx(
+        detections[0]["bounding_box"][:2]
+    )
+
+
+def test_image_encoding(stand_in_app: Starlite, location_data: dict):
+    responses = {}
+    with TestClient(app=stand_in_app) as client:
+        for image_format in ("png", "jpeg", "webp"):
+            responses[image_format] = client.post(
+                "/inference/location",
+                json={**location_data, "output_format": image_format, "quality": 70},
+            )
+        downscaled_response = client.post(
+            "/inference/location",
+            json={**location_data, "output_format": "jpeg", "downscale": 2},
+        )
+        invalid_response = client.post(
+            "/inference/location", json={**location_data, "quality": 0}
+        )
+        encoding_metrics = _read_metrics(client.get("/metrics").text)
+
+    for image_format, response in responses.items():
+        assert response.status_code == HTTP_201_CREATED
+        assert response.headers["content-type"].startswith(f"image/{image_format}")
+        assert response.headers["server-timing"].startswith("encode;dur=")
+        image = Image.open(io.BytesIO(response.content))
+        assert image.format == image_format.upper() and image.size == (640, 640)
+    assert Image.open(io.BytesIO(downscaled_response.content)).size == (320, 320)
+    assert invalid_response.status_code == HTTP_400_BAD_REQUEST
+    # The metrics count every encoded image and its size, the failed request aside.
+    encoded_bytes = {
+        image_format: len(response.content)
+        for image_format, response in responses.items()
+    }
+    encoded_bytes["jpeg"] += len(downscaled_response.content)
+    for image_format, images in (("png", 1), ("jpeg", 2), ("webp", 1)):
+        labels = f'{{format="{image_format}"}}'
+        assert (
+            encoding_metrics[f"object_detection_encoded_images_total{labels}"] == images
+        )
+        assert (
+            encoding_metrics[f"object_detection_encoded_bytes_total{labels}"]
+            == encoded_bytes[image_format]
+        )
+
+
+def test_metrics(stand_in_app: Starlite, address_data: dict, location_data: dict):
+    with TestClient(app=stand_in_app) as client:
+        for endpoint, data in (("address", address_data), ("location", location_data)):
+            response = client.post(f"/inference/{endpoint}", json=data)
+            assert response.status_code == HTTP_201_CREATED
+        # An unreachable WMTS server is counted as an upstream error.
+        stand_in_app.state.wmts_client.tile_url = "http://127.0.0.1:9/wmts"
+        failed_response = client.post("/inference/location", json=location_data)
+        metrics_response = client.get("/metrics")
+    assert failed_response.status_code == HTTP_500_INTERNAL_SERVER_ERROR
+    assert metrics_response.headers["content-type"].startswith("text/plain")
+    metrics = _read_metrics(metrics_response.text)
+    for stage, count in (
+        ("geocoding", 1),
+        ("tile_fetch", 3),
+        ("assembly", 2),
+        ("inference", 2),
+        ("drawing", 2),
+        ("encoding", 2),
+    ):
+        assert (
+            metrics[f'object_detection_stage_duration_seconds_count{{stage="{stage}"}}']
+            == count
+        )
+        assert (
+            metrics[
+                f'object_detection_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}}'
+            ]
+            == count
+        )
+    assert metrics['object_detection_upstream_errors_total{service="wmts"}'] > 0
+    assert metrics['object_detection_upstream_errors_total{service="nominatim"}'] == 0
+    assert metrics["object_detection_interpreter_pool_checkouts_total"] == 2
+    assert metrics["object_detection_interpreter_pool_in_use"] == 0
+
+    # Every timed block is observed once, in a single bucket, also when it raises.
+    stage_metrics = StageMetrics(buckets=(0.5, 1.0))
+    for _ in range(1000):
+        with stage_metrics.time("stage"):
+            pass
+    with pytest.raises(ValueError):
+        with stage_metrics.time("stage"):
+            raise ValueError
+    stage_metrics.observe("stage", 0.75)
+    bucket_counts, count, _ = stage_metrics.histograms["stage"].snapshot()
+    assert bucket_counts == [(0.5, 1001), (1.0, 1002), (float("inf"), 1002)]
+    assert count == 1002
+
+
+def test_detection_cache(
+    stand_in_app: Starlite,
+    local_wmts_server,
+    location_data: dict,
+    tmp_path,
+    monkeypatch,
+):
+    database_path = str(tmp_path / "detection_cache.sqlite")
+    detection_cache = DetectionCache("model-v1", database_path=database_path)
+    stand_in_app.state.detection_cache = detection_cache
+    stub_interpreter = stand_in_app.state.interpreter_pool.interpreters[0]
+    # Whether the database was read from the event loop thread, for every read.
+    database_reads_in_event_loop = []
+    connection = detection_cache._connection
+
+    def recording_connection():
+        try:
+            asyncio.get_running_loop()
+            database_reads_in_event_loop.append(True)
+        except RuntimeError:
+            database_reads_in_event_loop.append(False)
+        return connection()
+
+    monkeypatch.setattr(detection_cache, "_connection", recording_connection)
+    json_data = {**location_data, "output_format": "json"}
+    with TestClient(app=stand_in_app) as client:
+        first_response = client.post("/inference/location", json=json_data)
+        tile_requests = local_wmts_server.tile_requests
+        invocations = stub_interpreter.invocations
+        second_response = client.post("/inference/location", json=json_data)
+        assert local_wmts_server.tile_requests == tile_requests
+        # Drawing cached detections needs the tiles, but not the model.
+        first_image = client.post("/inference/location", json=location_data)
+        tile_requests = local_wmts_server.tile_requests
+        second_image = client.post("/inference/location", json=location_data)
+        assert local_wmts_server.tile_requests == tile_requests
+    assert second_response.json() == first_response.json()
+    assert first_image.content == second_image.content
+    assert stub_interpreter.invocations == invocations
+    assert detection_cache.stats["hits"] == 3
+    assert database_reads_in_event_loop and not any(database_reads_in_event_loop)
+
+    (key,) = (tuple(json.loads(key)[1:]) for key in detection_cache._entries)
+    key = (key[0], key[1], tuple(key[2]), key[3])
+
+    # Entries held in memory are answered without reading the database.
+    def read_database():
+        raise AssertionError("The database was read for an entry held in memory.")
+
+    hits = detection_cache.stats["hits"]
+    with monkeypatch.context() as patch:
+        patch.setattr(detection_cache, "_connection", read_database)
+        for _ in range(100):
+            assert detection_cache.get_detections(key) is not None
+    assert detection_cache.stats["hits"] == hits + 100
+    assert DetectionCache("model-v1", database_path=database_path).get_detections(key)
+    # Another model invalidates the results stored on disk.
+    assert (
+        DetectionCache("model-v2", database_path=database_path).get_detections(key)
+        is None
+    )
+    assert (
+        DetectionCache("model-v1", database_path=database_path).get_detections(key)
+        is None
+    )
+
+
+def test_benchmark_regressions():
+    report = run_benchmark(
+        requests_count=4,
+        concurrency=2,
+        scenarios={"location/json": SCENARIOS["location/json"]},
+    )
+    result = report["scenarios"]["location/json"]
+    assert result["throughput"] > 0
+    assert set(result["latency"]) == {"p50", "p95", "p99"}
+    assert {"tile_fetch", "inference", "serialization"} <= set(result["stages"])
+    assert find_regressions(report, report) == []
+
+    # A baseline three times as fast flags the throughput and the latencies.
+    faster_baseline = copy.deepcopy(report)
+    faster_result = faster_baseline["scenarios"]["location/json"]
+    faster_result["throughput"] *= 3
+    faster_result["latency"] = {
+        key: value / 3 for key, value in result["latency"].items()
+    }
+    regressions = find_regressions(report, faster_baseline)
+    assert any("throughput" in regression for regression in regressions)
+    assert any("latency p95" in regression for regression in regressions)
+
+
+def test_lazy_startup(
+    monkeypatch, local_wmts_server, local_nominatim_server, location_data, tmp_path
+):
+    model_loaded = threading.Event()
+
+    def load_stub_interpreter_pool(*args, **kwargs):
+        model_loaded.wait(timeout=10)
+        return InterpreterPool([StubInterpreter()]), 640, 640
+
+    monkeypatch.setattr(
+        api_configuration, "load_interpreter_pool", load_stub_interpreter_pool
+    )
+    monkeypatch.setattr(api_configuration, "hash_model_file", lambda path: "stub")
+    capabilities_path = str(tmp_path / "wmts_capabilities.xml")
+
+    def use_stand_ins(state: State):
+        state.WMTS_SERVICE_URL = local_wmts_server.url
+        state.GEOCODING_URL = local_nominatim_server.url
+        state.CAPABILITIES_FILE = capabilities_path
+        state.TILE_CACHE_ENABLED = state.GEOCODING_CACHE_ENABLED = False
+        state.READINESS_TIMEOUT = 0.1
+
+    app = Starlite(
+        route_handlers=[ObjectDetectionController, health_check, readiness_check],
+        on_startup=[
+            api_configuration.set_state_on_startup,
+            use_stand_ins,
+            api_configuration.start_api_initialization,
+        ],
+        initial_state={"config_file_path": CONFIG_FILE_PATH},
+    )
+    with TestClient(app=app) as client:
+        # The model is still loading: the liveness probe answers without waiting for it.
+        health_response = client.get("/health")
+        assert client.get("/ready").status_code == HTTP_503_SERVICE_UNAVAILABLE
+        assert (
+            client.post("/inference/location", json=location_data).status_code
+            == HTTP_503_SERVICE_UNAVAILABLE
+        )
+        model_loaded.set()
+        deadline = time.perf_counter() + 10
+        while client.get("/ready").status_code != HTTP_200_OK:
+            assert time.perf_counter() < deadline
+            time.sleep(0.05)
+        response = client.post("/inference/location", json=location_data)
+    assert health_response.status_code == HTTP_200_OK
+    assert response.status_code == HTTP_201_CREATED
+
+    # The capabilities snapshot lets the next clients start while the WMTS server is unreachable.
+    wmts_client = WMTSClient(
+        url="http://127.0.0.1:9/wmts?SERVICE=WMTS",
+        correspondance_table_path=os.path.join("data", "correspondance_table.csv"),
+        correspondance_table_url="",
+        capabilities_path=capabilities_path,
+    )
+    assert "19" in wmts_client.matrix_set.tilematrix
+    assert wmts_client.tile_url.startswith(local_wmts_server.url.split("?")[0])
+
+
+def test_initialization_retries(monkeypatch):
+    attempts = []
+
+    def flaky_initialization(state: State):
+        attempts.append(state)
+        if len(attempts) < state.failures:
+            raise ConnectionError("The WMTS server is unreachable.")
+        state.inference_engine = state.wmts_client = object()
+
+    monkeypatch.setattr(api_configuration, "api_initialization", flaky_initialization)
+
+    def start(failures: int, retry_seconds: float = 0.01, wait: bool = True) -> State:
+        state = State(
+            {
+                "failures": failures,
+                "INITIALIZATION_ATTEMPTS": 3,
+                "INITIALIZATION_RETRY_SECONDS": retry_seconds,
+                "INITIALIZATION_MAX_RETRY_SECONDS": 2 * retry_seconds,
+                "READINESS_TIMEOUT": 10,
+            }
+        )
+        initialization_thread = api_configuration.start_api_initialization(state)
+        if wait:
+            initialization_thread.join(timeout=10)
+        return state
+
+    def require_ready(state: State):
+        connection = SimpleNamespace(app=SimpleNamespace(state=state))
+        asyncio.run(_require_ready(connection, None))
+
+    # A transient failure is retried, and the API becomes ready.
+    state = start(failures=3)
+    assert len(attempts) == 3
+    assert api_configuration.is_ready(state)
+    assert state.initialization_error is None and not state.initialization_failed
+    assert health_check.fn.value(state) == "healthy"
+
+    # Requests received while an attempt failed wait for the next ones, instead of failing right away.
+    attempts.clear()
+    state = start(failures=2, retry_seconds=0.3, wait=False)
+    while state.initialization_error is None:
+        time.sleep(0.01)
+    require_ready(state)
+    assert len(attempts) == 2 and api_configuration.is_ready(state)
+
+    # Once every attempt failed, the liveness probe fails as well as the readiness probe.
+    attempts.clear()
+    state = start(failures=4)
+    assert len(attempts) == 3
+    assert not api_configuration.is_ready(state)
+    assert isinstance(state.initialization_error, ConnectionError)
+    assert state.initialization_failed
+    for probe in (health_check, readiness_check):
+        with pytest.raises(ServiceUnavailableException):
+            probe.fn.value(state)
+    rejection_start = time.perf_counter()
+    with pytest.raises(ServiceUnavailableException):
+        require_ready(state)
+    assert time.perf_counter() - rejection_start < state.READINESS_TIMEOUT
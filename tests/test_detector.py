@@ -1,5 +1,58 @@
-from object_detection_ign.detector.inference_helpers import load_inference_model
+import io
+import threading
+import struct
+import sqlite3
+import functools
+import tracemalloc
+import numpy as np
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from object_detection_ign.detector.input_tensor import (
+    as_image_writer,
+    invoke_with_writers,
+)
+from object_detection_ign.detector.inference_helpers import (
+    detect_objects,
+    filter_batch_predictions,
+    filter_predictions,
+    load_inference_model,
+    load_interpreter_pool,
+    non_max_suppression,
+    run_detector,
+)
+from object_detection_ign.detector.annotation import AnnotationRenderer, BoxStyle
+from object_detection_ign.detector.area_scan import SlidingWindowReader, scan_area
+from object_detection_ign.wmts.satellite_view import SatelliteView, WMTSClient
+from object_detection_ign.wmts.utils import compute_covering_tiles
+from object_detection_ign.detector.inference_engine import BatchedInferenceEngine
+from object_detection_ign.detector.interpreter_pool import InterpreterPool
+from object_detection_ign.detector.device_scheduler import DeviceScheduler
+from object_detection_ign.detector.detection_writers import (
+    GeoPackageDetectionWriter,
+    ParquetDetectionWriter,
+)
+from object_detection_ign.detector import offline_pipeline
+from object_detection_ign.detector.offline_pipeline import plan_chunks, run_pipeline
+from object_detection_ign.detector.change_detection import (
+    find_changed_tiles,
+    find_dirty_chunks,
+    match_detections,
+    run_change_detection,
+)
+from object_detection_ign.wmts.tile_sources import open_tile_source
+from object_detection_ign.wmts.utils import (
+    TileMatrixIndex,
+    tile_positions_to_coordinates,
+)
 import tflite_runtime.interpreter as tflite
+from PIL import Image
+from tests.benchmark import random_detections
+from tests.stand_ins import (
+    LocalWMTSServer,
+    StubInterpreter,
+    synthetic_tile,
+    write_synthetic_mbtiles,
+)
 
 
 def test_model_loading(model_definition):
@@ -9,3 +62,596 @@ def test_model_loading(model_definition):
     assert isinstance(satellite_detector, tflite.Interpreter)
     assert input_img_height == model_definition["input_img_width"]
     assert input_img_width == model_definition["input_img_height"]
+
+
+def test_batched_inference_throughput():
+    images = [np.full((1, 640, 640, 3), i, dtype="float32") for i in range(16)]
+
+    def run_concurrently(infer) -> list:
+        with ThreadPoolExecutor(max_workers=len(images)) as executor:
+            return list(executor.map(infer, images))
+
+    single_interpreter = StubInterpreter(invoke_overhead=0.02, per_image_time=0.002)
+    single_pool = InterpreterPool([single_interpreter])
+    single_outputs = run_concurrently(lambda image: run_detector(single_pool, image))
+
+    batched_interpreter = StubInterpreter(invoke_overhead=0.02, per_image_time=0.002)
+    engine = BatchedInferenceEngine(
+        InterpreterPool([batched_interpreter]), max_batch_size=8, max_wait_time=0.01
+    )
+    batched_outputs = run_concurrently(lambda image: run_detector(engine, image))
+    engine.close()
+
+    # Concurrent images share invokes, each paying the invoke overhead once. The throughput is measured by
+    # tests/benchmark.py.
+    assert single_interpreter.invocations == len(images)
+    assert batched_interpreter.invocations < len(images)
+    for single_output, batched_output in zip(single_outputs, batched_outputs):
+        for name in single_output:
+            np.testing.assert_array_equal(single_output[name], batched_output[name])
+
+
+def test_batched_inference_fixed_batch_model():
+    engine = BatchedInferenceEngine(
+        InterpreterPool([StubInterpreter(dynamic_batch=False)]),
+        max_batch_size=4,
+        max_wait_time=0.01,
+    )
+    futures = [
+        engine.submit(np.full((1, 640, 640, 3), 51, dtype="float32")) for _ in range(4)
+    ]
+    for future in futures:
+        assert future.result()["output_1"].shape == (1, 25)
+        np.testing.assert_allclose(future.result()["output_1"], 0.2)
+    engine.close()
+
+
+@pytest.mark.parametrize("dynamic_batch", [True, False])
+def test_batched_inference_failed_image_writer(dynamic_batch):
+    interpreter = StubInterpreter(dynamic_batch=dynamic_batch)
+    engine = BatchedInferenceEngine(
+        InterpreterPool([interpreter]), max_batch_size=3, max_wait_time=1
+    )
+
+    def failing_writer(destination: np.ndarray):
+        destination[...] = 255
+        raise OSError("The tile could not be read.")
+
+    image = np.full((1, 640, 640, 3), 51, dtype="float32")
+    futures = [
+        engine.submit(image),
+        engine.submit(failing_writer),
+        engine.submit(image),
+    ]
+    # Only the request whose image could not be written fails, its slot does not leak into the others.
+    with pytest.raises(OSError):
+        futures[1].result()
+    for future in futures[0], futures[2]:
+        np.testing.assert_allclose(future.result()["output_1"], 0.2)
+    assert interpreter.invocations == (1 if dynamic_batch else 3)
+    # The failed request keeps no view on the input tensor.
+    np.testing.assert_allclose(engine.infer(image)["output_1"], 0.2)
+    engine.close()
+
+
+def test_interpreter_pool_parallelism():
+    interpreter_pool = InterpreterPool(
+        [StubInterpreter(invoke_overhead=0.05) for _ in range(4)]
+    )
+    image = np.zeros((1, 640, 640, 3), dtype="float32")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        outputs = list(
+            executor.map(lambda _: run_detector(interpreter_pool, image), range(8))
+        )
+
+    # Concurrent calls are spread over the interpreters instead of waiting for a single one.
+    assert len(outputs) == 8
+    invocations = [
+        interpreter.invocations for interpreter in interpreter_pool.interpreters
+    ]
+    assert sum(invocations) == 8
+    assert sum(count > 0 for count in invocations) > 1
+    pool_metrics = interpreter_pool.metrics
+    assert pool_metrics["size"] == 4
+    assert pool_metrics["in_use"] == pool_metrics["queue_depth"] == 0
+    assert pool_metrics["checkouts"] == 8
+    assert pool_metrics["p99_wait_time"] >= 0.04
+
+
+def test_device_scheduler(monkeypatch):
+    # Two Coral TPU stand-ins answering in 10ms, and a CPU fallback answering in 80ms.
+    monkeypatch.setattr(
+        tflite,
+        "Interpreter",
+        lambda model_path, experimental_delegates, num_threads: StubInterpreter(
+            invoke_overhead=0.01 if experimental_delegates else 0.08
+        ),
+    )
+    scheduler, _, _ = load_interpreter_pool(
+        "stub.tflite",
+        pool_size=4,
+        list_devices=lambda: [{"type": "usb"}, {"type": "usb"}],
+        load_delegate=lambda library, options: options["device"],
+    )
+    assert isinstance(scheduler, DeviceScheduler)
+    image = np.zeros((1, 640, 640, 3), dtype="float32")
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda _: run_detector(scheduler, image), range(60)))
+
+    device_metrics = scheduler.metrics["devices"]
+    assert list(device_metrics) == ["edgetpu:0", "edgetpu:1", "cpu:0"]
+    assert sum(metrics["checkouts"] for metrics in device_metrics.values()) == 60
+    assert all(metrics["assigned"] == 0 for metrics in device_metrics.values())
+    for tpu in ("edgetpu:0", "edgetpu:1"):
+        assert (
+            device_metrics[tpu]["checkouts"] > 2 * device_metrics["cpu:0"]["checkouts"]
+        )
+        assert (
+            device_metrics[tpu]["mean_latency"]
+            < device_metrics["cpu:0"]["mean_latency"]
+        )
+    assert device_metrics["cpu:0"]["checkouts"] > 0
+
+
+def test_non_max_suppression():
+    bounding_boxes = np.array(
+        [[0, 0, 10, 10], [1, 1, 11, 11], [0, 0, 10, 10], [20, 20, 30, 30]]
+    )
+    scores = np.array([0.6, 0.9, 0.8, 0.5])
+    labels = ["car", "car", "truck", "car"]
+    kept_idx = non_max_suppression(bounding_boxes, scores, labels, iou_threshold=0.5)
+    assert kept_idx.tolist() == [1, 2, 3]
+
+
+def test_scan_area(wmts_client_config, model_definition):
+    with LocalWMTSServer() as server:
+        wmts_client = WMTSClient(
+            url=server.url,
+            correspondance_table_path=wmts_client_config["correspondance_table_path"],
+            correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        )
+        # Roughly 8*8 tiles at zoom level 19.
+        area = (-1.552, 48.838, -1.5465, 48.8416)
+        tiles = compute_covering_tiles(wmts_client.matrix_set, 19, area)
+        triangle = [(-1.552, 48.838), (-1.5465, 48.838), (-1.552, 48.8416)]
+        assert len(compute_covering_tiles(wmts_client.matrix_set, 19, triangle)) < len(
+            tiles
+        )
+
+        reader = SlidingWindowReader(
+            wmts_client, "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19, 640
+        )
+        first_row, first_column = tiles[0]
+        window = reader.read(first_row * 256 + 100, first_column * 256 + 50)
+        mosaic = wmts_client.get_concat_image(
+            3, 3, first_row + 1, first_column + 1, "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19
+        )
+        np.testing.assert_array_equal(
+            window[0, :600], np.asarray(mosaic)[100:700, 50:690]
+        )
+
+        tracemalloc.start()
+        scores, labels, bounding_boxes = scan_area(
+            wmts_client,
+            StubInterpreter(),
+            {label: str(label) for label in range(13)},
+            area,
+            "HR.ORTHOIMAGERY.ORTHOPHOTOS",
+            19,
+            window_size=model_definition["input_img_width"],
+        )
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # Far less than the 2048*2048 float32 image of the whole area.
+    assert peak_memory < 2048 * 2048 * 3 * 4 / 2
+    assert len(scores) == len(labels) == len(bounding_boxes) > 0
+    assert np.all(bounding_boxes[:, 0] < bounding_boxes[:, 2])
+    assert np.all(bounding_boxes[:, 1] < bounding_boxes[:, 3])
+    assert np.all((bounding_boxes[:, 0] > -1.56) & (bounding_boxes[:, 2] < -1.54))
+    assert np.all((bounding_boxes[:, 1] > 48.83) & (bounding_boxes[:, 3] < 48.85))
+
+
+def test_scan_area_tile_fetches(wmts_client_config, monkeypatch):
+    with LocalWMTSServer() as server:
+        wmts_client = WMTSClient(
+            url=server.url,
+            correspondance_table_path=wmts_client_config["correspondance_table_path"],
+            correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        )
+        # Roughly 8 rows of 20 tiles at zoom level 19, wider than the rows of windows would fit in a fixed cache.
+        area = (-1.552, 48.838, -1.538, 48.8416)
+        fetches = []
+        get_tile_array = wmts_client.get_tile_array
+
+        def recording_get_tile_array(layer, zoom_level, tile_row, tile_column):
+            fetches.append((threading.get_ident(), tile_row, tile_column))
+            return get_tile_array(layer, zoom_level, tile_row, tile_column)
+
+        monkeypatch.setattr(wmts_client, "get_tile_array", recording_get_tile_array)
+        engine = BatchedInferenceEngine(InterpreterPool([StubInterpreter()]))
+        scores, _, _ = scan_area(
+            wmts_client,
+            engine,
+            {label: str(label) for label in range(13)},
+            area,
+            "HR.ORTHOIMAGERY.ORTHOPHOTOS",
+            19,
+        )
+        engine.close()
+
+    # Tiles are fetched by the scanning thread, never by the inference worker, and each one only once.
+    tiles = compute_covering_tiles(wmts_client.matrix_set, 19, area)
+    assert tiles[:, 1].max() - tiles[:, 1].min() + 1 > 16
+    assert {thread for thread, _, _ in fetches} == {threading.get_ident()}
+    assert len(fetches) == len(set(fetches))
+    assert len(scores) > 0
+
+
+def test_filter_predictions():
+    classes_dict = {0: "background", 1: "car", 2: "truck"}
+    output = {
+        "output_1": np.array([[0.9, 0.05, 0.5, 0.3, 0.8, 0.2]]),
+        "output_2": np.array([[1.0, 1.0, 0.0, 2.0, 2.0, 7.0]]),
+        "output_3": np.arange(24, dtype="float32").reshape(1, 6, 4) / 24,
+    }
+    scores, labels, bounding_boxes = filter_predictions(output, classes_dict)
+    assert scores.tolist() == [0.9, 0.3, 0.8]
+    assert labels == ["car", "truck", "truck"]
+    np.testing.assert_array_equal(bounding_boxes, output["output_3"][0, [0, 3, 4]])
+
+    scores, labels, _ = filter_predictions(
+        output, classes_dict, class_thresholds={"truck": 0.5}, top_k=1
+    )
+    assert scores.tolist() == [0.9] and labels == ["car"]
+
+    batch_output = {name: np.concatenate([value] * 3) for name, value in output.items()}
+    batch_output["output_1"][1] = 0
+    results = filter_batch_predictions(batch_output, classes_dict, top_k=2)
+    assert [result[1] for result in results] == [["car", "truck"], [], ["car", "truck"]]
+    assert results[2][0].tolist() == [0.9, 0.8]
+
+
+def test_zero_copy_input():
+    satellite_view = SatelliteView()
+    satellite_view.tile_arrays = {
+        (row, column): np.asarray(synthetic_tile("layer", 19, row, column))
+        for row in range(100, 103)
+        for column in range(200, 203)
+    }
+    satellite_view.pixel_window = (100 * 256, 200 * 256, 768, 768)
+    satellite_view.tile_origin = (100, 200)
+    satellite_view.crop_image_center(640, 640)
+    classes_dict = {label: str(label) for label in range(13)}
+    float_interpreter, quantized_interpreter = StubInterpreter(), StubInterpreter(
+        input_dtype=np.uint8
+    )
+
+    tracemalloc.start()
+    legacy_scores, _, _ = filter_predictions(
+        run_detector(float_interpreter, satellite_view.image_array.astype("float32")),
+        classes_dict,
+    )
+    _, legacy_peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    scores, _, _ = detect_objects(float_interpreter, satellite_view, classes_dict)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The image is never assembled: the tiles are written straight into the input tensor.
+    assert satellite_view._image is None
+    assert peak_memory < 640 * 640 * 3 / 10 < legacy_peak_memory
+    np.testing.assert_allclose(scores, legacy_scores)
+    quantized_scores, _, _ = detect_objects(
+        quantized_interpreter, satellite_view, classes_dict
+    )
+    np.testing.assert_allclose(quantized_scores, scores)
+    np.testing.assert_array_equal(
+        np.asarray(satellite_view.image),
+        satellite_view.image_array[0],
+    )
+
+
+def test_failed_image_writer():
+    interpreter = StubInterpreter()
+
+    def failing_writer(destination: np.ndarray):
+        raise OSError("The tile could not be read.")
+
+    with pytest.raises(OSError) as error:
+        invoke_with_writers(interpreter, [failing_writer])
+    # While the error is kept, e.g. by a future, no view on the input tensor keeps the interpreter from running.
+    image = np.full((1, 640, 640, 3), 51, dtype="float32")
+    output = invoke_with_writers(interpreter, [as_image_writer(image)])
+    np.testing.assert_allclose(output["output_1"], 0.2)
+    assert isinstance(error.value, OSError)
+
+
+def test_annotation_renderer():
+    boxes, scores, labels = random_detections(300)
+    # A box thinner than its outline, and a box out of the image, are clipped.
+    boxes[:2] = [[0.5, 0.5, 0.501, 0.6], [0.9, 0.9, 1.2, 1.1]]
+    styles = {"truck": BoxStyle(outline_color=(0, 128, 255), outline_width=3)}
+    image = np.zeros((640, 640, 3), dtype="uint8")
+    per_box, at_once = image.copy(), image.copy()
+    # Outlines of different styles are drawn in another order, so only a single style gives the same pixels.
+    AnnotationRenderer(vectorize_above=None).draw(per_box, boxes, scores, labels)
+    AnnotationRenderer(vectorize_above=0).draw(at_once, boxes, scores, labels)
+    assert (per_box == at_once).all()
+
+    renderer = AnnotationRenderer(styles)
+    renderer.prerender(set(labels))
+    truck_box = boxes[labels.index("truck")]
+    outline_only = image.copy()
+    renderer.draw(outline_only, truck_box[None], [0.5], ["truck"])
+    top, left = np.rint(truck_box[:2] * 640).astype(int)
+    assert outline_only[top + 2, left + 2].tolist() == [0, 128, 255]
+    assert outline_only[top + 3, left + 3].tolist() == [0, 0, 0]
+
+    # Once prerendered, drawing rasterizes no label: the sprites are pasted. The drawing speed is measured by
+    # tests/benchmark.py.
+    prerendered_labels = len(renderer._labels)
+    pil_image = Image.new("RGB", (640, 640))
+    renderer.draw_on_image(pil_image, boxes, scores, labels)
+    assert len(renderer._labels) == prerendered_labels
+    drawn_array = image.copy()
+    renderer.draw(drawn_array, boxes, scores, labels)
+    np.testing.assert_array_equal(np.asarray(pil_image), drawn_array)
+    assert (drawn_array != 0).any()
+
+
+def test_offline_pipeline(tmp_path):
+    layer, zoom_level, first_tile, size = "ORTHO", 19, (180406, 259887), (4, 5)
+    write_synthetic_mbtiles(
+        str(tmp_path / "region.mbtiles"), layer, zoom_level, first_tile, size
+    )
+    tiles = np.array(
+        [
+            (row, column)
+            for row in range(first_tile[0], first_tile[0] + size[0])
+            for column in range(first_tile[1], first_tile[1] + size[1])
+        ]
+    )
+    # Each pixel of the tiles is owned by a single window, so each tile is covered by the chunks owning its pixels.
+    chunks = plan_chunks(tiles, 320, 64, 2)
+    windows = np.concatenate([chunk_windows for chunk_windows, _ in chunks.values()])
+    assert len(windows) == len(np.unique(windows, axis=0))
+    for chunk, (chunk_windows, covered_tiles) in chunks.items():
+        np.testing.assert_array_equal(chunk_windows // 2, [chunk] * len(chunk_windows))
+        assert len(covered_tiles) == len(np.unique(covered_tiles, axis=0))
+    np.testing.assert_array_equal(
+        np.unique(np.concatenate([covered for _, covered in chunks.values()]), axis=0),
+        tiles,
+    )
+
+    def run(writer, detection_threshold=0.1) -> dict:
+        return run_pipeline(
+            str(tmp_path / "region.mbtiles"),
+            writer,
+            layer,
+            zoom_level,
+            functools.partial(StubInterpreter, input_size=320),
+            {label: str(label) for label in range(13)},
+            workers=2,
+            window_size=320,
+            overlap=64,
+            chunk_windows=2,
+            detection_threshold=detection_threshold,
+        )
+
+    writer = GeoPackageDetectionWriter(str(tmp_path / "detections.gpkg"))
+    progress = run(writer)
+    assert progress["chunks"] == len(chunks)
+    assert progress["tiles"] == len(tiles) and progress["missing_tiles"] > 0
+    assert progress["detections"] > 0
+    envelopes = np.array(
+        [
+            struct.unpack_from("<4d", geometry, 8)
+            for (geometry,) in writer.connection.execute("SELECT geom FROM detections")
+        ]
+    )
+    assert len(envelopes) == progress["detections"]
+    # Detections are centered on the tiles of the archive.
+    matrix_index = TileMatrixIndex.pseudo_mercator([zoom_level])
+    min_longitude, max_latitude = tile_positions_to_coordinates(
+        matrix_index, zoom_level, first_tile[0], first_tile[1]
+    )
+    max_longitude, min_latitude = tile_positions_to_coordinates(
+        matrix_index, zoom_level, first_tile[0] + size[0], first_tile[1] + size[1]
+    )
+    center_longitudes = envelopes[:, :2].mean(axis=1)
+    center_latitudes = envelopes[:, 2:].mean(axis=1)
+    assert np.all(
+        (center_longitudes > min_longitude) & (center_longitudes < max_longitude)
+    )
+    assert np.all((center_latitudes > min_latitude) & (center_latitudes < max_latitude))
+
+    # A run started again only processes the chunks which were not completed.
+    chunk = min(chunks)
+    with writer.connection:
+        writer.connection.execute(
+            "DELETE FROM detections WHERE chunk_row = ? AND chunk_column = ?", chunk
+        )
+        writer.connection.execute(
+            "DELETE FROM pipeline_chunks WHERE chunk_row = ? AND chunk_column = ?",
+            chunk,
+        )
+    resumed_progress = run(writer)
+    assert resumed_progress["chunks"] == 1
+    assert (
+        writer.connection.execute("SELECT COUNT(*) FROM detections").fetchone()[0]
+        == progress["detections"]
+    )
+    with pytest.raises(ValueError):
+        run(writer, detection_threshold=0.5)
+    writer.close()
+
+
+def test_parquet_detection_writer(tmp_path):
+    pytest.importorskip("pyarrow")
+    writer = ParquetDetectionWriter(str(tmp_path / "detections"))
+    writer.check_parameters({"zoom_level": 19})
+    writer.write((3, -1), np.array([0.5, 0.25]), ["car", "truck"], np.ones((2, 4)))
+    writer.write((3, 0), np.array([]), [], np.zeros((0, 4)))
+    assert writer.completed_chunks() == {(3, -1), (3, 0)}
+    table = writer.parquet.read_table(str(tmp_path / "detections"))
+    assert sorted(table.column("label").to_pylist()) == ["car", "truck"]
+    with pytest.raises(ValueError):
+        ParquetDetectionWriter(str(tmp_path / "detections")).check_parameters(
+            {"zoom_level": 18}
+        )
+
+
+class _FailingInterpreter(StubInterpreter):
+    def invoke(self):
+        raise RuntimeError("invoke failed")
+
+
+def test_offline_pipeline_inference_error(tmp_path):
+    layer, zoom_level, first_tile, size = "ORTHO", 19, (180406, 259887), (4, 5)
+    write_synthetic_mbtiles(
+        str(tmp_path / "region.mbtiles"), layer, zoom_level, first_tile, size
+    )
+    tiles = np.array(
+        [
+            (row, column)
+            for row in range(first_tile[0], first_tile[0] + size[0])
+            for column in range(first_tile[1], first_tile[1] + size[1])
+        ]
+    )
+    # A single chunk with more windows than the queue holds, so the decoding thread is blocked when the inference fails.
+    chunk, (windows, covered_tiles) = max(
+        plan_chunks(tiles, 320, 64, 8).items(), key=lambda item: len(item[1][0])
+    )
+    assert len(windows) > 2
+    offline_pipeline._initialize_worker(
+        str(tmp_path / "region.mbtiles"),
+        layer,
+        zoom_level,
+        320,
+        64,
+        functools.partial(_FailingInterpreter, input_size=320),
+        {label: str(label) for label in range(13)},
+        0.1,
+        1,
+        32,
+    )
+    errors = []
+
+    def detect_chunk():
+        try:
+            offline_pipeline._detect_chunk(chunk, windows, covered_tiles)
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        thread = threading.Thread(target=detect_chunk, daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        assert len(errors) == 1 and isinstance(errors[0], RuntimeError)
+    finally:
+        offline_pipeline._worker.clear()
+
+
+def test_change_detection(tmp_path):
+    layer, zoom_level, first_tile, size = "ORTHO", 19, (180406, 259887), (4, 5)
+    for snapshot in ("2021", "2024"):
+        write_synthetic_mbtiles(
+            str(tmp_path / f"{snapshot}.mbtiles"), layer, zoom_level, first_tile, size
+        )
+    # A tile of the new snapshot turned dark, so the detections around it fall below the threshold.
+    changed_tile = (first_tile[0] + 1, first_tile[1] + 3)
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256)).save(buffer, format="PNG")
+    connection = sqlite3.connect(tmp_path / "2024.mbtiles")
+    with connection:
+        connection.execute(
+            "UPDATE tiles SET tile_data = ? WHERE tile_row = ? AND tile_column = ?",
+            (buffer.getvalue(), 2**zoom_level - 1 - changed_tile[0], changed_tile[1]),
+        )
+    connection.close()
+    snapshot_hashes = []
+    for snapshot in ("2021", "2024"):
+        tile_source = open_tile_source(str(tmp_path / f"{snapshot}.mbtiles"))
+        snapshot_hashes += tile_source.tile_hashes(layer, zoom_level)
+        tile_source.close()
+    np.testing.assert_array_equal(snapshot_hashes[0], snapshot_hashes[2])
+    assert find_changed_tiles(*snapshot_hashes).tolist() == [list(changed_tile)]
+    interpreter_factory = functools.partial(StubInterpreter, input_size=320)
+    classes_dict = {label: str(label) for label in range(13)}
+
+    def run(snapshot: str, writer) -> dict:
+        return run_pipeline(
+            str(tmp_path / f"{snapshot}.mbtiles"),
+            writer,
+            layer,
+            zoom_level,
+            interpreter_factory,
+            classes_dict,
+            workers=2,
+            window_size=320,
+            overlap=64,
+            chunk_windows=2,
+            detection_threshold=0.2,
+        )
+
+    previous_output = GeoPackageDetectionWriter(str(tmp_path / "2021.gpkg"))
+    run("2021", previous_output)
+    full_output = GeoPackageDetectionWriter(str(tmp_path / "2024_full.gpkg"))
+    full_progress = run("2024", full_output)
+
+    writer = GeoPackageDetectionWriter(str(tmp_path / "2024.gpkg"))
+    added_writer, removed_writer = (
+        GeoPackageDetectionWriter(str(tmp_path / "changes.gpkg"), layer=changes)
+        for changes in ("added", "removed")
+    )
+    progress = run_change_detection(
+        str(tmp_path / "2021.mbtiles"),
+        previous_output,
+        str(tmp_path / "2024.mbtiles"),
+        writer,
+        added_writer,
+        removed_writer,
+        interpreter_factory,
+        classes_dict,
+        workers=2,
+    )
+    dirty_chunks = find_dirty_chunks(np.array([changed_tile]), 320, 64, 2)
+    assert progress["changed_tiles"] == 1
+    assert progress["detected_chunks"] == len(dirty_chunks)
+    assert progress["reused_chunks"] == full_progress["chunks"] - len(dirty_chunks) > 0
+    # Reusing the unchanged chunks gives the detections of a full run.
+    assert progress["detections"] == full_progress["detections"]
+    for chunk in writer.completed_chunks():
+        np.testing.assert_allclose(
+            writer.read_chunk(chunk)[2], full_output.read_chunk(chunk)[2]
+        )
+    assert progress["added"] == 0 and progress["removed"] > 0
+    assert (
+        sum(len(removed_writer.read_chunk(chunk)[1]) for chunk in dirty_chunks)
+        == progress["removed"]
+    )
+    # Every output is complete, so a run started again has nothing left to do.
+    resumed_progress = run_change_detection(
+        str(tmp_path / "2021.mbtiles"),
+        previous_output,
+        str(tmp_path / "2024.mbtiles"),
+        writer,
+        added_writer,
+        removed_writer,
+        interpreter_factory,
+        classes_dict,
+    )
+    assert resumed_progress["detected_chunks"] == resumed_progress["reused_chunks"] == 0
+    for output in (previous_output, full_output, writer, added_writer, removed_writer):
+        output.close()
+
+    previous_matched, new_matched = match_detections(
+        [[0, 0, 2, 2], [0, 0, 2, 2], [5, 5, 6, 6]],
+        ["car", "truck", "car"],
+        [[0, 0, 2, 1.9], [5, 5, 5.5, 5.5]],
+        ["car", "car"],
+    )
+    assert previous_matched.tolist() == [True, False, False]
+    assert new_matched.tolist() == [True, False]
@@ -1,6 +1,525 @@
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+import pytest
+import numpy as np
+from pyproj import CRS, Transformer
 from object_detection_ign.wmts.satellite_view import WMTSClient
+from object_detection_ign.wmts.utils import (
+    _convert_coordinates,
+    _get_coordinates_transformer,
+    compute_tile_position,
+    compute_tile_positions,
+    get_matrix_index,
+    window_tile_positions,
+)
+from object_detection_ign.wmts.tile_cache import TileCache
+from object_detection_ign.wmts.tile_seeding import TileSeeder, read_geojson_polygons
+from object_detection_ign.wmts.tile_sources import (
+    TileNotFoundError,
+    open_tile_source,
+)
+from object_detection_ign.wmts.geocoding import (
+    GeocodingCache,
+    RateLimiter,
+    normalize_address,
+)
 
 
 def test_wmts_client(wmts_test_client: WMTSClient):
     assert len(wmts_test_client.available_options) > 0
     assert len(wmts_test_client.wmts_instance.contents) > 0
+
+
+def test_concurrent_concat_image(local_wmts_server, wmts_client_config):
+    sequential_client, concurrent_client = (
+        WMTSClient(
+            url=local_wmts_server.url,
+            correspondance_table_path=wmts_client_config["correspondance_table_path"],
+            correspondance_table_url=wmts_client_config["correspondance_table_url"],
+            max_concurrent_requests=max_concurrent_requests,
+        )
+        for max_concurrent_requests in (1, 9)
+    )
+    images, tiles_in_flight = [], []
+    for client in (sequential_client, concurrent_client):
+        local_wmts_server.max_tile_requests_in_flight = 0
+        images.append(
+            client.get_concat_image(3, 3, 100, 200, "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19)
+        )
+        tiles_in_flight.append(local_wmts_server.max_tile_requests_in_flight)
+
+    assert images[0].tobytes() == images[1].tobytes()
+    for i, row in enumerate(range(99, 102)):
+        for j, column in enumerate(range(199, 202)):
+            assert images[1].getpixel((j * 256, i * 256)) == (row, column, 19)
+    # The tiles are downloaded one at a time, or together. The latencies are measured by tests/benchmark.py.
+    assert tiles_in_flight[0] == 1 and tiles_in_flight[1] > 1
+    assert local_wmts_server.tile_requests == 18
+
+
+def test_tile_cache_avoids_downloads(local_wmts_server, wmts_client_config, tmp_path):
+    client = WMTSClient(
+        url=local_wmts_server.url,
+        correspondance_table_path=wmts_client_config["correspondance_table_path"],
+        correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        tile_cache=TileCache(str(tmp_path)),
+    )
+    first_image = client.get_concat_image(
+        3, 3, 100, 200, "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19
+    )
+    # The neighbouring mosaic shares 6 tiles with the first one.
+    client.get_concat_image(3, 3, 100, 201, "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19)
+    second_image = client.get_concat_image(
+        3, 3, 100, 200, "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19
+    )
+    assert local_wmts_server.tile_requests == 12
+    assert first_image.tobytes() == second_image.tobytes()
+    assert client.tile_cache.stats["misses"] == 12
+    assert client.tile_cache.stats["memory_hits"] == 15
+
+
+class _ThreadRecordingTileCache(TileCache):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = set()
+
+    def get(self, key):
+        self.threads.add(threading.get_ident())
+        return super().get(key)
+
+    def put(self, key, content):
+        self.threads.add(threading.get_ident())
+        super().put(key, content)
+
+
+def test_async_tile_cache_off_event_loop(
+    local_wmts_server, wmts_client_config, tmp_path
+):
+    client = WMTSClient(
+        url=local_wmts_server.url,
+        correspondance_table_path=wmts_client_config["correspondance_table_path"],
+        correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        tile_cache=_ThreadRecordingTileCache(str(tmp_path)),
+    )
+
+    async def get_tiles() -> int:
+        for _ in range(2):
+            await client.async_get_tile_content(
+                "HR.ORTHOIMAGERY.ORTHOPHOTOS", 19, 100, 200
+            )
+        return threading.get_ident()
+
+    event_loop_thread = asyncio.run(get_tiles())
+    assert local_wmts_server.tile_requests == 1
+    assert client.tile_cache.threads
+    assert event_loop_thread not in client.tile_cache.threads
+
+
+def test_tile_cache_tiers(tmp_path):
+    tile_cache = TileCache(str(tmp_path), memory_capacity=2, disk_budget_bytes=30)
+    for column in range(3):
+        tile_cache.put(("layer", 19, 0, column), bytes([column]) * 10)
+    assert tile_cache.stats["memory_tiles"] == 2
+
+    # The evicted tile is still served from disk, including by another worker.
+    other_worker_cache = TileCache(str(tmp_path))
+    assert other_worker_cache.get(("layer", 19, 0, 0)) == bytes([0]) * 10
+    assert other_worker_cache.stats["disk_hits"] == 1
+
+    # Exceeding the disk budget evicts the least recently accessed tiles, down to the low water mark.
+    tile_cache.put(("layer", 19, 0, 3), bytes([3]) * 10)
+    assert TileCache(str(tmp_path)).get(("layer", 19, 0, 1)) is None
+    assert TileCache(str(tmp_path)).get(("layer", 19, 0, 2)) is None
+    assert tile_cache.disk_size == other_worker_cache.disk_size == 20
+    # Replacing a tile updates the size of the disk tier.
+    tile_cache.put(("layer", 19, 0, 3), bytes([3]) * 5)
+    assert tile_cache.disk_size == 15
+
+    expired_cache = TileCache(str(tmp_path), ttl=0)
+    assert expired_cache.get(("layer", 19, 0, 3)) is None
+    assert expired_cache.stats["misses"] == 1
+
+
+def test_normalize_address():
+    assert (
+        normalize_address("  E.Leclerc ,60290   CAUFFRY ")
+        == normalize_address("e.leclerc, 60290 cauffry")
+        == "e.leclerc, 60290 cauffry"
+    )
+
+
+def test_geocoding_cache(
+    local_wmts_server,
+    local_nominatim_server,
+    wmts_client_config,
+    address_data,
+    tmp_path,
+):
+    database_path = str(tmp_path / "geocoding_cache.sqlite")
+    client = WMTSClient(
+        url=local_wmts_server.url,
+        correspondance_table_path=wmts_client_config["correspondance_table_path"],
+        correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        geocoding_url=local_nominatim_server.url,
+        geocoding_cache=GeocodingCache(database_path, not_found_ttl=0.5),
+        geocoding_rate_limit=10,
+    )
+    start = time.perf_counter()
+    found_result = client.reverse_geocoding(address_data["address"])
+    assert client.reverse_geocoding(address_data["address"].upper()) == found_result
+    assert found_result[2]
+    not_found_result = client.reverse_geocoding("Nowhere")
+    assert (
+        client.reverse_geocoding("nowhere ") == not_found_result == (None, None, False)
+    )
+    assert local_nominatim_server.search_requests == 2
+    # The two outgoing calls are spaced by the rate limit.
+    assert time.perf_counter() - start >= 0.1
+
+    # Results persist across workers, and not found results expire sooner.
+    time.sleep(0.5)
+    other_worker_cache = GeocodingCache(database_path, not_found_ttl=0.5)
+    assert other_worker_cache.get(address_data["address"]) == found_result
+    assert other_worker_cache.get("Nowhere") is None
+
+
+def test_shared_rate_limiter(tmp_path):
+    database_path = str(tmp_path / "geocoding_cache.sqlite")
+    first_worker, second_worker = RateLimiter(1, database_path), RateLimiter(
+        1, database_path
+    )
+    # The workers reserve consecutive slots of the same schedule.
+    delays = [
+        first_worker.reserve(),
+        second_worker.reserve(),
+        first_worker.reserve(),
+    ]
+    assert delays[0] < 0.5 < 0.9 < delays[1] < 1.1 < 1.9 < delays[2]
+
+
+def test_concurrent_geocoding_lookups(
+    local_wmts_server, local_nominatim_server, wmts_client_config, address_data
+):
+    client = WMTSClient(
+        url=local_wmts_server.url,
+        correspondance_table_path=wmts_client_config["correspondance_table_path"],
+        correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        geocoding_url=local_nominatim_server.url,
+        geocoding_cache=GeocodingCache(),
+    )
+
+    async def look_up() -> list:
+        return await asyncio.gather(
+            *(
+                client.async_reverse_geocoding(address)
+                for address in [address_data["address"]] * 4
+                + [address_data["address"].upper()]
+            )
+        )
+
+    results = asyncio.run(look_up())
+    assert local_nominatim_server.search_requests == 1
+    assert results[0][2] and all(result == results[0] for result in results)
+    assert client.geocoding_cache.stats["misses"] == 1
+
+
+def test_coordinates_conversion(local_wmts_client: WMTSClient):
+    rng = np.random.default_rng(0)
+    longitudes, latitudes = rng.uniform(-5, 8, 2000), rng.uniform(42, 51, 2000)
+    uncached_transformer = Transformer.from_crs(
+        CRS("EPSG:4326"), CRS("EPSG:3857"), always_xy=True
+    )
+
+    # The transformer is built once per thread, and converts like a freshly built one.
+    assert _get_coordinates_transformer() is _get_coordinates_transformer()
+    for longitude, latitude in zip(longitudes[:100], latitudes[:100]):
+        assert _convert_coordinates(longitude, latitude) == pytest.approx(
+            uncached_transformer.transform(longitude, latitude)
+        )
+    tile_rows, tile_columns = compute_tile_positions(
+        local_wmts_client.matrix_set, 19, longitudes, latitudes
+    )
+    for i in range(0, len(longitudes), 100):
+        assert compute_tile_position(
+            local_wmts_client.matrix_set, 19, longitudes[i], latitudes[i]
+        ) == (tile_rows[i], tile_columns[i])
+
+
+def test_boxes_to_coordinates(local_wmts_client: WMTSClient, location_data: dict):
+    satellite_view = local_wmts_client.create_satellite_view_from_location(
+        location_data["latitude"],
+        location_data["longitude"],
+        location_data["layer"],
+        location_data["zoom_level"],
+    )
+    satellite_view.crop_image_center(640, 640)
+    (
+        min_longitude,
+        min_latitude,
+        max_longitude,
+        max_latitude,
+    ), half_box = satellite_view.boxes_to_coordinates(
+        np.array([[0, 0, 1, 1], [0, 0, 0.5, 0.5]]), local_wmts_client.matrix_set
+    )
+    assert min_longitude < location_data["longitude"] < max_longitude
+    assert min_latitude < location_data["latitude"] < max_latitude
+    assert half_box[0] == pytest.approx(min_longitude)
+    assert half_box[2] == pytest.approx((min_longitude + max_longitude) / 2)
+    assert half_box[3] == pytest.approx(max_latitude)
+
+
+def test_view_window_centered_on_point(
+    local_wmts_server, local_wmts_client: WMTSClient, location_data: dict
+):
+    requests_before = local_wmts_server.tile_requests
+    satellite_view = local_wmts_client.create_satellite_view_from_location(
+        location_data["latitude"],
+        location_data["longitude"],
+        location_data["layer"],
+        location_data["zoom_level"],
+        window_width=640,
+        window_height=512,
+    )
+    assert satellite_view.size == (640, 512)
+    assert (
+        local_wmts_server.tile_requests - requests_before
+        == len(satellite_view.tile_arrays)
+        == len(window_tile_positions(*satellite_view.pixel_window))
+    )
+    # The point falls on the center pixel of the image, at every zoom level.
+    for zoom_level in (12, 16, location_data["zoom_level"]):
+        satellite_view = local_wmts_client.create_satellite_view_from_location(
+            location_data["latitude"],
+            location_data["longitude"],
+            location_data["layer"],
+            zoom_level,
+            window_width=640,
+            window_height=640,
+        )
+        (
+            min_longitude,
+            min_latitude,
+            max_longitude,
+            max_latitude,
+        ) = satellite_view.boxes_to_coordinates(
+            np.array([[320, 320, 321, 321]]) / 640, local_wmts_client.matrix_set
+        )[
+            0
+        ]
+        assert min_longitude <= location_data["longitude"] < max_longitude
+        assert min_latitude < location_data["latitude"] <= max_latitude
+
+
+def test_tile_matrix_index(
+    local_wmts_server, local_wmts_client: WMTSClient, location_data: dict
+):
+    matrix_index = local_wmts_client.matrix_index
+    assert get_matrix_index(local_wmts_client.matrix_set) is not matrix_index
+    assert get_matrix_index(matrix_index) is matrix_index
+    for zoom_level, tile_matrix in local_wmts_client.matrix_set.tilematrix.items():
+        x0, y0, tile_width_meters, matrix_height, matrix_width = matrix_index.matrix(
+            int(zoom_level)
+        )
+        assert (x0, y0) == tuple(map(float, tile_matrix.topleftcorner))
+        assert tile_width_meters == pytest.approx(
+            tile_matrix.scaledenominator * 0.00028 * 256
+        )
+        assert (matrix_height, matrix_width) == (
+            tile_matrix.matrixheight,
+            tile_matrix.matrixwidth,
+        )
+    with pytest.raises(ValueError):
+        matrix_index.matrix(max(matrix_index.zoom_levels) + 1)
+    with pytest.raises(ValueError):
+        compute_tile_position(matrix_index, 19, 0.0, 89.0)
+    # A point of the last half-tile is in the last tile, not past the matrix.
+    assert compute_tile_position(matrix_index, 0, 100.0, -10.0) == (0, 0)
+    assert compute_tile_position(matrix_index, 1, 100.0, -10.0) == (1, 1)
+    rows, columns = compute_tile_positions(matrix_index, 0, [100.0], [-10.0])
+    assert (rows.tolist(), columns.tolist()) == ([0], [0])
+    assert matrix_index.contains(
+        19, [0, -0.5, 2**19], [2**19 - 0.5, 0, 0]
+    ).tolist() == [
+        True,
+        False,
+        False,
+    ]
+
+    # Out-of-range points and windows are rejected without requesting any tile.
+    requests_before = local_wmts_server.tile_requests
+    for latitude, longitude, zoom_level, window_size in (
+        (89.0, location_data["longitude"], 19, 640),
+        (-89.0, location_data["longitude"], 19, None),
+        (85.05, 0.0, 2, 640),
+        (location_data["latitude"], location_data["longitude"], 25, 640),
+    ):
+        satellite_view = local_wmts_client.create_satellite_view_from_location(
+            latitude,
+            longitude,
+            location_data["layer"],
+            zoom_level,
+            window_width=window_size,
+            window_height=window_size,
+        )
+        assert not satellite_view.found_coordinates
+    assert local_wmts_server.tile_requests == requests_before
+
+
+def test_tile_seeding(local_wmts_server, wmts_client_config, tmp_path):
+    client = WMTSClient(
+        url=local_wmts_server.url,
+        correspondance_table_path=wmts_client_config["correspondance_table_path"],
+        correspondance_table_url=wmts_client_config["correspondance_table_url"],
+        tile_cache=TileCache(str(tmp_path / "tiles")),
+    )
+    layer, bounding_box = "HR.ORTHOIMAGERY.ORTHOPHOTOS", (
+        2.2945,
+        48.8580,
+        2.2950,
+        48.8585,
+    )
+    geojson_path = tmp_path / "region.geojson"
+    geojson_path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "geometry": {
+                            "type": "Polygon",
+                            "coordinates": [
+                                [
+                                    (2.2945, 48.8580),
+                                    (2.2950, 48.8580),
+                                    (2.2950, 48.8585),
+                                ]
+                            ],
+                        },
+                    }
+                ],
+            }
+        )
+    )
+    (triangle,) = read_geojson_polygons(str(geojson_path))
+    assert triangle[1] == (2.2950, 48.8580)
+
+    # Tiles already stored are skipped.
+    client.get_tile_content(
+        layer, 18, *compute_tile_position(client.matrix_index, 18, 2.2945, 48.8585)
+    )
+    seeder = TileSeeder(client, max_concurrent_downloads=4)
+    tile_keys, stored_tiles = seeder.plan(layer, [18, 19], [bounding_box, triangle])
+    assert stored_tiles == 1
+    assert len(set(tile_keys)) == len(tile_keys) > 1
+
+    requests_before = local_wmts_server.tile_requests
+    progress = asyncio.run(seeder.seed(tile_keys))
+    assert progress["downloaded"] == len(tile_keys)
+    assert local_wmts_server.tile_requests - requests_before == len(tile_keys)
+    assert seeder.plan(layer, [18, 19], [bounding_box]) == ([], len(tile_keys) + 1)
+
+    # The bandwidth cap spaces the downloads out.
+    tile_size = progress["bytes"] / progress["downloaded"]
+    seeder = TileSeeder(client, max_bytes_per_second=tile_size / 0.05)
+    progress = asyncio.run(seeder.seed(tile_keys[:5]))
+    assert progress["duration"] >= 0.15
+
+
+def test_local_tile_sources(
+    local_wmts_server, local_wmts_client: WMTSClient, location_data: dict, tmp_path
+):
+    layer, zoom_level = location_data["layer"], location_data["zoom_level"]
+    served_view = local_wmts_client.create_satellite_view_from_location(
+        location_data["latitude"], location_data["longitude"], layer, zoom_level
+    )
+    tiles = {
+        position: local_wmts_client.get_tile_content(layer, zoom_level, *position)
+        for position in served_view.tile_arrays
+    }
+    min_row, min_column = map(int, np.min(list(tiles), axis=0))
+    _, y0, tile_width_meters, _, _ = local_wmts_client.matrix_index.matrix(zoom_level)
+
+    # MBTiles rows are counted from the bottom of the matrix.
+    mbtiles = sqlite3.connect(tmp_path / "region.mbtiles")
+    mbtiles.executescript(
+        """CREATE TABLE metadata (name TEXT, value TEXT);
+        CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);"""
+    )
+    mbtiles.execute("INSERT INTO metadata VALUES ('name', ?)", (layer,))
+    mbtiles.executemany(
+        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+        [
+            (zoom_level, column, 2**zoom_level - 1 - row, content)
+            for (row, column), content in tiles.items()
+        ],
+    )
+    # The GeoPackage matrix only covers the region, and its zoom levels are numbered from 0.
+    geopackage = sqlite3.connect(tmp_path / "region.gpkg")
+    geopackage.executescript(
+        """CREATE TABLE gpkg_spatial_ref_sys (srs_id INTEGER, organization TEXT, organization_coordsys_id INTEGER);
+        CREATE TABLE gpkg_contents (table_name TEXT, data_type TEXT);
+        CREATE TABLE gpkg_tile_matrix_set (table_name TEXT, srs_id INTEGER, min_x REAL, min_y REAL, max_x REAL, max_y REAL);
+        CREATE TABLE gpkg_tile_matrix (table_name TEXT, zoom_level INTEGER, matrix_width INTEGER, matrix_height INTEGER,
+            tile_width INTEGER, tile_height INTEGER, pixel_x_size REAL, pixel_y_size REAL);
+        CREATE TABLE ortho (id INTEGER PRIMARY KEY, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+        INSERT INTO gpkg_spatial_ref_sys VALUES (3857, 'EPSG', 3857);
+        INSERT INTO gpkg_contents VALUES ('ortho', 'tiles');"""
+    )
+    geopackage.execute(
+        "INSERT INTO gpkg_tile_matrix_set VALUES ('ortho', 3857, ?, 0, 0, ?)",
+        (
+            -20037508.3427892 + min_column * tile_width_meters,
+            y0 - min_row * tile_width_meters,
+        ),
+    )
+    geopackage.execute(
+        "INSERT INTO gpkg_tile_matrix VALUES ('ortho', 0, 3, 3, 256, 256, ?, ?)",
+        (tile_width_meters / 256, tile_width_meters / 256),
+    )
+    geopackage.executemany(
+        "INSERT INTO ortho (zoom_level, tile_column, tile_row, tile_data) VALUES (0, ?, ?, ?)",
+        [
+            (column - min_column, row - min_row, content)
+            for (row, column), content in tiles.items()
+        ],
+    )
+    for connection in (mbtiles, geopackage):
+        connection.commit()
+        connection.close()
+
+    requests_before = local_wmts_server.tile_requests
+    for path, source_layer in (
+        (tmp_path / "region.mbtiles", layer),
+        (tmp_path / "region.gpkg", "ortho"),
+    ):
+        tile_source = open_tile_source(str(path))
+        client = WMTSClient(
+            url="http://127.0.0.1:9/wmts",
+            correspondance_table_path="data/correspondance_table.csv",
+            correspondance_table_url="",
+            tile_source=tile_source,
+        )
+        assert client.list_available_layers() == [source_layer]
+        assert client.matrix_index.zoom_levels == [zoom_level]
+        np.testing.assert_array_equal(
+            client.matrix_index.matrices[zoom_level],
+            local_wmts_client.matrix_index.matrices[zoom_level],
+        )
+        local_view = client.create_satellite_view_from_location(
+            location_data["latitude"],
+            location_data["longitude"],
+            source_layer,
+            zoom_level,
+        )
+        assert local_view.pixel_window == served_view.pixel_window
+        np.testing.assert_array_equal(local_view.image_array, served_view.image_array)
+        with pytest.raises(TileNotFoundError):
+            client.get_tile_content(source_layer, zoom_level, min_row - 1, min_column)
+        with pytest.raises(TileNotFoundError):
+            client.get_tile_content("other", zoom_level, min_row, min_column)
+        tile_source.close()
+    assert local_wmts_server.tile_requests == requests_before